@@ -1,7 +1,7 @@
 # =========================================
 # Miku Bot - Discord Server Manager
 # Voice channels, moderation, AI chat, music, and more.
-# MongoDB for persistence, per-guild settings.
+# MongoDB or SQLite for persistence, per-guild settings.
 # =========================================
 
 from dotenv import load_dotenv
@@ -14,15 +14,27 @@ from discord.ext import commands, tasks
 import asyncio
 import os
 import logging
+import threading
+import signal
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, timezone
 import random
 import re
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
 import time
 import requests
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 import json
 import ast
+from abc import ABC, abstractmethod
+import bisect
+import string
+import unicodedata
+import sqlite3
+import sys
+import heapq
 from typing import Optional
 import aiohttp
 import math
@@ -34,9 +46,9 @@ import pytz
 import yt_dlp
 
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, UpdateOne, DeleteOne
 except ImportError:
-    MongoClient = None
+    MongoClient = UpdateOne = DeleteOne = None
     print("Warning: pymongo not installed. Database features will be disabled.")
 
 try:
@@ -62,29 +74,459 @@ if spotipy and SpotifyClientCredentials:
 else:
     sp = None
 
+# --- Bounded Trackers ---
+# Per-user anti-spam and bookkeeping dicts would otherwise only grow. TTLCache drops
+# entries a fixed time after their last write and caps the entry count; the sweeper
+# task expires idle entries even when nothing touches the tracker.
+TRACKER_MAX_ENTRIES = int(os.getenv("TRACKER_MAX_ENTRIES", "50000"))
+TTL_SWEEP_INTERVAL = int(os.getenv("TTL_SWEEP_INTERVAL", "60"))  # seconds
+ttl_caches = {}  # {name: TTLCache}, for the sweeper and !memstats
+
+class TTLCache(MutableMapping):
+    """Dict whose entries expire `ttl` seconds after their last write, capped at `max_size`.
+
+    Keys are kept in write order, so expiry and the size cap only ever look at the
+    oldest entries. Nested values changed in place should call touch(key) to stay
+    alive. on_evict(key, value) runs for entries dropped by expiry or the cap, not for
+    explicit deletes.
+    """
+
+    def __init__(self, name, ttl, max_size=TRACKER_MAX_ENTRIES, default_factory=None, on_evict=None,
+                 register=True):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.default_factory = default_factory
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._data = {}
+        self._written = OrderedDict()  # key -> monotonic time of last write, oldest first
+        if register:
+            ttl_caches[name] = self
+
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            if self.default_factory is None:
+                raise
+        value = self[key] = self.default_factory()
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self.touch(key)
+        if self.max_size is not None and len(self._data) > self.max_size:
+            self._evict(next(iter(self._written)))
+
+    def __delitem__(self, key):
+        del self._data[key]
+        del self._written[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def pop(self, key, *default):
+        if key not in self._data:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._written.pop(key)
+        return self._data.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self._data:
+            self[key] = default
+        return self._data[key]
+
+    def clear(self):
+        self._data.clear()
+        self._written.clear()
+
+    def entry_count(self) -> int:
+        return len(self._data)
+
+    def set_with_time(self, key, value, written_at) -> bool:
+        """Insert an entry last written at `written_at` (a time.time() value), e.g. a restored one.
+
+        Entries must be inserted oldest first. Returns False, without inserting, if the
+        entry has already expired.
+        """
+        age = max(0.0, time.time() - written_at)
+        if age >= self.ttl:
+            return False
+        self._data[key] = value
+        self._written[key] = time.monotonic() - age
+        self._written.move_to_end(key)
+        if self.max_size is not None and len(self._data) > self.max_size:
+            self._evict(next(iter(self._written)))
+        return True
+
+    def touch(self, key) -> None:
+        """Restart the expiry clock of an existing entry."""
+        self._written[key] = time.monotonic()
+        self._written.move_to_end(key)
+
+    def _evict(self, key) -> None:
+        value = self._data.pop(key)
+        del self._written[key]
+        self.evictions += 1
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.error(f"Error evicting {key!r} from {self.name}: {e}")
+
+    def expire(self) -> int:
+        """Drop every entry not written within the last `ttl` seconds; returns how many."""
+        cutoff = time.monotonic() - self.ttl
+        expired = 0
+        while self._written:
+            key, written = next(iter(self._written.items()))
+            if written > cutoff:
+                break
+            self._evict(key)
+            expired += 1
+        return expired
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the tracker (containers, keys and values)."""
+        return sys.getsizeof(self._data) + sys.getsizeof(self._written) + sum(
+            _approx_sizeof(key) + _approx_sizeof(value) for key, value in self._data.items()
+        )
+
+class GuildTrackers(dict):
+    """{guild_id: TTLCache}, so each guild's entries are looked up, listed and expired on their own.
+
+    A guild's cache is created on first use and dropped once it has expired empty.
+    on_evict(guild_id, key, value) runs for entries dropped by expiry or the cap.
+    """
+
+    def __init__(self, name, ttl, max_size=TRACKER_MAX_ENTRIES, on_evict=None):
+        super().__init__()
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._evicted_from_dropped = 0
+        ttl_caches[name] = self
+
+    def __missing__(self, guild_id):
+        on_evict = None
+        if self.on_evict is not None:
+            on_evict = lambda key, value: self.on_evict(guild_id, key, value)
+        cache = self[guild_id] = TTLCache(
+            f"{self.name}:{guild_id}", ttl=self.ttl, max_size=self.max_size, on_evict=on_evict, register=False
+        )
+        return cache
+
+    def setdefault(self, guild_id, default=None):
+        return self[guild_id]
+
+    @property
+    def evictions(self) -> int:
+        return self._evicted_from_dropped + sum(cache.evictions for cache in self.values())
+
+    def entry_count(self) -> int:
+        return sum(len(cache) for cache in self.values())
+
+    def expire(self) -> int:
+        expired = 0
+        for guild_id, cache in list(self.items()):
+            expired += cache.expire()
+            if not cache:
+                self._evicted_from_dropped += cache.evictions
+                del self[guild_id]
+        return expired
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self) + sum(cache.memory_bytes() for cache in self.values())
+
+def _approx_sizeof(obj, depth=3) -> int:
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_approx_sizeof(k, depth - 1) + _approx_sizeof(v, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, deque)):
+        size += sum(_approx_sizeof(item, depth - 1) for item in obj)
+    return size
+
+class SlidingWindowCounter:
+    """Counts events per key, e.g. (guild_id, user_id[, target_id]), over the last `window` seconds.
+
+    Each key keeps a ring buffer of at most `capacity` timestamps, which is enough to
+    test any threshold below capacity, so a hit is O(1) amortized and allocates
+    nothing after the key's first event. Keys idle for a whole window expire from
+    the underlying TTLCache.
+    """
+
+    def __init__(self, name, window, capacity):
+        self.window = window
+        self.capacity = capacity
+        self._events = TTLCache(name, ttl=window)
+
+    def _prune(self, events, now) -> None:
+        cutoff = now - self.window
+        while events and events[0] <= cutoff:
+            events.popleft()
+
+    def hit(self, key, now=None) -> int:
+        """Record one event and return how many fall inside the window (at most capacity)."""
+        now = time.time() if now is None else now
+        events = self._events.get(key)
+        if events is None:
+            events = self._events[key] = deque(maxlen=self.capacity)
+        else:
+            self._events.touch(key)
+        events.append(now)
+        self._prune(events, now)
+        return len(events)
+
+    def count(self, key, now=None) -> int:
+        events = self._events.get(key)
+        if not events:
+            return 0
+        self._prune(events, time.time() if now is None else now)
+        return len(events)
+
+    def reset(self, key) -> None:
+        self._events.pop(key, None)
+
+    def clear(self) -> None:
+        self._events.clear()
+
+async def sweep_ttl_caches(interval: float = TTL_SWEEP_INTERVAL) -> None:
+    """Periodically expire idle entries from every tracker."""
+    while True:
+        await asyncio.sleep(interval)
+        for cache in list(ttl_caches.values()):
+            try:
+                expired = cache.expire()
+                if expired:
+                    logger.debug(f"Expired {expired} entries from {cache.name}")
+            except Exception as e:
+                logger.error(f"Error sweeping {cache.name}: {e}")
+
 # --- Module-level state containers ---
-chat_message_timestamps = {}   # {guild_id: {user_id: [timestamps]}}
+CHAT_ACTIVITY_RATE_LIMIT = 5  # messages per 10 seconds that count towards chat activity
+chat_message_timestamps = SlidingWindowCounter(  # keyed (guild_id, user_id)
+    "chat_message_timestamps", window=10, capacity=CHAT_ACTIVITY_RATE_LIMIT
+)
 chat_activity_weekly = {}      # {guild_id: {user_id: [count]*7}}
 voice_activity_weekly = {}     # {guild_id: {user_id: [seconds]*7}}
 active_dm_conversations = {}   # {user_id: {"channel_id": ..., "moderator_id": ..., "start_time": ...}}
 
+# --- Storage Executor ---
+# All database I/O runs on one dedicated worker thread so the gateway heartbeat and
+# other guilds are never stalled by MongoDB. A single worker keeps writes ordered.
+# The startup load reads collections in parallel on a separate small pool.
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+storage_read_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="storage-read")
+storage_metrics = {
+    "ops": 0,
+    "errors": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+    "last_ms": 0.0,
+    "loop_thread_calls": 0,  # storage calls that (wrongly) ran on the event loop thread
+    "marks": 0,    # mark_dirty() calls
+    "flushes": 0,  # coalesced background saves
+    "loop_lag_ms": 0.0,
+    "loop_lag_max_ms": 0.0,
+}
+_background_tasks = set()
+
+def storage_io(func):
+    """Mark a blocking database function; counts any call made from the event loop thread."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if threading.current_thread() is threading.main_thread():
+            storage_metrics["loop_thread_calls"] += 1
+            logger.warning(f"Storage call {func.__name__} ran on the event loop thread")
+        return func(*args, **kwargs)
+    return wrapper
+
+async def run_storage(func, *args, executor=None):
+    """Run a blocking database function on the storage thread and record its latency."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor or storage_executor, functools.partial(func, *args))
+    except Exception:
+        storage_metrics["errors"] += 1
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        storage_metrics["ops"] += 1
+        storage_metrics["total_ms"] += elapsed_ms
+        storage_metrics["last_ms"] = elapsed_ms
+        storage_metrics["max_ms"] = max(storage_metrics["max_ms"], elapsed_ms)
+
+def spawn_background(coro):
+    """Schedule a coroutine without awaiting it, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Measure how late the event loop wakes up; storage must never make this grow."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (time.perf_counter() - start - interval) * 1000)
+        storage_metrics["loop_lag_ms"] = lag_ms
+        storage_metrics["loop_lag_max_ms"] = max(storage_metrics["loop_lag_max_ms"], lag_ms)
+
+async def wait_for_state(*collections) -> None:
+    """Wait until the named persisted states have finished loading (no-op without storage)."""
+    for name in collections:
+        ready = PERSISTED_STATES[name].ready
+        if ready is not None:
+            await ready.wait()
+
+def requires_state(*collections):
+    """Command check that waits for the persisted states a command reads or changes."""
+    async def predicate(ctx):
+        await wait_for_state(*collections)
+        return True
+    return commands.check(predicate)
+
 # --- Per-Guild (Server) Settings Helper Functions ---
+# Every guild's settings document is kept in memory so that hot paths (on_message,
+# on_voice_state_update, ...) never touch the database. The cache is loaded once at
+# startup, updated write-through by set_guild_setting, and kept in sync with edits made
+# by other processes through a MongoDB change stream (or polling when unavailable).
+# A polled snapshot may be read before a local write lands, so guilds with a write in
+# flight, or one finished after the snapshot read began, keep their cached settings.
+guild_settings_cache = {}  # {guild_id: settings_dict}
+SETTINGS_POLL_INTERVAL = int(os.getenv("SETTINGS_POLL_INTERVAL", "60"))  # seconds
+_settings_writes_in_flight = defaultdict(int)  # {guild_id: queued writes not yet finished}
+_settings_written_at = {}  # {guild_id: time.monotonic() when its last write finished}
+
 def get_guild_settings(guild_id):
-    """Fetch settings for a specific Discord server (guild) from the database."""
-    if db is None:
-        return {}
-    settings = db.guild_settings.find_one({"guild_id": guild_id})
-    return settings or {}
+    """Fetch settings for a specific Discord server (guild) from the in-memory cache."""
+    return guild_settings_cache.get(guild_id, {})
 
 def set_guild_setting(guild_id, key, value):
-    """Set a specific setting for a Discord server (guild) in the database."""
-    if db is None:
+    """Set a specific setting for a Discord server (guild), writing through to the database."""
+    settings = dict(guild_settings_cache.get(guild_id, {"guild_id": guild_id}))
+    settings[key] = value
+    guild_settings_cache[guild_id] = settings
+    if storage is None:
         return
-    db.guild_settings.update_one(
-        {"guild_id": guild_id},
-        {"$set": {key: value}},
-        upsert=True
+    _settings_writes_in_flight[guild_id] += 1
+    task = spawn_background(run_storage(_write_guild_setting, guild_id, key, value))
+    task.add_done_callback(lambda _: _guild_setting_written(guild_id))
+
+def _guild_setting_written(guild_id):
+    _settings_written_at[guild_id] = time.monotonic()
+    _settings_writes_in_flight[guild_id] -= 1
+    if _settings_writes_in_flight[guild_id] <= 0:
+        del _settings_writes_in_flight[guild_id]
+
+def _merge_guild_settings_snapshot(docs, read_started):
+    """Replace cached settings with a snapshot read at `read_started` (time.monotonic()).
+
+    Guilds written locally since then, or still being written, keep their cached
+    settings; the snapshot may not include those writes yet.
+    """
+    def snapshot_is_stale(guild_id):
+        return guild_id in _settings_writes_in_flight or _settings_written_at.get(guild_id, float("-inf")) >= read_started
+    fresh = {doc["guild_id"]: doc for doc in docs if "guild_id" in doc}
+    for guild_id in [g for g in guild_settings_cache if g not in fresh and not snapshot_is_stale(g)]:
+        del guild_settings_cache[guild_id]
+    for guild_id, doc in fresh.items():
+        if not snapshot_is_stale(guild_id):
+            guild_settings_cache[guild_id] = doc
+
+def _apply_guild_settings_change(change):
+    """Apply a single change stream event to the settings cache."""
+    op = change.get("operationType")
+    doc = change.get("fullDocument")
+    if op in ("insert", "update", "replace") and doc and "guild_id" in doc:
+        guild_settings_cache[doc["guild_id"]] = doc
+    elif op == "delete":
+        doc_id = change.get("documentKey", {}).get("_id")
+        for guild_id, settings in list(guild_settings_cache.items()):
+            if settings.get("_id") == doc_id:
+                del guild_settings_cache[guild_id]
+
+@storage_io
+def _fetch_all_guild_settings():
+    """Fetch every guild's settings document (blocking, run it off the event loop)."""
+    if storage is None:
+        return []
+    return storage.find_all("guild_settings")
+
+async def load_guild_settings() -> None:
+    """Fill the settings cache from storage before the bot starts handling events."""
+    if storage is None:
+        return
+    try:
+        read_started = time.monotonic()
+        docs = await run_storage(_fetch_all_guild_settings)
+        _merge_guild_settings_snapshot(docs, read_started)
+        logger.info(f"Loaded settings for {len(docs)} guilds into cache")
+    except Exception as e:
+        logger.error(f"Error loading guild settings: {e}")
+
+def _guild_settings_watcher(loop) -> None:
+    """Background thread mirroring guild_settings edits from other processes into the cache."""
+    use_stream = storage.supports_change_streams
+    while True:
+        try:
+            if use_stream:
+                with storage.watch("guild_settings") as stream:
+                    for change in stream:
+                        loop.call_soon_threadsafe(_apply_guild_settings_change, change)
+            else:
+                time.sleep(SETTINGS_POLL_INTERVAL)
+                read_started = time.monotonic()
+                docs = _fetch_all_guild_settings()
+                loop.call_soon_threadsafe(_merge_guild_settings_snapshot, docs, read_started)
+        except RuntimeError:
+            return  # event loop closed, bot is shutting down
+        except Exception as e:
+            # Change streams need a replica set (error 40573 on standalone servers)
+            if use_stream and getattr(e, "code", None) == 40573:
+                logger.warning(f"Settings change stream unavailable, polling every {SETTINGS_POLL_INTERVAL}s instead")
+                use_stream = False
+            else:
+                # Resync after an interrupted stream so no edits are missed
+                logger.error(f"Guild settings watcher error: {e}")
+                time.sleep(5)
+                try:
+                    read_started = time.monotonic()
+                    docs = _fetch_all_guild_settings()
+                    loop.call_soon_threadsafe(_merge_guild_settings_snapshot, docs, read_started)
+                except RuntimeError:
+                    return
+                except Exception:
+                    pass
+
+def start_guild_settings_watcher() -> None:
+    """Start the settings watcher thread (once per process)."""
+    if storage is None or getattr(bot, '_settings_watcher', None) is not None:
+        return
+    watcher = threading.Thread(
+        target=_guild_settings_watcher,
+        args=(asyncio.get_running_loop(),),
+        name="guild-settings-watcher",
+        daemon=True
     )
+    watcher.start()
+    bot._settings_watcher = watcher
 
 def get_guild_timezone(guild_id):
     """Get the timezone for a guild, defaulting to UTC if not set."""
@@ -106,6 +548,8 @@ def update_weekly_chat_activity(guild_id, user_id):
         chat_activity_weekly[guild_id][user_id] = [0] * 7
     idx = datetime.datetime.utcnow().weekday()
     chat_activity_weekly[guild_id][user_id][idx] += 1
+    mark_dirty("chat_activity_weekly", guild_id, user_id)
+    bump_leaderboard("chat_weekly", guild_id, user_id, sum(chat_activity_weekly[guild_id][user_id]))
 
 # --- Conversation Start Time Tracking ---
 # Used for tracking how long a conversation has been going in a server
@@ -208,27 +652,91 @@ def postprocess_response(text, recent_endings: Optional[list] = None):
     return text
 
 # --- Channel History Helper ---
-async def get_recent_channel_history(channel: discord.TextChannel, bot_user: discord.User, current_message: discord.Message, limit: int = 20) -> list:
-    """
-    Fetch the last N messages from a channel (excluding commands and bot messages),
-    for use as context in AI responses.
+# AI replies take their context from an in-memory ring of each channel's recent
+# messages instead of a channel.history REST call per reply. A channel's ring is
+# loaded over REST the first time the AI answers there (a cold start) and is then kept
+# current by on_message and the raw edit/delete events; rings idle for
+# CHANNEL_HISTORY_TTL are dropped and reload on next use.
+CHANNEL_HISTORY_SIZE = 21  # the 20 context messages plus the message being answered
+CHANNEL_HISTORY_TTL = 6 * 3600  # seconds
+CHANNEL_HISTORY_MAX_CHANNELS = 500
+channel_history = TTLCache("channel_history", ttl=CHANNEL_HISTORY_TTL, max_size=CHANNEL_HISTORY_MAX_CHANNELS)
+# {channel_id: OrderedDict{message_id: (author, content)}}, oldest first
+
+def history_content(content: str) -> Optional[str]:
+    """The text kept for AI context, or None for commands and empty messages."""
+    if content.startswith("!"):
+        return None  # skip commands
+    content = content.strip()
+    if not content:
+        return None  # skip empty/whitespace
+    if len(content) > 300:
+        content = content[:297] + "..."  # truncate long messages
+    return content
+
+def record_channel_history(message: discord.Message, bot_user) -> None:
+    """Append a new message to its channel's ring, if the channel has one."""
+    ring = channel_history.get(message.channel.id)
+    if ring is None:
+        return
+    content = history_content(message.content)
+    if content is None:
+        return
+    ring[message.id] = ("bot" if message.author == bot_user else message.author.display_name, content)
+    channel_history.touch(message.channel.id)
+    while len(ring) > CHANNEL_HISTORY_SIZE:
+        ring.popitem(last=False)
+
+def edit_channel_history(channel_id, message_id, content: str) -> None:
+    ring = channel_history.get(channel_id)
+    if ring is None or message_id not in ring:
+        return
+    content = history_content(content)
+    if content is None:
+        del ring[message_id]
+    else:
+        ring[message_id] = (ring[message_id][0], content)
+
+def forget_channel_history(channel_id, message_ids) -> None:
+    ring = channel_history.get(channel_id)
+    if ring is not None:
+        for message_id in message_ids:
+            ring.pop(message_id, None)
+
+async def load_channel_history(channel: discord.TextChannel, bot_user) -> OrderedDict:
+    """Fill a channel's ring from the REST API (newest messages first, stored oldest first).
+
+    A failed fetch returns what was read without caching it, so the next call retries.
     """
-    history = []
+    newest_first = []
     try:
-        async for msg in channel.history(limit=limit, oldest_first=True):
-            if msg.id == current_message.id:
-                continue  # skip current message
-            if msg.content.startswith("!"):
-                continue  # skip commands
-            content = msg.content.strip()
-            if not content:
-                continue  # skip empty/whitespace
-            if len(content) > 300:
-                content = content[:297] + "..."  # truncate long messages
-            author = "bot" if msg.author == bot_user else msg.author.display_name
-            history.append((author, content))
+        async for msg in channel.history(limit=CHANNEL_HISTORY_SIZE):
+            content = history_content(msg.content)
+            if content is not None:
+                newest_first.append((msg.id, ("bot" if msg.author == bot_user else msg.author.display_name, content)))
     except Exception as e:
         logger.error(f"Error fetching channel history: {e}")
+        return OrderedDict(reversed(newest_first))
+    ring = channel_history[channel.id] = OrderedDict(reversed(newest_first))
+    return ring
+
+async def get_recent_channel_history(channel: discord.TextChannel, bot_user: discord.User, current_message: discord.Message,
+                                     limit: int = 20, exclude_ids=None) -> list:
+    """
+    Return the last N messages from a channel (excluding commands),
+    for use as context in AI responses.
+
+    With `exclude_ids`, those messages are left out and the current message is not
+    appended, for callers that put them in the prompt themselves.
+    """
+    ring = channel_history.get(channel.id)
+    if ring is None:
+        ring = await load_channel_history(channel, bot_user)
+    else:
+        channel_history.touch(channel.id)
+    if exclude_ids is not None:
+        return [entry for message_id, entry in ring.items() if message_id not in exclude_ids][-limit:]
+    history = [entry for message_id, entry in ring.items() if message_id != current_message.id][-limit:]
     # Add the current message as the last entry
     content = current_message.content.strip()
     if content:
@@ -247,7 +755,48 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+class MikuBot(commands.Bot):
+    """Bot with one-time startup and shutdown hooks for background services."""
+
+    shutting_down = False
+
+    async def setup_hook(self):
+        # Connect and load settings before logging in; the rest of the persisted state
+        # loads in the background and handlers wait only for the parts they use.
+        await connect_storage()
+        await open_http_session()
+        await load_guild_settings()
+        start_guild_settings_watcher()
+        start_loading_state()
+        start_persistence_flusher()
+        start_welcome_dm_workers()
+        llm_dispatcher.start()
+        self._loop_lag_monitor = asyncio.create_task(monitor_loop_lag())
+        self._ttl_sweeper = asyncio.create_task(sweep_ttl_caches())
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: spawn_background(self.close())
+            )
+        except (NotImplementedError, RuntimeError):
+            pass  # no signal handlers on Windows
+
+    def dispatch(self, event_name, /, *args, **kwargs):
+        # Events arriving during shutdown could mark state after the final save
+        if not self.shutting_down:
+            super().dispatch(event_name, *args, **kwargs)
+
+    async def close(self):
+        # Stop handling events, send the buffered Discord actions while the REST client
+        # is still open, close the gateway, then write out everything left.
+        self.shutting_down = True
+        await moderation_queue.drain()
+        await modlog_buffer.drain()
+        await super().close()
+        await stop_persistence_flusher()
+        await message_store.flush_spill()
+        await close_http_session()
+
+bot = MikuBot(command_prefix='!', intents=intents)
 
 TEMPLATE_CHANNELS = {
     "Duo": {
@@ -286,7 +835,14 @@ AFK_CHANNEL_ID = 1364156990561194075
 
 # AFK detection settings
 AFK_TIMEOUT = 300  # 5 minutes in seconds
-user_voice_activity = {}  # Track when users last spoke/had activity
+def _cancel_afk_task(user_id, activity) -> None:
+    task = activity.get("afk_task")
+    if task is not None and not task.done():
+        task.cancel()
+
+user_voice_activity = TTLCache(  # Track when users last spoke/had activity
+    "user_voice_activity", ttl=12 * 3600, on_evict=_cancel_afk_task
+)
 
 created_channels = {}
 channel_stats = {"total_created": 0, "user_activity": {}}
@@ -294,6 +850,57 @@ channel_stats = {"total_created": 0, "user_activity": {}}
 # Gaming Features
 voice_activity_today = {}  # {guild_id: {user_id: ...}}
 voice_activity_alltime = {}  # {guild_id: {user_id: {"name": str, "total_time": float}}}
+
+# --- Leaderboards ---
+# Top-N boards kept up to date as scores change, so leaderboard commands and the
+# weekly champion never sort every user in the guild.
+class Leaderboard:
+    """Top-N (score, user_id) pairs, highest first.
+
+    Scores only grow between resets, so an update only has to look at the N cached
+    entries. Anything that lowers a score must rebuild() the board instead.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.top = []
+
+    def update(self, user_id, score) -> None:
+        for i, (_, uid) in enumerate(self.top):
+            if uid == user_id:
+                self.top[i] = (score, user_id)
+                break
+        else:
+            if len(self.top) >= self.size and score <= self.top[-1][0]:
+                return
+            self.top.append((score, user_id))
+        self.top.sort(reverse=True)
+        del self.top[self.size:]
+
+    def rebuild(self, scores) -> None:
+        self.top = heapq.nlargest(self.size, ((score, uid) for uid, score in scores.items()))
+
+leaderboards = defaultdict(Leaderboard)  # {(board, guild_id): Leaderboard}
+
+def bump_leaderboard(board, guild_id, user_id, score) -> None:
+    leaderboards[(board, guild_id)].update(user_id, score)
+
+def get_leaderboard(board, guild_id, limit=10) -> list:
+    """Return up to `limit` (user_id, score) pairs, highest first."""
+    board = leaderboards.get((board, guild_id))
+    return [(uid, score) for score, uid in board.top[:limit]] if board else []
+
+def rebuild_leaderboards() -> None:
+    """Recompute every board from the in-memory state (after loading or resets)."""
+    leaderboards.clear()
+    for guild_id, users in voice_activity_alltime.items():
+        leaderboards[("voice_alltime", guild_id)].rebuild(
+            {uid: data.get("total_time", 0) for uid, data in users.items()})
+    for board, weekly in (("voice_weekly", voice_activity_weekly), ("chat_weekly", chat_activity_weekly)):
+        for guild_id, users in weekly.items():
+            leaderboards[(board, guild_id)].rebuild({uid: sum(days) for uid, days in users.items()})
+    leaderboards[("channels_created", None)].rebuild(
+        {uid: data.get("channels_created", 0) for uid, data in channel_stats["user_activity"].items()})
 channel_themes = {
     "🎮": {
         "name": "Gaming",
@@ -325,7 +932,11 @@ ROLE_THRESHOLDS = {
 }
 
 # @everyone tag tracking
-everyone_warnings = {}
+EVERYONE_WARNING_TTL = 7 * 24 * 3600  # a warning is forgotten after a week
+everyone_warnings = GuildTrackers(  # {guild_id: {user_id: warned_at}}
+    "everyone_warnings", ttl=EVERYONE_WARNING_TTL,
+    on_evict=lambda guild_id, user_id, _: mark_dirty("everyone_warnings", guild_id, user_id)
+)
 
 # Vulgar GIFs and Images for Miku responses
 MIKU_GIFS = [
@@ -373,19 +984,30 @@ HREI_GIFS = [
 MENTION_SPAM_THRESHOLD = 3  # mentions
 MENTION_SPAM_WINDOW = 120  # seconds (2 minutes)
 MENTION_TIMEOUT_DURATION = 600  # seconds (10 minutes)
-mention_spam_tracker = defaultdict(lambda: deque(maxlen=MENTION_SPAM_THRESHOLD))
-mention_spam_warnings = {}
+MENTION_WARNING_TTL = 24 * 3600  # seconds before a mention spam warning is forgotten
+mention_spam_tracker = SlidingWindowCounter(  # keyed (guild_id, author_id, target_id)
+    "mention_spam_tracker", window=MENTION_SPAM_WINDOW, capacity=MENTION_SPAM_THRESHOLD
+)
+mention_spam_warnings = TTLCache(
+    "mention_spam_warnings", ttl=MENTION_WARNING_TTL,
+    on_evict=lambda key, _: mark_dirty("mention_spam_warnings", *key)
+)
 
 # Add to the top of the file, after other globals
 active_character_per_channel = defaultdict(lambda: "miku")
 
 # Moderation settings
 MODERATION_LOG_CHANNEL_ID = 1391641782487617696  # Change to your mod log channel
-WARNINGS_DB = {}  # Store user warnings
+WARNINGS_DB = {}  # Store user warnings: {guild_id: {user_id: [warning, ...]}}
 MUTE_ROLE_ID = None  # Set this to your mute role ID
 AUTO_MODERATION = {
     "caps_threshold": 0.7,  # 70% caps triggers warning
     "spam_threshold": 5,  # 5 messages in 10 seconds
+    "mention_threshold": 10,  # distinct <@...> mentions in one message
+    "zalgo_threshold": 0.5,  # combining marks per character
+    "emoji_threshold": 15,  # emoji per message
+    "repeat_threshold": 20,  # longest run of one repeated character
+    "copypasta_users": None,  # distinct users posting near-identical text within COPYPASTA_WINDOW; opt-in per guild
     "link_whitelist": [
         "discord.com", "discord.gg", "youtube.com", "youtu.be", 
         "github.com", "github.io", "gitlab.com", "bitbucket.org",
@@ -454,17 +1076,517 @@ AUTO_MODERATION = {
     ],
 }
 
+# --- Message Rule Matcher ---
+# Banned words and keyword auto-responses are compiled per guild into a single regex,
+# so each message is scanned once no matter how many of them exist; the few regex
+# rules (invite links) get their own search. The compiled matcher is cached and only
+# rebuilt when the guild's rule settings change.
+INVITE_LINK_REGEX = r"(?:discord\.gg|discord(?:app)?\.com/invite)/[\w-]+"
+
+DEFAULT_AUTO_RESPONSES = [
+    {"name": "deadshot", "literal": "deadshot",
+     "reply": "Oi rando, talai muji deadshot sanga love paryo ki kya ho? gay chakka randi berojgar", "gifs": "miku"},
+    {"name": "oj", "literal": "oj", "word": True, "reply": "OJ chakka sanga kura na gar", "gifs": "miku"},
+    {"name": "rei", "literal": "rei",
+     "reply": "I love my darling @Rei. He's so much bigger than my black femboy <3. ", "gifs": "hrei"},
+    {"name": "peak", "literal": "peak", "link": "https://discord.gg/peak", "question": True},
+    {"name": "valorant", "literal": "valorant", "link": "https://discord.gg/valorant", "question": True},
+]
+
+def trie_regex(words) -> str:
+    """Regex matching any of `words`, with shared prefixes factored out (longest match wins).
+
+    A flat a|b|c alternation retries every word at every position; the trie form
+    only follows the branch for the next character.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+class RuleMatcher:
+    """A guild's rules compiled for one scan; match() returns every rule found, highest priority first.
+
+    Rules are either a lowercase "literal" (optionally whole-"word" only) or a "regex".
+    Literals are folded into a trie inside a single lookahead, so one pass tries every
+    start position. A literal hit also counts every literal contained in it, so
+    overlapping rules are never missed. Regex rules are searched separately, so a
+    literal matching at the same position cannot hide them.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        literals = {rule["literal"] for rule in rules if "literal" in rule}
+        self._regex_rules = {id(rule): re.compile(rule["regex"]) for rule in rules if "regex" in rule}
+        self._contained = {lit: {other for other in literals if other in lit} for lit in literals}
+        # \b would never match next to a trigger's non-word characters (e.g. "c++")
+        self._word_patterns = {
+            rule["literal"]: re.compile(rf"(?<!\w){re.escape(rule['literal'])}(?!\w)")
+            for rule in rules if rule.get("word")
+        }
+        self.pattern = re.compile(f"(?=({trie_regex(literals)}))") if literals else None
+
+    def match(self, text) -> list:
+        if self.pattern is None and not self._regex_rules:
+            return []
+        text = text.lower()
+        seen = set()
+        if self.pattern is not None:
+            for m in self.pattern.finditer(text):
+                seen |= self._contained[m.group(1)]
+        found = []
+        for rule in self.rules:
+            if "literal" in rule:
+                literal = rule["literal"]
+                if literal in seen and (not rule.get("word") or self._word_patterns[literal].search(text)):
+                    found.append(rule)
+            elif self._regex_rules[id(rule)].search(text):
+                found.append(rule)
+        return found
+
+def _rule_settings(settings) -> tuple:
+    """The part of a guild's settings that affects its matcher."""
+    return (
+        tuple(settings.get("banned_words", ())),
+        bool(settings.get("block_invites", False)),
+        bool(settings.get("auto_responses", True)),
+        tuple((r["trigger"], r["reply"]) for r in settings.get("custom_responses", ())),
+    )
+
+def build_rule_matcher(settings) -> RuleMatcher:
+    banned_words, block_invites, auto_responses, custom_responses = _rule_settings(settings)
+    rules = [
+        {"kind": "ban", "name": word, "literal": word.lower()}
+        for word in (*AUTO_MODERATION.get("banned_words", ()), *banned_words) if word
+    ]
+    if block_invites:
+        rules.append({"kind": "invite", "name": "invite", "regex": INVITE_LINK_REGEX})
+    rules.extend(
+        {"kind": "response", "name": trigger, "literal": trigger.lower(), "word": True, "reply": reply}
+        for trigger, reply in custom_responses
+    )
+    if auto_responses:
+        rules.extend({"kind": "response", **rule} for rule in DEFAULT_AUTO_RESPONSES)
+    return RuleMatcher(rules)
+
+def cached_for_settings(cache, guild_id, signature, build):
+    """Per-guild object derived from settings; rebuilt only when signature(settings) changes."""
+    settings = get_guild_settings(guild_id)
+    cached = cache.get(guild_id)
+    if cached is not None and cached[0] is settings:
+        return cached[2]
+    key = signature(settings)
+    value = cached[2] if cached is not None and cached[1] == key else build(settings)
+    cache[guild_id] = (settings, key, value)
+    return value
+
+_guild_matchers = {}  # {guild_id: (settings, rule_settings, RuleMatcher)}
+
+def get_rule_matcher(guild_id) -> RuleMatcher:
+    """Return the guild's compiled matcher, rebuilding it only after its rules changed."""
+    return cached_for_settings(_guild_matchers, guild_id, _rule_settings, build_rule_matcher)
+
+# --- Link Filter ---
+# Opt-in per guild ("link_filter"): links whose host is not on the whitelist are removed.
+# The whitelist (AUTO_MODERATION["link_whitelist"] plus/minus per-guild edits) is held
+# in a reversed-label suffix trie, so checking cdn.media.tenor.com costs one dict step
+# per label instead of a scan over every whitelisted domain.
+# The authority stops at a backslash too: browsers read "\" as "/", so in
+# https://evil.com\@tenor.com the host is evil.com.
+URL_HOST_REGEX = re.compile(r"(?:https?://|\bwww\.)([^\s/\\?#<>\"'`|]+)", re.IGNORECASE)
+
+class DomainSuffixTrie:
+    """Set of domains that also matches their subdomains, keyed by labels from the right."""
+
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain) -> None:
+        node = self.root
+        for label in reversed(domain.lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        node[""] = True
+
+    def matches(self, host) -> bool:
+        """True if host is a listed domain or a subdomain of one."""
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if "" in node:
+                return True
+        return False
+
+def extract_link_hosts(text) -> list:
+    """Lowercased hostnames of every http(s):// or www. link in the text."""
+    hosts = []
+    for authority in URL_HOST_REGEX.findall(text):
+        try:
+            host = urlsplit("//" + authority).hostname
+        except ValueError:  # e.g. an unclosed IPv6 bracket
+            host = authority
+        host = (host or "").strip(".").lower()
+        if host:
+            hosts.append(host)
+    return hosts
+
+def _link_settings(settings) -> tuple:
+    return (
+        tuple(settings.get("link_whitelist_add", ())),
+        tuple(settings.get("link_whitelist_remove", ())),
+    )
+
+def build_link_whitelist(settings) -> DomainSuffixTrie:
+    added, removed = _link_settings(settings)
+    removed = set(removed)
+    domains = [d for d in AUTO_MODERATION["link_whitelist"] if d not in removed]
+    return DomainSuffixTrie(domains + list(added))
+
+_guild_link_whitelists = {}  # {guild_id: (settings, link_settings, DomainSuffixTrie)}
+
+def find_blocked_link(guild_id, text) -> Optional[str]:
+    """Return the first linked host that is not whitelisted for the guild, if any."""
+    lowered = text.lower()
+    if "http" not in lowered and "www." not in lowered:
+        return None
+    whitelist = cached_for_settings(_guild_link_whitelists, guild_id, _link_settings, build_link_whitelist)
+    for host in extract_link_hosts(text):
+        if not whitelist.matches(host):
+            return host
+    return None
+
+# --- Message Features ---
+# auto_moderate used to walk every character in Python for the caps check, and each
+# new heuristic would have added another pass. message_features() measures all of
+# them together: ASCII letters are counted on the UTF-8 bytes with bytes.translate
+# deletions, and only the non-ASCII characters (usually few) go through one
+# str.translate that maps each of them to a class marker counted with str.count.
+UPPER_MARK, LOWER_MARK, COMBINING_MARK, EMOJI_MARK = "\x01\x02\x03\x04"
+EMOJI_RANGES = ((0x2600, 0x27BF), (0x1F000, 0x1FAFF))
+ASCII_BYTES = bytes(range(128))
+ASCII_UPPERCASE = string.ascii_uppercase.encode()
+ASCII_LOWERCASE = string.ascii_lowercase.encode()
+REPEATED_CHAR_REGEX = re.compile(r"(.)\1{2,}", re.DOTALL)
+CAPS_MIN_LETTERS = 10
+
+def _build_char_class_table() -> dict:
+    """Map non-ASCII code points to UPPER/LOWER/COMBINING/EMOJI markers."""
+    table = {}
+    for codepoint in range(0x80, 0x10000):
+        char = chr(codepoint)
+        if char.isupper():
+            table[codepoint] = UPPER_MARK
+        elif char.islower():
+            table[codepoint] = LOWER_MARK
+        elif unicodedata.category(char) in ("Mn", "Me"):
+            table[codepoint] = COMBINING_MARK
+    for low, high in EMOJI_RANGES:
+        for codepoint in range(low, high + 1):
+            table[codepoint] = EMOJI_MARK
+    return table
+
+CHAR_CLASS_TABLE = _build_char_class_table()
+
+def message_features(content: str) -> dict:
+    """Compute every auto-moderation feature of a message in one go."""
+    raw = content.encode("utf-8")
+    upper = len(raw) - len(raw.translate(None, ASCII_UPPERCASE))
+    lower = len(raw) - len(raw.translate(None, ASCII_LOWERCASE))
+    combining = emoji = 0
+    if len(raw) != len(content):
+        # Markers are ASCII, so they cannot collide with the untranslated characters
+        shape = raw.translate(None, ASCII_BYTES).decode("utf-8").translate(CHAR_CLASS_TABLE)
+        upper += shape.count(UPPER_MARK)
+        lower += shape.count(LOWER_MARK)
+        combining = shape.count(COMBINING_MARK)
+        emoji = shape.count(EMOJI_MARK)
+    letters = upper + lower
+    return {
+        "length": len(content),
+        "caps": upper / letters if letters > CAPS_MIN_LETTERS else 0.0,
+        "emoji": emoji + content.count("<:") + content.count("<a:"),
+        "repeat": max((m.end() - m.start() for m in REPEATED_CHAR_REGEX.finditer(content)), default=1),
+        "zalgo": combining / len(content) if content else 0.0,
+        "mentions": content.count("<@"),
+    }
+
+# Checked in order; the first feature over its limit wins. Guilds override the
+# AUTO_MODERATION defaults with !automod limit, stored as {feature: limit or None}.
+MESSAGE_FEATURE_RULES = (
+    # (feature, AUTO_MODERATION key, delete message, warning)
+    ("caps", "caps_threshold", False, "please don't use excessive caps!"),
+    ("mentions", "mention_threshold", True, "please don't mass-mention members!"),
+    ("zalgo", "zalgo_threshold", True, "zalgo text is not allowed here!"),
+    ("emoji", "emoji_threshold", False, "please don't spam emoji!"),
+    ("repeat", "repeat_threshold", False, "please don't spam repeated characters!"),
+)
+
+def feature_limits(guild_id) -> dict:
+    """The guild's feature limits; None disables a check."""
+    limits = {feature: AUTO_MODERATION[key] for feature, key, _, _ in MESSAGE_FEATURE_RULES}
+    limits.update(get_guild_settings(guild_id).get("automod_limits", {}))
+    return limits
+
+def exceeded_feature_rule(features: dict, limits: dict):
+    """Return the first rule whose feature is over the guild's limit, if any."""
+    for rule in MESSAGE_FEATURE_RULES:
+        limit = limits.get(rule[0])
+        if limit is not None and features[rule[0]] > limit:
+            return rule
+    return None
+
+# --- Moderation Action Queue ---
+# During a raid every offending message used to cost its own delete, warning and
+# timeout call. Actions are now queued per channel for MODERATION_BATCH_WINDOW seconds
+# and flushed together: bulk delete_messages calls of up to 100 messages, one combined
+# warning message with each distinct line once, and at most one timeout per member.
+# Timeouts with no channel to report in (raid joins) are batched per guild. A guild's flushes run one at a time, so their calls queue behind discord.py's
+# per-route rate-limit buckets instead of racing each other into 429s.
+MODERATION_BATCH_WINDOW = float(os.getenv("MODERATION_BATCH_WINDOW", "1.5"))  # seconds
+
+class ModerationQueue:
+    """Per-channel batches of deletes, warning lines and timeouts."""
+
+    def __init__(self, window):
+        self.window = window
+        # {channel_id or ("guild", guild_id): {"channel", "guild", "deletes": set, "lines": {line: None}, "timeouts": {member_id: ...}}}
+        self._batches = {}
+        self._guild_locks = defaultdict(asyncio.Lock)
+        # {(guild_id, member_id): timeout end}, so a member already being timed out is not timed out again
+        self._timeouts_until = TTLCache("moderation_timeouts", ttl=24 * 3600)
+        self.stats = {"actions": 0, "api_calls": 0, "failed_calls": 0}
+
+    def _batch(self, channel, guild=None) -> dict:
+        self.stats["actions"] += 1
+        key = channel.id if channel is not None else ("guild", guild.id)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = {
+                "channel": channel, "guild": guild or channel.guild, "deletes": set(), "lines": {}, "timeouts": {},
+            }
+            spawn_background(self._flush_later(key))
+        return batch
+
+    def delete(self, channel, message_id) -> None:
+        self._batch(channel)["deletes"].add(message_id)
+
+    def warn(self, channel, line: str) -> None:
+        """Queue a warning line; identical lines in one batch are sent once."""
+        self._batch(channel)["lines"][line] = None
+
+    def timeout(self, channel, member, duration: timedelta, reason: str, notice: Optional[str] = None) -> bool:
+        """Queue a timeout unless the member is already (being) timed out for at least as long.
+
+        `notice` is posted with the channel's warnings once the timeout succeeded; with
+        no channel the timeout is batched per guild. Returns whether it was queued.
+        """
+        until = discord.utils.utcnow() + duration
+        key = (member.guild.id, member.id)
+        current = self._timeouts_until.get(key) or member.timed_out_until
+        if current is not None and current >= until - timedelta(seconds=self.window):
+            return False
+        self._timeouts_until[key] = until
+        self._batch(channel, member.guild)["timeouts"][member.id] = (member, duration, reason, notice)
+        return True
+
+    async def drain(self) -> None:
+        """Flush every pending batch now (on shutdown)."""
+        while self._batches:
+            _, batch = self._batches.popitem()
+            async with self._guild_locks[batch["guild"].id]:
+                await self._flush(batch)
+
+    async def _flush_later(self, key) -> None:
+        await asyncio.sleep(self.window)
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        async with self._guild_locks[batch["guild"].id]:
+            await self._flush(batch)
+
+    async def _call(self, coro) -> bool:
+        self.stats["api_calls"] += 1
+        try:
+            await coro
+            return True
+        except discord.NotFound:
+            return True
+        except discord.HTTPException as e:
+            self.stats["failed_calls"] += 1
+            logger.error(f"Moderation action failed ({e.status}): {e}")
+        return False
+
+    async def _flush(self, batch) -> None:
+        channel = batch["channel"]
+        message_ids = sorted(batch["deletes"])  # only channel batches have deletes
+        for start in range(0, len(message_ids), 100):
+            chunk = [discord.Object(id=message_id) for message_id in message_ids[start:start + 100]]
+            if not await self._call(channel.delete_messages(chunk)) and len(chunk) > 1:
+                # One bad id fails the whole bulk call; fall back to single deletes
+                for message in chunk:
+                    await self._call(channel.get_partial_message(message.id).delete())
+        lines = list(batch["lines"])
+        for member, duration, reason, notice in batch["timeouts"].values():
+            if await self._call(member.timeout(duration, reason=reason)):
+                if notice:
+                    lines.append(notice)
+            else:
+                self._timeouts_until.pop((member.guild.id, member.id), None)
+        if channel is None:
+            return
+        chunk = ""
+        for line in lines:
+            if chunk and len(chunk) + len(line) + 1 > 2000:
+                await self._call(channel.send(chunk))
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line[:2000]
+        if chunk:
+            await self._call(channel.send(chunk))
+
+moderation_queue = ModerationQueue(MODERATION_BATCH_WINDOW)
+
+# --- Copypasta Detection ---
+# Raids often have dozens of accounts post the same text with small changes, which
+# per-user rate limits never see. Each message is reduced to a bottom-k MinHash sketch
+# (the k smallest hashes of its normalized 4-character shingles). Near-identical
+# messages share most of those hashes, so every sketch hash is an index key and a
+# lookup is k dict probes per message, whatever the message rate. Sketches use the
+# process-salted hash(), which is fine because the index only lives in memory.
+# Detection is opt-in per guild (!automod copypasta <users>). The first time a text
+# reaches the guild's user count, the channel is warned; copies posted after that
+# warning are deleted.
+COPYPASTA_WINDOW = int(os.getenv("COPYPASTA_WINDOW", "120"))  # seconds
+COPYPASTA_INDEX_SIZE = int(os.getenv("COPYPASTA_INDEX_SIZE", "8000"))  # sketch hashes per guild
+COPYPASTA_NORMALIZE_REGEX = re.compile(r"[\W_]+")
+COPYPASTA_MIN_LENGTH = 80  # normalized characters; shorter messages are ordinary chatter
+COPYPASTA_MIN_USERS = 3
+COPYPASTA_MAX_LENGTH = 600
+COPYPASTA_SHINGLE = 4
+COPYPASTA_SKETCH_SIZE = 16
+COPYPASTA_MIN_OVERLAP = 10  # shared sketch hashes for two messages to count as copies
+
+def copypasta_sketch(text: str) -> Optional[frozenset]:
+    """Bottom-k MinHash sketch of a message, or None when it is too short to judge."""
+    normalized = COPYPASTA_NORMALIZE_REGEX.sub(" ", text[:COPYPASTA_MAX_LENGTH].casefold()).strip()
+    if len(normalized) < COPYPASTA_MIN_LENGTH:
+        return None
+    shingles = {normalized[i:i + COPYPASTA_SHINGLE] for i in range(len(normalized) - COPYPASTA_SHINGLE + 1)}
+    return frozenset(heapq.nsmallest(COPYPASTA_SKETCH_SIZE, map(hash, shingles)))
+
+class CopypastaDetector:
+    """Groups near-identical messages per guild and reports when enough users post one.
+
+    A cluster is {"sketch", "users": {user_id: last_post}, "flagged"}; it is stored
+    under each of its sketch hashes in a per-guild TTLCache, so idle clusters expire after `window` seconds and the
+    index never holds more than `max_size` hashes per guild.
+    """
+
+    def __init__(self, name, window, max_size):
+        self.window = window
+        self._index = GuildTrackers(name, ttl=window, max_size=max_size)
+
+    def check(self, guild_id, user_id, content, min_users, now=None) -> Optional[dict]:
+        """Record a message; returns its cluster once `min_users` distinct users posted it."""
+        sketch = copypasta_sketch(content)
+        if sketch is None:
+            return None
+        now = time.time() if now is None else now
+        index = self._index[guild_id]
+        cluster = None
+        for value in sketch:
+            candidate = index.get(value)
+            if candidate is not None and len(candidate["sketch"] & sketch) >= COPYPASTA_MIN_OVERLAP:
+                cluster = candidate
+                break
+        if cluster is None:
+            cluster = {"sketch": sketch, "users": {}, "flagged": False}
+        for value in sketch:
+            index[value] = cluster
+        cutoff = now - self.window
+        users = cluster["users"]
+        for stale in [uid for uid, posted in users.items() if posted <= cutoff]:
+            del users[stale]
+        users[user_id] = now
+        return cluster if len(users) >= min_users else None
+
+copypasta_detector = CopypastaDetector("copypasta_index", window=COPYPASTA_WINDOW, max_size=COPYPASTA_INDEX_SIZE)
+
+def handle_copypasta(message: discord.Message, cluster: dict) -> bool:
+    """Warn on a cluster's first flag and delete copies posted after it; True if the message was deleted."""
+    if cluster["flagged"]:
+        moderation_queue.delete(message.channel, message.id)
+        return True
+    cluster["flagged"] = True
+    moderation_queue.warn(
+        message.channel,
+        f"🚨 {len(cluster['users'])} users posted the same message within {COPYPASTA_WINDOW}s; "
+        "further copies will be removed."
+    )
+    return False
+
 # Server statistics
-server_stats = {
-    "messages_today": 0,
-    "commands_used": 0,
-    "users_joined": 0,
-    "users_left": 0
-}
+SERVER_STAT_NAMES = ("messages_today", "commands_used", "users_joined", "users_left")
+server_stats = {}  # {guild_id: {stat: count}}, reset daily
+
+def guild_stats(guild_id) -> dict:
+    """Today's counters for one guild."""
+    stats = server_stats.get(guild_id)
+    if stats is None:
+        stats = server_stats[guild_id] = dict.fromkeys(SERVER_STAT_NAMES, 0)
+    return stats
+
+def bump_stat(guild_id, stat) -> None:
+    guild_stats(guild_id)[stat] += 1
+    mark_dirty("server_stats", guild_id)
 
 # User activity tracking
 user_activity = {}
-message_cooldowns = {}
+message_cooldowns = SlidingWindowCounter(  # keyed (guild_id, user_id)
+    "message_cooldowns", window=10, capacity=AUTO_MODERATION["spam_threshold"] + 1
+)
+
+# --- HTTP Client ---
+# One aiohttp session for the bot's lifetime, opened in setup_hook and closed in
+# close(), so outbound requests reuse pooled keep-alive connections instead of
+# paying a TCP and TLS handshake each. Use it for all outbound HTTP.
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "50"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_KEEPALIVE_TIMEOUT = 60  # seconds an idle connection stays pooled
+HTTP_DNS_CACHE_TTL = 300  # seconds
+HTTP_TIMEOUT = 15  # seconds per request
+http_session = None  # aiohttp.ClientSession
+
+async def open_http_session():
+    """Create the shared session (if needed) and return it."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            enable_cleanup_closed=True,
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return http_session
+
+async def close_http_session() -> None:
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 FIREWORKS_API_KEY = os.getenv("FIREWORKS_API_KEY")
 FIREWORKS_API_URL = "https://api.fireworks.ai/inference/v1/chat/completions"
@@ -495,10 +1617,22 @@ def get_system_prompt_with_timezone_and_duration(guild_id):
         f"\nThe conversation has been going for {str(duration).split('.')[0]}."
     )
 
-async def fetch_llama4_response(prompt: str, user: Optional[discord.Member] = None, history: Optional[list] = None, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> Optional[str]:
-    if not FIREWORKS_API_KEY:
-        logger.error("No FIREWORKS_API_KEY set!")
-        return None
+class LLMRateLimited(Exception):
+    """The LLM API answered 429; retry_after is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited for {retry_after}s")
+        self.retry_after = retry_after
+
+def llm_retry_after(resp) -> float:
+    try:
+        return float(resp.headers.get("Retry-After", LLM_DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return LLM_DEFAULT_RETRY_AFTER
+
+def build_llama4_request(prompt: str, user: Optional[discord.Member] = None, history: Optional[list] = None,
+                         system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> tuple:
+    """Headers and JSON body of a chat completion request."""
     headers = {
         "Authorization": f"Bearer {FIREWORKS_API_KEY}",
         "Content-Type": "application/json"
@@ -523,46 +1657,482 @@ async def fetch_llama4_response(prompt: str, user: Optional[discord.Member] = No
         "model": LLAMA4_MODEL,
         "messages": messages
     }
+    return headers, data
+
+async def fetch_llama4_response(prompt: str, user: Optional[discord.Member] = None, history: Optional[list] = None, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> Optional[str]:
+    if not FIREWORKS_API_KEY:
+        logger.error("No FIREWORKS_API_KEY set!")
+        return None
+    headers, data = build_llama4_request(prompt, user, history, system_prompt)
     try:
-        timeout = aiohttp.ClientTimeout(total=15)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(FIREWORKS_API_URL, headers=headers, json=data) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    if "choices" in result and result["choices"]:
-                        return result["choices"][0]["message"]["content"]
-                    return None
-                else:
-                    logger.error(f"Llama 4 API error: {resp.status} {await resp.text()}")
-                    return None
+        session = await open_http_session()
+        async with session.post(FIREWORKS_API_URL, headers=headers, json=data) as resp:
+            if resp.status == 429:
+                raise LLMRateLimited(llm_retry_after(resp))
+            if resp.status == 200:
+                result = await resp.json()
+                if "choices" in result and result["choices"]:
+                    return result["choices"][0]["message"]["content"]
+                return None
+            else:
+                logger.error(f"Llama 4 API error: {resp.status} {await resp.text()}")
+                return None
+    except LLMRateLimited:
+        raise
     except Exception as e:
         logger.error(f"Llama 4 API exception: {e}")
         return None
 
-@bot.command(name="miku")
-async def miku(ctx, *, prompt: str):
-    """Get an AI response from Miku."""
-    async with ctx.typing():
+# --- Streaming Replies ---
+# With LLM_STREAMING on, AI replies post a placeholder at once and edit it as the
+# server-sent event stream delivers tokens. Edits are at least STREAM_EDIT_INTERVAL
+# seconds apart (Discord allows about five edits per five seconds per channel), and
+# the interval doubles whenever an edit is rate limited. The finished text goes
+# through the caller's finalize step (postprocess_response for !miku) before the
+# last edit, and text beyond 2,000 characters continues in follow-up messages.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = 1.0  # seconds
+STREAM_PLACEHOLDER = "💭 ..."
+STREAM_CURSOR = " ▌"
+DISCORD_MESSAGE_LIMIT = 2000
+
+async def stream_llama4_response(prompt: str, user: Optional[discord.Member] = None, history: Optional[list] = None,
+                                 system_prompt: str = DEFAULT_SYSTEM_PROMPT):
+    """Yield completion text deltas as the SSE stream delivers them."""
+    if not FIREWORKS_API_KEY:
+        logger.error("No FIREWORKS_API_KEY set!")
+        return
+    headers, data = build_llama4_request(prompt, user, history, system_prompt)
+    data["stream"] = True
+    headers["Accept"] = "text/event-stream"
+    session = await open_http_session()
+    # The session's total timeout would cut off long streams; bound the gaps between chunks instead
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+    async with session.post(FIREWORKS_API_URL, headers=headers, json=data, timeout=timeout) as resp:
+        if resp.status == 429:
+            raise LLMRateLimited(llm_retry_after(resp))
+        if resp.status != 200:
+            logger.error(f"Llama 4 API error: {resp.status} {await resp.text()}")
+            return
+        async for line in resp.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                return
+            try:
+                choices = json.loads(payload).get("choices") or [{}]
+            except ValueError:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    """Split text into chunks of at most `limit` characters, preferring line breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+async def reply_with_llm(message: discord.Message, prompt: str, user=None, history=None,
+                         system_prompt: str = DEFAULT_SYSTEM_PROMPT, finalize=None, on_final=None) -> None:
+    """Reply to a message with an AI response, streamed into the reply when LLM_STREAMING is on.
+
+    on_final() is called once the response is complete, before its final text is sent.
+    """
+    if not LLM_STREAMING:
+        text = await fetch_llama4_response(prompt, user=user, history=history, system_prompt=system_prompt)
+        if on_final is not None:
+            on_final()
+        if text and finalize is not None:
+            text = finalize(text)
+        for chunk in split_message(text or "Sorry, I couldn't generate a response."):
+            await message.reply(chunk)
+        return
+    reply = await message.reply(STREAM_PLACEHOLDER)
+    text = ""
+    shown = STREAM_PLACEHOLDER
+    interval = STREAM_EDIT_INTERVAL
+    last_edit = 0.0  # show the first tokens as soon as they arrive
+    try:
+        async for delta in stream_llama4_response(prompt, user=user, history=history, system_prompt=system_prompt):
+            text += delta
+            if time.monotonic() - last_edit < interval:
+                continue
+            preview = text[:DISCORD_MESSAGE_LIMIT - len(STREAM_CURSOR)] + STREAM_CURSOR
+            if preview == shown:
+                continue
+            try:
+                await reply.edit(content=preview)
+                shown = preview
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+                interval *= 2
+            last_edit = time.monotonic()
+    except LLMRateLimited:
+        if not text:
+            await reply.delete()  # the dispatcher retries the whole reply
+            raise
+    except asyncio.CancelledError:
+        # A newer message made this reply stale; the next reply replaces it
         try:
-            history = await get_recent_channel_history(ctx.channel, bot.user, ctx.message, limit=10)
-            system_prompt_for_guild = get_system_prompt_with_timezone_and_duration(ctx.guild.id)
-            ai_response = await fetch_llama4_response(prompt, user=ctx.author, history=history, system_prompt=system_prompt_for_guild)
-            
-            if ai_response and isinstance(ai_response, str):
-                if not hasattr(bot, '_recent_endings'):
-                    bot._recent_endings = []
-                recent_endings = bot._recent_endings[-3:]
-                processed = postprocess_response(ai_response, recent_endings)
-                if processed:
-                    last_words = processed.split()[-5:]
-                    bot._recent_endings.append(" ".join(last_words))
-                await ctx.reply(processed)
+            await reply.delete()
+        except discord.HTTPException:
+            pass
+        raise
+    except Exception as e:
+        logger.error(f"Llama 4 streaming exception: {e}")
+    if on_final is not None:
+        on_final()
+    if text and finalize is not None:
+        text = finalize(text)
+    chunks = split_message(text) or ["Sorry, I couldn't generate a response."]
+    await reply.edit(content=chunks[0])
+    for chunk in chunks[1:]:
+        await message.channel.send(chunk)
+
+# --- LLM Dispatcher ---
+# Every AI reply goes through llm_dispatcher instead of calling the API directly:
+# - at most LLM_MAX_CONCURRENCY requests run at once;
+# - each guild spends tokens from its own bucket (LLM_GUILD_BURST, refilled at
+#   LLM_GUILD_RATE per minute), so one busy guild cannot starve the others;
+# - !miku requests are dispatched before ambient AI-channel/mention chatter;
+# - a newer ambient request with the same merge key (a user's mentions in a channel)
+#   replaces a queued older one (its reply covers the same conversation), requests
+#   older than their lane's staleness limit are dropped instead of answered late,
+#   and a full queue sheds ambient requests;
+# - cancel(key) withdraws a queued request or cancels a running one for that key;
+# - a 429 pauses all dispatch for its Retry-After and requeues the request.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "50"))
+LLM_GUILD_RATE = float(os.getenv("LLM_GUILD_RATE", "12"))  # requests per minute per guild, 0 for no limit
+LLM_GUILD_BURST = int(os.getenv("LLM_GUILD_BURST", "4"))
+LLM_MAX_RETRIES = 2
+LLM_DEFAULT_RETRY_AFTER = 5  # seconds, when a 429 carries no Retry-After
+LLM_PRIORITY_COMMAND = 0
+LLM_PRIORITY_AMBIENT = 1
+LLM_LANE_NAMES = {LLM_PRIORITY_COMMAND: "!miku", LLM_PRIORITY_AMBIENT: "ambient"}
+LLM_STALE_AFTER = {LLM_PRIORITY_COMMAND: 60, LLM_PRIORITY_AMBIENT: 20}  # seconds queued
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled at `rate` tokens per second (a rate of 0 never limits)."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def ready_in(self, now) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+class LLMDispatcher:
+    """Priority queue of AI reply jobs with a global concurrency cap and per-guild token buckets."""
+
+    def __init__(self, max_concurrency, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._pending = []  # request dicts; small enough to scan
+        self._by_key = {}  # {merge key: queued request}
+        self._active = {}  # {merge key: task running its request}
+        self._running = 0
+        self._seq = 0
+        self._cooldown_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self._buckets = TTLCache(
+            "llm_guild_buckets", ttl=3600,
+            default_factory=lambda: TokenBucket(LLM_GUILD_RATE / 60, LLM_GUILD_BURST)
+        )
+        self.stats = {
+            "submitted": 0, "dispatched": 0, "merged": 0, "dropped_stale": 0, "shed": 0,
+            "rate_limited": 0, "failed": 0, "cancelled": 0, "wait_ms_total": 0.0,
+        }
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = spawn_background(self._run())
+
+    def submit(self, guild_id, priority, job, merge_key=None, on_drop=None) -> None:
+        """Queue `job` (an async callable making one AI reply); on_drop() runs if it is shed or goes stale."""
+        self.stats["submitted"] += 1
+        self._seq += 1
+        request = {
+            "guild_id": guild_id, "priority": priority, "job": job, "key": merge_key, "on_drop": on_drop,
+            "seq": self._seq, "queued_at": time.monotonic(), "retries": 0,
+        }
+        if merge_key is not None and merge_key in self._by_key:
+            self._pending.remove(self._by_key.pop(merge_key))
+            self.stats["merged"] += 1
+        if len(self._pending) >= self.max_queue:
+            # Shed the oldest request of the lowest lane, unless that lane outranks the new request
+            victim = max(self._pending, key=lambda r: (r["priority"], -r["seq"]))
+            if victim["priority"] < priority:
+                self._drop(request, "shed")
+                return
+            self._remove(victim)
+            self._drop(victim, "shed")
+        self._enqueue(request)
+
+    def _enqueue(self, request) -> None:
+        self._pending.append(request)
+        if request["key"] is not None:
+            self._by_key[request["key"]] = request
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _remove(self, request) -> None:
+        self._pending.remove(request)
+        if request["key"] is not None and self._by_key.get(request["key"]) is request:
+            del self._by_key[request["key"]]
+
+    def _drop(self, request, reason) -> None:
+        self.stats[reason] += 1
+        if request["on_drop"] is not None:
+            spawn_background(request["on_drop"]())
+
+    def cancel(self, merge_key) -> bool:
+        """Withdraw the queued request and cancel the running one for `merge_key`; True if there was one."""
+        cancelled = False
+        request = self._by_key.get(merge_key)
+        if request is not None:
+            self._remove(request)
+            cancelled = True
+        task = self._active.pop(merge_key, None)
+        if task is not None and not task.done():
+            task.cancel()
+            cancelled = True
+        if cancelled:
+            self.stats["cancelled"] += 1
+        return cancelled
+
+    def finishing(self, merge_key) -> None:
+        """Called by a running job about to send its result; cancel(merge_key) then leaves it alone."""
+        if self._active.get(merge_key) is asyncio.current_task():
+            del self._active[merge_key]
+
+    def queue_depth(self) -> dict:
+        depth = dict.fromkeys(LLM_LANE_NAMES.values(), 0)
+        for request in self._pending:
+            depth[LLM_LANE_NAMES[request["priority"]]] += 1
+        return depth
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def cooldown_remaining(self) -> float:
+        return max(0.0, self._cooldown_until - time.monotonic())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                delay = self._dispatch_ready()
+            except Exception as e:
+                logger.error(f"LLM dispatcher error: {e}")
+                delay = 1.0
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _dispatch_ready(self) -> Optional[float]:
+        """Start every request that may run now; returns seconds until one might become runnable."""
+        now = time.monotonic()
+        for request in [r for r in self._pending if now - r["queued_at"] > LLM_STALE_AFTER[r["priority"]]]:
+            self._remove(request)
+            self._drop(request, "dropped_stale")
+        if now < self._cooldown_until:
+            return self._cooldown_until - now
+        next_delay = None
+        while self._running < self.max_concurrency and self._pending:
+            chosen = None
+            for request in sorted(self._pending, key=lambda r: (r["priority"], r["seq"])):
+                wait = self._buckets[request["guild_id"]].ready_in(now)
+                if wait == 0:
+                    chosen = request
+                    break
+                next_delay = wait if next_delay is None else min(next_delay, wait)
+            if chosen is None:
+                break
+            self._remove(chosen)
+            self._buckets[chosen["guild_id"]].take()
+            self._buckets.touch(chosen["guild_id"])  # an active guild's bucket must not expire and refill
+            self.stats["dispatched"] += 1
+            self.stats["wait_ms_total"] += (now - chosen["queued_at"]) * 1000
+            self._running += 1
+            spawn_background(self._execute(chosen))
+        if self._pending and next_delay is None and self._running < self.max_concurrency:
+            next_delay = 1.0
+        return next_delay
+
+    async def _execute(self, request) -> None:
+        task = asyncio.current_task()
+        if request["key"] is not None:
+            self._active[request["key"]] = task
+        try:
+            await request["job"]()
+        except asyncio.CancelledError:
+            pass  # withdrawn through cancel()
+        except LLMRateLimited as e:
+            self.stats["rate_limited"] += 1
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + e.retry_after)
+            logger.warning(f"LLM API rate limited; pausing dispatch for {e.retry_after:.1f}s")
+            if request["retries"] < LLM_MAX_RETRIES and (request["key"] is None or request["key"] not in self._by_key):
+                request["retries"] += 1
+                request["queued_at"] = time.monotonic()
+                self._enqueue(request)
             else:
-                await ctx.reply("Sorry, I couldn't process that. Please try again.")
+                self._drop(request, "shed")
         except Exception as e:
-            logger.error(f"Error in !miku command: {e}")
-            logger.error(f"Miku command traceback: {traceback.format_exc()}")
-            await ctx.reply("❌ An unexpected error occurred while processing your command.")
+            self.stats["failed"] += 1
+            logger.error(f"LLM request failed: {e}")
+        finally:
+            if self._active.get(request["key"]) is task:
+                del self._active[request["key"]]
+            self._running -= 1
+            self._wakeup.set()
+
+llm_dispatcher = LLMDispatcher(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+# --- AI Channel Batching ---
+# People often type several short lines in a row in the AI channel. Instead of one
+# completion per line, each message restarts a per-channel quiet timer
+# (AI_DEBOUNCE_SECONDS, or the guild's ai_debounce_seconds setting) and the whole
+# batch is answered by one request when it fires. A message that arrives while a
+# reply is still queued or streaming cancels it (the streamed placeholder is
+# deleted), and its messages roll into the next batch. Once a reply's final text is
+# being sent it is no longer cancelled, and its batch counts as answered. Mentions outside the AI
+# channel are answered one by one as before.
+AI_DEBOUNCE_SECONDS = float(os.getenv("AI_DEBOUNCE_SECONDS", "2.0"))
+AI_BATCH_MAX_MESSAGES = 10
+
+class AIChannelBatcher:
+    """Collects AI-channel messages per channel and answers each batch with one LLM request."""
+
+    def __init__(self, max_messages):
+        self.max_messages = max_messages
+        self._unanswered = {}  # {channel_id: [message]}
+        self._timers = {}  # {channel_id: asyncio.TimerHandle}
+        self.stats = {"messages": 0, "batches": 0}
+
+    def add(self, message: discord.Message) -> None:
+        channel_id = message.channel.id
+        unanswered = self._unanswered.setdefault(channel_id, [])
+        unanswered.append(message)
+        del unanswered[:-self.max_messages]
+        self.stats["messages"] += 1
+        llm_dispatcher.cancel(channel_id)
+        timer = self._timers.pop(channel_id, None)
+        if timer is not None:
+            timer.cancel()
+        delay = get_guild_settings(message.guild.id).get("ai_debounce_seconds", AI_DEBOUNCE_SECONDS)
+        self._timers[channel_id] = asyncio.get_running_loop().call_later(delay, self._flush, channel_id)
+
+    def _flush(self, channel_id) -> None:
+        self._timers.pop(channel_id, None)
+        batch = list(self._unanswered.get(channel_id, ()))
+        if not batch:
+            return
+        self.stats["batches"] += 1
+
+        def on_final():
+            llm_dispatcher.finishing(channel_id)
+            self._answered(channel_id, batch)
+
+        async def answer():
+            try:
+                await self._answer(batch, on_final)
+            except (asyncio.CancelledError, LLMRateLimited):
+                raise  # the next batch or the dispatcher's retry still covers these messages
+            except Exception:
+                self._answered(channel_id, batch)
+                raise
+
+        async def dropped():
+            self._answered(channel_id, batch)
+
+        llm_dispatcher.submit(batch[-1].guild.id, LLM_PRIORITY_AMBIENT, answer, merge_key=channel_id, on_drop=dropped)
+
+    async def _answer(self, batch: list, on_final) -> None:
+        message = batch[-1]
+        authors = {m.author.id for m in batch}
+        if len(authors) == 1:
+            prompt = "\n".join(m.content for m in batch)
+            user = message.author
+        else:
+            prompt = "\n".join(f"{m.author.display_name}: {m.content}" for m in batch)
+            user = None
+        # The whole batch is in the prompt, so none of it is repeated in the history
+        history = await get_recent_channel_history(
+            message.channel, bot.user, message, limit=20, exclude_ids={m.id for m in batch}
+        )
+        system_prompt = get_system_prompt_with_timezone_and_duration(message.guild.id)
+        await reply_with_llm(message, prompt, user=user, history=history, system_prompt=system_prompt,
+                             on_final=on_final)
+
+    def _answered(self, channel_id, batch: list) -> None:
+        unanswered = self._unanswered.get(channel_id)
+        if unanswered is None:
+            return
+        answered = {m.id for m in batch}
+        unanswered[:] = [m for m in unanswered if m.id not in answered]
+        if not unanswered:
+            del self._unanswered[channel_id]
+
+ai_batcher = AIChannelBatcher(AI_BATCH_MAX_MESSAGES)
+
+
+@bot.command(name="miku")
+async def miku(ctx, *, prompt: str):
+    """Get an AI response from Miku."""
+    async def answer():
+        async with ctx.typing():
+            try:
+                history = await get_recent_channel_history(ctx.channel, bot.user, ctx.message, limit=10)
+                system_prompt_for_guild = get_system_prompt_with_timezone_and_duration(ctx.guild.id)
+
+                def finalize(ai_response):
+                    if not hasattr(bot, '_recent_endings'):
+                        bot._recent_endings = []
+                    recent_endings = bot._recent_endings[-3:]
+                    processed = postprocess_response(ai_response, recent_endings)
+                    if processed:
+                        last_words = processed.split()[-5:]
+                        bot._recent_endings.append(" ".join(last_words))
+                    return processed
+
+                await reply_with_llm(ctx.message, prompt, user=ctx.author, history=history,
+                                     system_prompt=system_prompt_for_guild, finalize=finalize)
+            except LLMRateLimited:
+                raise
+            except Exception as e:
+                logger.error(f"Error in !miku command: {e}")
+                logger.error(f"Miku command traceback: {traceback.format_exc()}")
+                await ctx.reply("❌ An unexpected error occurred while processing your command.")
+
+    async def busy():
+        await ctx.reply("⏳ Miku is busy right now, please try again in a moment.")
+
+    llm_dispatcher.submit(ctx.guild.id, LLM_PRIORITY_COMMAND, answer, on_drop=busy)
 
 
 
@@ -571,13 +2141,18 @@ async def on_ready():
     if bot.user:
         logger.info(f"✅ Logged in as {bot.user.name}")
     
+    logger.info(f"Bot is in {len(bot.guilds)} guilds")
+
+    # on_ready fires again after every reconnect; everything below must only run once
+    if getattr(bot, '_ready_once', False):
+        return
+    setattr(bot, '_ready_once', True)
+
     # Add persistent views
     bot.add_view(RoleButtonView()) # Add the persistent view for game roles
     
     # Start scheduled tasks
     daily_role_reset.start()
-    
-    logger.info(f"Bot is in {len(bot.guilds)} guilds")
 
     # Ensure bot.loop is set
     if not hasattr(bot, 'loop') or bot.loop is discord.utils.MISSING:
@@ -593,7 +2168,13 @@ async def on_ready():
     if not hasattr(bot, '_recent_endings'):
         setattr(bot, '_recent_endings', [])
     
+    bot.loop.create_task(reset_voice_activity())
+    bot.loop.create_task(reset_daily_stats())
+    bot.loop.create_task(reset_voice_activity_weekly())
+
     # --- NEW: Initialize voice activity for all users currently in voice channels ---
+    # (after the saved state has loaded, so the seeded entries are not overwritten)
+    await wait_for_state("voice_activity")
     for guild in bot.guilds:
         guild_id = guild.id
         if guild_id not in voice_activity_today:
@@ -607,14 +2188,203 @@ async def on_ready():
                         "join_time": discord.utils.utcnow(),  # treat as just joined
                         "total_time": 0
                     }
-    
-    # Load persisted data from MongoDB
-    load_all_data()
-    
-    bot.loop.create_task(heartbeat())
-    bot.loop.create_task(reset_voice_activity())
-    bot.loop.create_task(reset_daily_stats())
-    bot.loop.create_task(reset_voice_activity_weekly())
+                    mark_dirty("voice_activity", guild_id, user_id)
+
+
+# --- Welcome Messages ---
+# Join handling does a constant amount of work: one precompiled regex decides whether
+# the member's name is a greeting, the welcome text is a template filled with
+# str.format, and the welcome DM goes onto a bounded queue drained by background
+# workers, so a slow or closed DM never holds up on_member_join. Guilds can replace
+# the spooky templates with their own through !welcomemsg.
+GREETING_NAME_REGEX = re.compile(r"\b(?:hello|hi|hey|namaste|yo|sup|wassup)\b", re.IGNORECASE)
+WELCOME_TEMPLATE_FIELDS = {"mention": "@member", "name": "member", "server": "server", "count": 100}
+SPOOKY_WELCOME_TEMPLATES = (
+    "Welcome, {mention}! You've entered the haunted server… 👻",
+    "Beware, {mention}! New souls rarely leave… 😈",
+    "You've joined us… forever, {mention}. Mwahaha! 🦇",
+    "Don't look behind you, {mention}. Just kidding… or am I? 😱",
+    "Welcome, {mention}! The ghosts will show you around. Maybe.",
+    "You're just in time for the midnight ritual, {mention}! 🔮",
+    "Hey {mention}, did you hear that noise? Must be the server spirits… 👀",
+    "Welcome, {mention}! We hope you survive your stay… 🪦",
+    "A wild {mention} appeared! The monsters are pleased. 🧟‍♂️",
+    "Welcome, {mention}! Don't feed the vampires after midnight. 🧛‍♂️",
+)
+GREETING_WELCOME_TEMPLATES = (
+    "Well, look at you, {mention}! Your name is a greeting all by itself. Welcome to the server! 🎉",
+    "Hello {mention}! With a name like that, you're already bringing good vibes. Glad to have you!",
+    "Heyyy {mention}! A name that says hello? You're my kind of people. Welcome!",
+    "Yo {mention}! Your username is basically a welcome mat. Come on in!",
+)
+WELCOME_DM_TEXT = (
+    "Hey there! 🎉\n\n"
+    "Welcome to **Miku Server**! We're excited to have you join our community.\n"
+    "Feel free to ask any questions or just say hi—everyone here is super friendly!\n\n"
+    "Enjoy your stay! 💖\n\n"
+    "- MIKU-BOT"
+)
+WELCOME_DM_QUEUE_SIZE = int(os.getenv("WELCOME_DM_QUEUE_SIZE", "500"))
+WELCOME_DM_WORKERS = int(os.getenv("WELCOME_DM_WORKERS", "2"))
+WELCOME_DM_INTERVAL = 1.0  # seconds between DMs per worker; Discord throttles opening many DMs
+WELCOME_DM_BACKOFF = 60  # seconds to pause after being rate limited
+welcome_dm_queue = None  # asyncio.Queue of members, created in setup_hook
+welcome_dm_stats = {"queued": 0, "sent": 0, "dropped": 0, "forbidden": 0, "failed": 0, "rate_limited": 0}
+
+def validate_welcome_template(template: str) -> Optional[str]:
+    """Return an error message if the template cannot be filled, else None."""
+    try:
+        template.format(**WELCOME_TEMPLATE_FIELDS)
+    except (KeyError, IndexError, ValueError) as e:
+        return f"unknown or malformed placeholder {e}"
+    return None
+
+def build_welcome_embed(member) -> discord.Embed:
+    settings = get_guild_settings(member.guild.id)
+    if GREETING_NAME_REGEX.search(member.display_name):
+        templates = GREETING_WELCOME_TEMPLATES
+    else:
+        templates = settings.get("welcome_templates") or SPOOKY_WELCOME_TEMPLATES
+    welcome_text = random.choice(templates).format(
+        mention=member.mention, name=member.display_name, server=member.guild.name, count=member.guild.member_count
+    )
+    embed = discord.Embed(
+        title=settings.get("welcome_title", "🎃 Welcome to the Spooky Server!"),
+        description=welcome_text,
+        color=0x00ff88)
+    embed.set_image(url=random.choice(WELCOME_GIFS))
+    embed.set_thumbnail(url=member.display_avatar.url)
+    embed.set_footer(text=f"Member #{member.guild.member_count}")
+    embed.timestamp = discord.utils.utcnow()
+    return embed
+
+def queue_welcome_dm(member) -> None:
+    """Hand the welcome DM to the workers; dropped (and counted) when the queue is full."""
+    if welcome_dm_queue is None:
+        return
+    try:
+        welcome_dm_queue.put_nowait(member)
+        welcome_dm_stats["queued"] += 1
+    except asyncio.QueueFull:
+        welcome_dm_stats["dropped"] += 1
+
+async def welcome_dm_worker() -> None:
+    while True:
+        member = await welcome_dm_queue.get()
+        try:
+            text = WELCOME_DM_TEXT
+            if WELCOME_GIFS:
+                text = f"{text}\n{random.choice(WELCOME_GIFS)}"
+            await member.send(text)
+            welcome_dm_stats["sent"] += 1
+        except discord.Forbidden:
+            welcome_dm_stats["forbidden"] += 1  # DMs closed; nothing to retry
+        except discord.HTTPException as e:
+            if e.status == 429 or e.code == 40003:  # rate limited / opening DMs too fast
+                welcome_dm_stats["rate_limited"] += 1
+                logger.warning(f"Welcome DMs rate limited; pausing for {WELCOME_DM_BACKOFF}s")
+                await asyncio.sleep(WELCOME_DM_BACKOFF)
+            else:
+                welcome_dm_stats["failed"] += 1
+                logger.error(f"Failed to send welcome DM to {member.display_name}: {e}")
+        except Exception as e:
+            welcome_dm_stats["failed"] += 1
+            logger.error(f"Failed to send welcome DM to {member.display_name}: {e}")
+        finally:
+            welcome_dm_queue.task_done()
+        await asyncio.sleep(WELCOME_DM_INTERVAL)
+
+def start_welcome_dm_workers() -> None:
+    global welcome_dm_queue
+    welcome_dm_queue = asyncio.Queue(maxsize=WELCOME_DM_QUEUE_SIZE)
+    for _ in range(WELCOME_DM_WORKERS):
+        spawn_background(welcome_dm_worker())
+
+
+# --- Raid Mode ---
+# A join burst above the guild's threshold switches it into raid mode: per-member
+# welcomes are replaced by one summary every RAID_SUMMARY_INTERVAL seconds, welcome
+# DMs are skipped, and (opt-in) accounts younger than RAID_NEW_ACCOUNT_DAYS are timed
+# out. Raid mode ends after RAID_QUIET_PERIOD seconds without joins, unless an admin
+# turned it on with !raidmode on.
+RAID_JOIN_THRESHOLD = int(os.getenv("RAID_JOIN_THRESHOLD", "10"))  # joins per RAID_JOIN_WINDOW
+RAID_JOIN_WINDOW = int(os.getenv("RAID_JOIN_WINDOW", "30"))  # seconds
+RAID_QUIET_PERIOD = int(os.getenv("RAID_QUIET_PERIOD", "300"))  # seconds
+RAID_SUMMARY_INTERVAL = int(os.getenv("RAID_SUMMARY_INTERVAL", "60"))  # seconds
+RAID_NEW_ACCOUNT_DAYS = 7
+RAID_TIMEOUT_DURATION = timedelta(hours=1)
+RAID_MAX_THRESHOLD = 500  # join_rate keeps this many joins per guild, so no higher threshold can fire
+join_rate = SlidingWindowCounter("join_rate", window=RAID_JOIN_WINDOW, capacity=RAID_MAX_THRESHOLD)  # keyed guild_id
+raid_state = {}  # {guild_id: {"since", "last_join", "manual", "joins", "pending", "timed_out", "dms_skipped", "task"}}
+
+def raid_join_threshold(guild_id) -> int:
+    return min(get_guild_settings(guild_id).get("raid_join_threshold", RAID_JOIN_THRESHOLD), RAID_MAX_THRESHOLD)
+
+def start_raid_mode(guild, manual=False) -> dict:
+    """Put a guild into raid mode (no-op if it already is) and start its summary task."""
+    state = raid_state.get(guild.id)
+    if state is None:
+        state = raid_state[guild.id] = {
+            "since": discord.utils.utcnow(), "last_join": time.time(), "manual": manual,
+            "joins": 0, "pending": [], "timed_out": 0, "dms_skipped": 0,
+        }
+        logger.warning(f"Raid mode enabled in guild {guild.id} ({'manual' if manual else 'join burst'})")
+        state["task"] = spawn_background(raid_summary_loop(guild))
+    elif manual:
+        state["manual"] = True
+    return state
+
+def welcome_channel_for(guild):
+    channel_id = get_guild_settings(guild.id).get("welcome_channel_id")
+    channel = bot.get_channel(channel_id) if channel_id else None
+    return channel if isinstance(channel, discord.TextChannel) else None
+
+async def send_raid_summary(guild, state, ended=False) -> None:
+    pending, state["pending"] = state["pending"], []
+    channel = welcome_channel_for(guild)
+    if channel is None or not (pending or ended):
+        return
+    embed = discord.Embed(
+        title="🛡️ Raid Mode Lifted" if ended else "🛡️ Raid Mode Active",
+        description=f"**{len(pending)}** members joined since the last update. Welcomes and DMs are paused.",
+        color=0x00ff88 if ended else 0xff1744
+    )
+    if pending:
+        names = ", ".join(pending[:50])
+        embed.add_field(name="New Members", value=names + (f" and {len(pending) - 50} more" if len(pending) > 50 else ""), inline=False)
+    embed.add_field(name="Joins During Raid", value=f"{state['joins']:,}", inline=True)
+    embed.add_field(name="Timed Out", value=f"{state['timed_out']:,}", inline=True)
+    embed.timestamp = discord.utils.utcnow()
+    await channel.send(embed=embed)
+
+async def raid_summary_loop(guild) -> None:
+    """Post periodic join summaries until the guild has been quiet long enough."""
+    while True:
+        await asyncio.sleep(RAID_SUMMARY_INTERVAL)
+        state = raid_state.get(guild.id)
+        if state is None:
+            return
+        ended = not state["manual"] and time.time() - state["last_join"] >= RAID_QUIET_PERIOD
+        try:
+            await send_raid_summary(guild, state, ended=ended)
+        except Exception as e:
+            logger.error(f"Failed to send raid summary for guild {guild.id}: {e}")
+        if ended:
+            raid_state.pop(guild.id, None)
+            logger.info(f"Raid mode lifted in guild {guild.id}")
+            return
+
+async def handle_raid_join(member, state) -> None:
+    """Record a join during raid mode instead of welcoming the member."""
+    state["joins"] += 1
+    state["last_join"] = time.time()
+    state["dms_skipped"] += 1
+    state["pending"].append(member.mention)
+    if not get_guild_settings(member.guild.id).get("raid_timeout_new_accounts"):
+        return
+    if discord.utils.utcnow() - member.created_at < timedelta(days=RAID_NEW_ACCOUNT_DAYS):
+        if moderation_queue.timeout(None, member, RAID_TIMEOUT_DURATION, "Raid mode: new account"):
+            state["timed_out"] += 1
 
 
 @bot.event
@@ -622,154 +2392,430 @@ async def on_member_join(member):
     """Welcome new members to the server"""
     try:
         # Update server stats
-        server_stats["users_joined"] += 1
-        settings = get_guild_settings(member.guild.id)
-        welcome_channel_id = settings.get("welcome_channel_id")
-        welcome_channel = bot.get_channel(welcome_channel_id) if welcome_channel_id else None
+        await wait_for_state("server_stats")
+        bump_stat(member.guild.id, "users_joined")
+        # Join bursts switch the guild into raid mode, which replaces welcomes and DMs
+        if join_rate.hit(member.guild.id) >= raid_join_threshold(member.guild.id):
+            start_raid_mode(member.guild)
+        state = raid_state.get(member.guild.id)
+        if state is not None:
+            await handle_raid_join(member, state)
+            return
+        welcome_channel = welcome_channel_for(member.guild)
         if welcome_channel:
-            # Greeting detection
-            greetings = ["hello", "hi", "hey", "namaste", "yo", "sup", "wassup"]
-            display_name = member.display_name.lower()
-            is_greeting = any(
-                re.search(rf'\b{re.escape(word)}\b', display_name, re.IGNORECASE)
-                for word in greetings
-            )
+            await welcome_channel.send(embed=build_welcome_embed(member), content=f"Welcome {member.mention}!")
+            logger.info(f"Welcomed new member: {member.display_name}")
+            queue_welcome_dm(member)
+    except Exception as e:
+        logger.error(f"Error welcoming member {member.display_name}: {e}")
 
-            # List of funny/scary welcome messages
-            spooky_messages = [
-                f"Welcome, {member.mention}! You've entered the haunted server… 👻",
-                f"Beware, {member.mention}! New souls rarely leave… 😈",
-                f"You've joined us… forever, {member.mention}. Mwahaha! 🦇",
-                f"Don't look behind you, {member.mention}. Just kidding… or am I? 😱",
-                f"Welcome, {member.mention}! The ghosts will show you around. Maybe.",
-                f"You're just in time for the midnight ritual, {member.mention}! 🔮",
-                f"Hey {member.mention}, did you hear that noise? Must be the server spirits… 👀",
-                f"Welcome, {member.mention}! We hope you survive your stay… 🪦",
-                f"A wild {member.mention} appeared! The monsters are pleased. 🧟‍♂️",
-                f"Welcome, {member.mention}! Don't feed the vampires after midnight. 🧛‍♂️"
-            ]
-            greeting_messages = [
-                f"Well, look at you, {member.mention}! Your name is a greeting all by itself. Welcome to the server! 🎉",
-                f"Hello {member.mention}! With a name like that, you're already bringing good vibes. Glad to have you!",
-                f"Heyyy {member.mention}! A name that says hello? You're my kind of people. Welcome!",
-                f"Yo {member.mention}! Your username is basically a welcome mat. Come on in!"
-            ]
-            if is_greeting:
-                welcome_text = random.choice(greeting_messages)
-            else:
-                welcome_text = random.choice(spooky_messages)
 
+# --- Message Content Store ---
+# discord.py only knows the content of messages still in its small message cache, so
+# deletions of older messages used to go unlogged. For guilds with a modlog channel
+# the pipeline records each message's author, content and timestamp in a per-channel
+# ring of MESSAGE_STORE_PER_CHANNEL entries (content capped at 1,000 characters, the
+# modlog field size), with at most MESSAGE_STORE_MAX_CHANNELS channels. Entries pushed
+# out of a ring are dropped, or written to an SQLite file when MESSAGE_SPILL_PATH is
+# set, where they are kept for MESSAGE_SPILL_DAYS. The raw delete/edit events look
+# messages up here.
+MESSAGE_STORE_PER_CHANNEL = int(os.getenv("MESSAGE_STORE_PER_CHANNEL", "500"))
+MESSAGE_STORE_MAX_CHANNELS = int(os.getenv("MESSAGE_STORE_MAX_CHANNELS", "1000"))
+MESSAGE_STORE_TTL = 7 * 24 * 3600  # seconds without messages before a channel's ring is dropped
+MESSAGE_SPILL_PATH = os.getenv("MESSAGE_SPILL_PATH")
+MESSAGE_SPILL_DAYS = int(os.getenv("MESSAGE_SPILL_DAYS", "7"))
+MESSAGE_SPILL_BATCH = 200
+STORED_CONTENT_CHARS = 1000
+
+class MessageSpill:
+    """SQLite overflow for the message store; opened lazily on the storage threads that use it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    @storage_io
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, "
+                    "author_id INTEGER, author_name TEXT, content TEXT, created_at REAL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)")
+                self._schema_ready = True
+        return conn
+
+    def write(self, rows) -> None:
+        """Insert (id, channel_id, author_id, author_name, content, created_at) rows and prune old ones."""
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - MESSAGE_SPILL_DAYS * 86400,))
+
+    def find(self, message_ids) -> dict:
+        """{message_id: (author_id, author_name, content, created_at)} for the ids that were spilled."""
+        ids = list(message_ids)
+        found = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self._conn().execute(
+                f"SELECT id, author_id, author_name, content, created_at FROM messages "
+                f"WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update((row[0], tuple(row[1:])) for row in rows)
+        return found
+
+    def update(self, message_id, content) -> None:
+        with self._conn() as conn:
+            conn.execute("UPDATE messages SET content = ? WHERE id = ?", (content, message_id))
+
+class MessageStore:
+    """Per-channel rings of {message_id: (author_id, author_name, content, created_at)}."""
+
+    def __init__(self, per_channel, max_channels, spill_path=None):
+        self.per_channel = per_channel
+        self._channels = TTLCache("message_store", ttl=MESSAGE_STORE_TTL, max_size=max_channels,
+                                  on_evict=self._spill_channel)
+        self.spill = MessageSpill(spill_path) if spill_path else None
+        self._spill_pending = {}  # {message_id: row} not yet written to the spill file
+
+    def add(self, message) -> None:
+        ring = self._channels.get(message.channel.id)
+        if ring is None:
+            ring = self._channels[message.channel.id] = OrderedDict()
+        else:
+            self._channels.touch(message.channel.id)
+        ring[message.id] = (
+            message.author.id, message.author.display_name,
+            message.content[:STORED_CONTENT_CHARS], message.created_at.timestamp(),
+        )
+        if len(ring) > self.per_channel:
+            message_id, entry = ring.popitem(last=False)
+            self._queue_spill(message.channel.id, message_id, entry)
+
+    def _spill_channel(self, channel_id, ring) -> None:
+        for message_id, entry in ring.items():
+            self._queue_spill(channel_id, message_id, entry)
+
+    def _queue_spill(self, channel_id, message_id, entry) -> None:
+        if self.spill is None:
+            return
+        self._spill_pending[message_id] = (message_id, channel_id, *entry)
+        if len(self._spill_pending) >= MESSAGE_SPILL_BATCH:
+            rows, self._spill_pending = list(self._spill_pending.values()), {}
+            spawn_background(run_storage(self.spill.write, rows))
+
+    async def pop(self, channel_id, message_ids) -> dict:
+        """Remove and return the stored entries of deleted messages, checking the spill file last."""
+        ring = self._channels.get(channel_id, {})
+        found = {}
+        missing = []
+        for message_id in message_ids:
+            entry = ring.pop(message_id, None)
+            if entry is None:
+                row = self._spill_pending.pop(message_id, None)
+                entry = row[2:] if row else None
+            if entry is not None:
+                found[message_id] = entry
+            else:
+                missing.append(message_id)
+        if missing and self.spill is not None:
+            found.update(await run_storage(self.spill.find, missing, executor=storage_read_executor))
+        return found
+
+    async def edit(self, channel_id, message_id, content) -> Optional[tuple]:
+        """Store a message's new content and return its previous entry, if known."""
+        content = content[:STORED_CONTENT_CHARS]
+        ring = self._channels.get(channel_id, {})
+        entry = ring.get(message_id)
+        if entry is not None:
+            ring[message_id] = (*entry[:2], content, entry[3])
+            return entry
+        row = self._spill_pending.get(message_id)
+        if row is not None:
+            self._spill_pending[message_id] = (*row[:4], content, row[5])
+            return row[2:]
+        if self.spill is None:
+            return None
+        entry = (await run_storage(self.spill.find, [message_id], executor=storage_read_executor)).get(message_id)
+        if entry is not None:
+            spawn_background(run_storage(self.spill.update, message_id, content))
+        return entry
+
+    async def flush_spill(self) -> None:
+        """Write the spill rows still short of a full batch (on shutdown)."""
+        if self.spill is None or not self._spill_pending:
+            return
+        rows, self._spill_pending = list(self._spill_pending.values()), {}
+        await run_storage(self.spill.write, rows)
+
+    def memory_bytes(self) -> int:
+        return self._channels.memory_bytes()
+
+message_store = MessageStore(MESSAGE_STORE_PER_CHANNEL, MESSAGE_STORE_MAX_CHANNELS, MESSAGE_SPILL_PATH)
+
+
+# --- Mod Log Buffer ---
+# Modlog events are buffered per guild instead of sent one embed per event. A buffer
+# is flushed MODLOG_FLUSH_INTERVAL seconds after its first event, or as soon as it
+# holds a full message of embeds, and is packed into messages of up to 10 embeds
+# (within Discord's 6,000 character total). When a guild logs more than
+# MODLOG_DIGEST_RATE events per window, e.g. during a purge or a raid, events are
+# sent as one-line entries in compact digest embeds instead.
+MODLOG_FLUSH_INTERVAL = float(os.getenv("MODLOG_FLUSH_INTERVAL", "2"))  # seconds
+MODLOG_DIGEST_RATE = int(os.getenv("MODLOG_DIGEST_RATE", "20"))  # events per MODLOG_RATE_WINDOW
+MODLOG_RATE_WINDOW = 10  # seconds
+MODLOG_EMBEDS_PER_MESSAGE = 10
+MODLOG_MESSAGE_CHARS = 6000
+MODLOG_DIGEST_CHARS = 4000
+
+def modlog_channel_for(guild_id):
+    channel_id = get_guild_settings(guild_id).get("modlog_channel_id")
+    channel = bot.get_channel(channel_id) if channel_id else None
+    return channel if isinstance(channel, discord.TextChannel) else None
+
+def truncate(text: str, limit: int) -> str:
+    return text[:limit] + "..." if len(text) > limit else text
+
+class ModlogBuffer:
+    """Per-guild buffer of (embed, one-line summary) modlog events."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}  # {guild_id: [(embed, summary)]}
+        self._scheduled = set()  # guild ids with a timed flush pending
+        self._locks = defaultdict(asyncio.Lock)
+        self._rate = SlidingWindowCounter("modlog_rate", window=MODLOG_RATE_WINDOW, capacity=MODLOG_DIGEST_RATE + 1)
+        self.stats = {"events": 0, "messages": 0, "digests": 0}
+
+    def log(self, guild_id, embed: discord.Embed, summary: str) -> None:
+        if modlog_channel_for(guild_id) is None:
+            return
+        self.stats["events"] += 1
+        pending = self._pending.setdefault(guild_id, [])
+        pending.append((embed, summary))
+        under_load = self._rate.hit(guild_id) > MODLOG_DIGEST_RATE
+        if len(pending) >= MODLOG_EMBEDS_PER_MESSAGE and not under_load:
+            spawn_background(self.flush(guild_id))
+        elif guild_id not in self._scheduled:
+            self._scheduled.add(guild_id)
+            spawn_background(self._flush_later(guild_id))
+
+    async def _flush_later(self, guild_id) -> None:
+        await asyncio.sleep(self.interval)
+        self._scheduled.discard(guild_id)
+        await self.flush(guild_id)
+
+    async def drain(self) -> None:
+        """Flush every guild's pending events now (on shutdown)."""
+        for guild_id in list(self._pending):
+            await self.flush(guild_id)
+
+    async def flush(self, guild_id) -> None:
+        async with self._locks[guild_id]:
+            events = self._pending.pop(guild_id, None)
+            channel = modlog_channel_for(guild_id)
+            if not events or channel is None:
+                return
+            if self._rate.count(guild_id) > MODLOG_DIGEST_RATE:
+                batches = [[embed] for embed in self._digest_embeds(events)]
+            else:
+                batches = self._pack([embed for embed, _ in events])
+            for embeds in batches:
+                try:
+                    await channel.send(embeds=embeds)
+                    self.stats["messages"] += 1
+                except Exception as e:
+                    logger.error(f"Failed to send modlog for guild {guild_id}: {e}")
+
+    @staticmethod
+    def _pack(embeds) -> list:
+        """Group embeds into messages of at most 10 embeds and 6,000 characters."""
+        batches, batch, size = [], [], 0
+        for embed in embeds:
+            length = len(embed)
+            if batch and (len(batch) >= MODLOG_EMBEDS_PER_MESSAGE or size + length > MODLOG_MESSAGE_CHARS):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(embed)
+            size += length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _digest_embeds(self, events) -> list:
+        embeds, lines, size = [], [], 0
+        for _, summary in events:
+            if lines and size + len(summary) + 1 > MODLOG_DIGEST_CHARS:
+                embeds.append(lines)
+                lines, size = [], 0
+            lines.append(summary)
+            size += len(summary) + 1
+        embeds.append(lines)
+        self.stats["digests"] += len(embeds)
+        digest = []
+        for part, lines in enumerate(embeds, 1):
             embed = discord.Embed(
-                title="🎃 Welcome to the Spooky Server!",
-                description=welcome_text,
-                color=0x00ff88)
-            gif_url = random.choice(WELCOME_GIFS)
-            embed.set_image(url=gif_url)
-            embed.set_thumbnail(url=member.display_avatar.url)
-            embed.set_footer(text=f"Member #{member.guild.member_count}")
+                title=f"🧾 Mod Log Digest ({len(events)} events)" + (f" • {part}/{len(embeds)}" if len(embeds) > 1 else ""),
+                description="\n".join(lines),
+                color=0xffaa00
+            )
             embed.timestamp = discord.utils.utcnow()
+            digest.append(embed)
+        return digest
 
-            if isinstance(welcome_channel, discord.TextChannel):
-                await welcome_channel.send(embed=embed, content=f"Welcome {member.mention}!")
-            logger.info(f"Welcomed new member: {member.display_name}")
-            # Send a DM to the new member
-            try:
-                welcome_text = (
-                    "Hey there! 🎉\n\n"
-                    "Welcome to **Miku Server**! We're excited to have you join our community.\n"
-                    "Feel free to ask any questions or just say hi—everyone here is super friendly!\n\n"
-                    "Enjoy your stay! 💖\n\n"
-                    "- MIKU-BOT"
-                )
-                # Debug log for GIF selection
-                if WELCOME_GIFS:
-                    gif_url = random.choice(WELCOME_GIFS)
-                    logger.info(f"Selected welcome GIF for DM: {gif_url}")
-                else:
-                    gif_url = None
-                    logger.warning("WELCOME_GIFS list is empty! No GIF will be sent in DM.")
-                await member.send(welcome_text)
-                if gif_url:
-                    await member.send(gif_url)
-            except Exception as e:
-                logger.error(f"Failed to send welcome DM to {member.display_name}: {e}")
-    except Exception as e:
-        logger.error(f"Error welcoming member {member.display_name}: {e}")
+modlog_buffer = ModlogBuffer(MODLOG_FLUSH_INTERVAL)
 
 
 @bot.event
 async def on_member_remove(member):
     """Handle member leaving"""
     try:
-        server_stats["users_left"] += 1
-        settings = get_guild_settings(member.guild.id)
-        modlog_channel_id = settings.get("modlog_channel_id")
-        mod_channel = bot.get_channel(modlog_channel_id) if modlog_channel_id else None
-        if mod_channel:
-            embed = discord.Embed(
-                title="👋 Member Left",
-                description=f"{member.display_name} has left the server",
-                color=0xffaa00
-            )
-            embed.add_field(name="Account Created", value=discord.utils.format_dt(member.created_at, style='D'), inline=True)
-            joined_value = discord.utils.format_dt(member.joined_at, style='D') if member.joined_at else "Unknown"
-            embed.add_field(name="Joined", value=joined_value, inline=True)
-            embed.set_thumbnail(url=member.display_avatar.url)
-            embed.timestamp = discord.utils.utcnow()
-            if isinstance(mod_channel, discord.TextChannel):
-                await mod_channel.send(embed=embed)
+        await wait_for_state("server_stats")
+        bump_stat(member.guild.id, "users_left")
+        embed = discord.Embed(
+            title="👋 Member Left",
+            description=f"{member.display_name} has left the server",
+            color=0xffaa00
+        )
+        embed.add_field(name="Account Created", value=discord.utils.format_dt(member.created_at, style='D'), inline=True)
+        joined_value = discord.utils.format_dt(member.joined_at, style='D') if member.joined_at else "Unknown"
+        embed.add_field(name="Joined", value=joined_value, inline=True)
+        embed.set_thumbnail(url=member.display_avatar.url)
+        embed.timestamp = discord.utils.utcnow()
+        modlog_buffer.log(member.guild.id, embed, f"👋 **{member.display_name}** left")
     except Exception as e:
         logger.error(f"Error handling member leave: {e}")
 
 
 @bot.event
-async def on_message_delete(message):
-    """Handle message deletion"""
+async def on_raw_message_delete(payload):
+    """Log message deletions, including messages discord.py no longer has cached"""
     try:
-        if message.guild is None:
+        forget_channel_history(payload.channel_id, [payload.message_id])
+        if payload.guild_id is None or modlog_channel_for(payload.guild_id) is None:
             return
-        settings = get_guild_settings(message.guild.id)
-        modlog_channel_id = settings.get("modlog_channel_id")
-        mod_channel = bot.get_channel(modlog_channel_id) if modlog_channel_id else None
-        if mod_channel and not message.author.bot:
-            embed = discord.Embed(
-                title="🗑️ Message Deleted",
-                description=f"**Channel:** {message.channel.mention}\n**Author:** {message.author.mention}",
-                color=0xff0000
-            )
-            embed.add_field(name="Content", value=message.content[:1000] + "..." if len(message.content) > 1000 else message.content, inline=False)
+        stored = await message_store.pop(payload.channel_id, [payload.message_id])
+        message = payload.cached_message
+        if message is not None:
+            if message.author.bot:
+                return
+            author_id, content, created_at = message.author.id, message.content, message.created_at.timestamp()
+        elif payload.message_id in stored:
+            author_id, _, content, created_at = stored[payload.message_id]
+        else:
+            return  # sent before the bot started tracking the channel, or by a bot
+        embed = discord.Embed(
+            title="🗑️ Message Deleted",
+            description=f"**Channel:** <#{payload.channel_id}>\n**Author:** <@{author_id}>\n"
+                        f"**Sent:** <t:{int(created_at)}:R>",
+            color=0xff0000
+        )
+        embed.add_field(name="Content", value=truncate(content, 1000) or "No text content", inline=False)
+        if message is not None:
             embed.set_thumbnail(url=message.author.display_avatar.url)
-            embed.timestamp = discord.utils.utcnow()
-            if isinstance(mod_channel, discord.TextChannel):
-                await mod_channel.send(embed=embed)
+        embed.timestamp = discord.utils.utcnow()
+        modlog_buffer.log(
+            payload.guild_id, embed, f"🗑️ <#{payload.channel_id}> <@{author_id}>: {truncate(content, 80)}"
+        )
     except Exception as e:
         logger.error(f"Error handling message deletion: {e}")
 
 
 @bot.event
-async def on_message_edit(before, after):
-    """Handle message edits"""
+async def on_raw_bulk_message_delete(payload):
+    """Log a purge as a single entry"""
+    try:
+        forget_channel_history(payload.channel_id, payload.message_ids)
+        if payload.guild_id is None or modlog_channel_for(payload.guild_id) is None:
+            return
+        cached = {message.id: message for message in payload.cached_messages}
+        stored = await message_store.pop(payload.channel_id, payload.message_ids)
+        recovered = []  # (author_id, author_name, content), oldest first
+        for message_id in sorted(payload.message_ids):
+            message = cached.get(message_id)
+            if message is not None:
+                recovered.append((message.author.id, message.author.display_name, message.content))
+            elif message_id in stored:
+                recovered.append(stored[message_id][:3])
+        authors = defaultdict(int)
+        for author_id, _, _ in recovered:
+            authors[author_id] += 1
+        embed = discord.Embed(
+            title="🧹 Messages Purged",
+            description=f"**Channel:** <#{payload.channel_id}>\n**Messages:** {len(payload.message_ids)} "
+                        f"({len(recovered)} with known content)",
+            color=0xff0000
+        )
+        embed.add_field(
+            name="Authors",
+            value=truncate(", ".join(f"<@{author_id}> ({count})" for author_id, count in authors.items()), 1000)
+                  or "Unknown",
+            inline=False
+        )
+        embed.add_field(
+            name="Latest Messages",
+            value=truncate("\n".join(
+                f"{name}: {truncate(content, 60)}" for _, name, content in recovered[-10:] if content
+            ), 1000) or "No text content",
+            inline=False
+        )
+        embed.timestamp = discord.utils.utcnow()
+        modlog_buffer.log(
+            payload.guild_id, embed, f"🧹 <#{payload.channel_id}>: {len(payload.message_ids)} messages purged"
+        )
+    except Exception as e:
+        logger.error(f"Error handling bulk message deletion: {e}")
+
+
+@bot.event
+async def on_raw_message_edit(payload):
+    """Log message edits, including edits of messages discord.py no longer has cached"""
     try:
-        # Ignore bot messages and if content didn't change
-        if before.author.bot or before.content == after.content:
+        data = payload.data
+        content = data.get("content")
+        if content is not None:
+            edit_channel_history(payload.channel_id, payload.message_id, content)
+        # Embed-only updates carry no content; ignore bot messages
+        if payload.guild_id is None or content is None or data.get("author", {}).get("bot"):
             return
-        if before.guild is None:
+        if modlog_channel_for(payload.guild_id) is None:
             return
-        settings = get_guild_settings(before.guild.id)
-        modlog_channel_id = settings.get("modlog_channel_id")
-        mod_channel = bot.get_channel(modlog_channel_id) if modlog_channel_id else None
-        if mod_channel:
-            embed = discord.Embed(
-                title="✏️ Message Edited",
-                description=f"**Channel:** {before.channel.mention}\n**Author:** {before.author.mention}",
-                color=0xffaa00
-            )
-            embed.add_field(name="Before", value=before.content[:500] + "..." if len(before.content) > 500 else before.content, inline=False)
-            embed.add_field(name="After", value=after.content[:500] + "..." if len(after.content) > 500 else after.content, inline=False)
-            embed.add_field(name="Link", value=f"[Jump to Message]({after.jump_url})", inline=False)
+        previous = await message_store.edit(payload.channel_id, payload.message_id, content)
+        before = payload.cached_message
+        if before is not None:
+            before_content = before.content
+        elif previous is not None:
+            before_content = previous[2]
+        else:
+            return
+        if before_content == content:
+            return
+        author_id = data.get("author", {}).get("id") or (before.author.id if before else previous[0])
+        jump_url = f"https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/{payload.message_id}"
+        embed = discord.Embed(
+            title="✏️ Message Edited",
+            description=f"**Channel:** <#{payload.channel_id}>\n**Author:** <@{author_id}>",
+            color=0xffaa00
+        )
+        embed.add_field(name="Before", value=truncate(before_content, 500) or "No text content", inline=False)
+        embed.add_field(name="After", value=truncate(content, 500) or "No text content", inline=False)
+        embed.add_field(name="Link", value=f"[Jump to Message]({jump_url})", inline=False)
+        if before is not None:
             embed.set_thumbnail(url=before.author.display_avatar.url)
-            embed.timestamp = discord.utils.utcnow()
-            await mod_channel.send(embed=embed)
+        embed.timestamp = discord.utils.utcnow()
+        modlog_buffer.log(
+            payload.guild_id, embed,
+            f"✏️ <#{payload.channel_id}> <@{author_id}>: {truncate(content, 80)} ([jump]({jump_url}))"
+        )
     except Exception as e:
         logger.error(f"Error handling message edit: {e}")
 
@@ -803,6 +2849,8 @@ async def on_command_error(ctx, error):
 @bot.event
 async def on_voice_state_update(member, before, after):
     try:
+        await wait_for_state("voice_activity", "voice_activity_alltime", "voice_activity_weekly",
+                             "created_channels", "channel_stats")
         guild_id = member.guild.id
         user_id = str(member.id)
         if guild_id not in voice_activity_today:
@@ -821,6 +2869,9 @@ async def on_voice_state_update(member, before, after):
                 "total_time": 0
             }
 
+        mark_dirty("voice_activity", guild_id, user_id)
+        mark_dirty("voice_activity_alltime", guild_id, user_id)
+
         # User joined a voice channel
         if after.channel and not before.channel:
             # Only set join_time if not self-deafened, not self-muted, and not in AFK channel
@@ -850,6 +2901,8 @@ async def on_voice_state_update(member, before, after):
                 # --- Alltime update ---
                 voice_activity_alltime[guild_id][user_id]["total_time"] += time_spent
                 voice_activity_alltime[guild_id][user_id]["name"] = member.display_name
+                bump_leaderboard("voice_alltime", guild_id, user_id,
+                                 voice_activity_alltime[guild_id][user_id]["total_time"])
                 update_weekly_voice_time(guild_id, user_id, time_spent)
             # Reset join_time if still in a channel and not self-deafened, not self-muted, and not in AFK channel
             if after.channel and not after.self_deaf and not after.self_mute and (not afk_channel_id or after.channel.id != afk_channel_id):
@@ -901,6 +2954,7 @@ async def on_voice_state_update(member, before, after):
                             user_limit=info["limit"],
                             category=after.channel.category)
                         created_channels[new_vc.id] = True
+                        mark_dirty("created_channels", new_vc.id)
                         await member.move_to(new_vc)
                         channel_stats["total_created"] += 1
                         if user_id not in channel_stats["user_activity"]:
@@ -910,6 +2964,9 @@ async def on_voice_state_update(member, before, after):
                             }
                         channel_stats["user_activity"][user_id][
                             "channels_created"] += 1
+                        mark_dirty("channel_stats", user_id)
+                        bump_leaderboard("channels_created", None, user_id,
+                                         channel_stats["user_activity"][user_id]["channels_created"])
                         await check_and_assign_roles(
                             member, channel_stats["user_activity"][user_id]
                             ["channels_created"])
@@ -951,23 +3008,23 @@ async def on_voice_state_update(member, before, after):
                     await channel.delete()
                     if before.channel.id in created_channels:
                         del created_channels[before.channel.id]
+                        mark_dirty("created_channels", before.channel.id)
                     logger.info(f"Deleted empty channel: {channel.name}")
             except discord.NotFound:
                 if before.channel.id in created_channels:
                     del created_channels[before.channel.id]
+                    mark_dirty("created_channels", before.channel.id)
             except discord.Forbidden:
                 logger.error("Bot forbidden to delete channel")
             except discord.HTTPException as e:
                 logger.error(f"HTTP error deleting channel: {e}")
 
-        save_all_data()
-
     except Exception as e:
         logger.error(f"Unexpected error in voice state update: {e}")
 
 
 # --- Auto-moderation function ---
-async def auto_moderate(message: discord.Message):
+async def auto_moderate(message: discord.Message, matches=None):
     """Auto-moderation checks for messages"""
     try:
         # Skip if user has manage messages permission
@@ -975,170 +3032,267 @@ async def auto_moderate(message: discord.Message):
             return
         content = message.content
         user_id = str(message.author.id)
-        # Caps check
-        if len(content) > 10:
-            caps_count = sum(1 for c in content if c.isupper())
-            caps_ratio = caps_count / len(content)
-            if caps_ratio > AUTO_MODERATION["caps_threshold"]:
-                await message.channel.send(f"⚠️ {message.author.mention}, please don't use excessive caps!")
+        # Caps, mass mentions, zalgo, emoji and repeated characters
+        rule = exceeded_feature_rule(message_features(content), feature_limits(message.guild.id))
+        if rule:
+            _, _, delete, warning = rule
+            if delete:
+                moderation_queue.delete(message.channel, message.id)
+            moderation_queue.warn(message.channel, f"⚠️ {message.author.mention}, {warning}")
+            return
+        # Banned words and invite links (one scan for all of the guild's rules)
+        if matches is None:
+            matches = get_rule_matcher(message.guild.id).match(content)
+        for rule in matches:
+            if rule["kind"] == "ban":
+                moderation_queue.delete(message.channel, message.id)
+                moderation_queue.warn(message.channel, f"🚫 {message.author.mention}, that word is not allowed!")
+                return
+            if rule["kind"] == "invite":
+                moderation_queue.delete(message.channel, message.id)
+                moderation_queue.warn(message.channel, f"🚫 {message.author.mention}, server invites are not allowed here!")
+                return
+        # Near-identical messages from several users (copypasta raids)
+        settings = get_guild_settings(message.guild.id)
+        copypasta_users = settings.get("copypasta_users", AUTO_MODERATION["copypasta_users"])
+        if copypasta_users:
+            cluster = copypasta_detector.check(message.guild.id, user_id, content, copypasta_users)
+            if cluster and handle_copypasta(message, cluster):
                 return
-        # Banned words check
-        content_lower = content.lower()
-        for word in AUTO_MODERATION.get("banned_words", []):
-            if word in content_lower:
-                await message.delete()
-                await message.channel.send(f"🚫 {message.author.mention}, that word is not allowed!")
+        # Link whitelist (opt-in per guild)
+        if settings.get("link_filter"):
+            blocked_host = find_blocked_link(message.guild.id, content)
+            if blocked_host:
+                moderation_queue.delete(message.channel, message.id)
+                moderation_queue.warn(message.channel, f"🔗 {message.author.mention}, links to `{blocked_host}` are not allowed here!")
                 return
         # Spam detection
-        now = time.time()
-        if user_id not in message_cooldowns:
-            message_cooldowns[user_id] = []
-        message_cooldowns[user_id].append(now)
-        # Remove old messages (older than 10 seconds)
-        message_cooldowns[user_id] = [t for t in message_cooldowns[user_id] if now - t < 10]
-        if len(message_cooldowns[user_id]) > AUTO_MODERATION["spam_threshold"]:
-            await message.channel.send(f"⚠️ {message.author.mention}, please slow down your messages!")
+        recent = message_cooldowns.hit((message.guild.id, user_id))
+        if recent > AUTO_MODERATION["spam_threshold"]:
+            moderation_queue.warn(message.channel, f"⚠️ {message.author.mention}, please slow down your messages!")
             return
     except Exception as e:
         logger.error(f"Error in auto-moderation: {e}")
 
 
-@bot.event
-async def on_message(message):
-    try:
-        if message.author == bot.user:
-            return
-
-        if isinstance(message.channel, discord.DMChannel):
-            await handle_dm_reply(message)
-            return
-
-        settings = get_guild_settings(message.guild.id)
-        ai_channel_id = settings.get("ai_channel_id")
-
-        # AI response in designated channel or when mentioned
-        is_ai_channel = ai_channel_id and message.channel.id == ai_channel_id
-        is_mention = bot.user is not None and bot.user.mentioned_in(message) and not message.mention_everyone
-
-        if (is_ai_channel or is_mention) and not message.content.startswith('!'):
-            history = await get_recent_channel_history(message.channel, bot.user, message, limit=20)
-            system_prompt = get_system_prompt_with_timezone_and_duration(message.guild.id)
-            ai_response = await fetch_llama4_response(message.content, user=message.author, history=history, system_prompt=system_prompt)
-            if ai_response:
-                await message.reply(ai_response)
-            else:
-                await message.reply("Sorry, I couldn't generate a response.")
-            return
-
-        # Keyword auto-responses (before process_commands so they fire on non-command messages)
-        message_lower = message.content.lower()
-
-        if 'deadshot' in message_lower:
-            response = "Oi rando, talai muji deadshot sanga love paryo ki kya ho? gay chakka randi berojgar"
-            gif_url = random.choice(MIKU_GIFS)
-            embed = discord.Embed(description=response, color=0xff1744)
-            embed.set_image(url=gif_url)
-            await message.reply(embed=embed)
+# --- Message Pipeline ---
+# on_message runs a list of registered stages in order. Each stage has a cheap
+# precondition (so bot messages and commands skip the stages that do not apply to
+# them) and may return True to stop the pipeline. Every stage's latency goes into
+# a histogram shown by !pipelinestats.
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+MESSAGE_STAGES = []   # [{"name", "when", "run"}] in execution order
+pipeline_stats = {}   # {stage name: {"runs", "skipped", "stopped", "errors", "total_ms", "max_ms", "buckets"}}
+
+class MessageContext:
+    """Facts about one message shared by all stages; the rule scan runs at most once."""
+
+    def __init__(self, message):
+        self.message = message
+        self.is_dm = isinstance(message.channel, discord.DMChannel)
+        self.settings = {} if self.is_dm else get_guild_settings(message.guild.id)
+        self.is_bot = message.author.bot
+        self.is_command = message.content.startswith('!')
+        ai_channel_id = self.settings.get("ai_channel_id")
+        self.is_ai_channel = bool(ai_channel_id) and message.channel.id == ai_channel_id
+        self._matches = None
+
+    @property
+    def matches(self) -> list:
+        if self._matches is None:
+            self._matches = get_rule_matcher(self.message.guild.id).match(self.message.content)
+        return self._matches
+
+def message_stage(name, when=lambda ctx: True):
+    """Register a pipeline stage; stages run in the order they are defined."""
+    def decorator(func):
+        MESSAGE_STAGES.append({"name": name, "when": when, "run": func})
+        pipeline_stats[name] = {
+            "runs": 0, "skipped": 0, "stopped": 0, "errors": 0,
+            "total_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        }
+        return func
+    return decorator
+
+def record_stage_latency(stats, elapsed_ms) -> None:
+    stats["runs"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    stats["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+def latency_percentile(stats, fraction) -> str:
+    """Upper bound of the histogram bucket holding the given fraction of runs."""
+    target = stats["runs"] * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, stats["buckets"]):
+        seen += count
+        if seen >= target:
+            return f"≤{bound:g}ms"
+    return f">{LATENCY_BUCKETS_MS[-1]:g}ms"
+
+async def run_message_pipeline(ctx: MessageContext) -> None:
+    for stage in MESSAGE_STAGES:
+        stats = pipeline_stats[stage["name"]]
+        if not stage["when"](ctx):
+            stats["skipped"] += 1
+            continue
+        start = time.perf_counter()
+        try:
+            stop = await stage["run"](ctx)
+        except Exception as e:
+            stop = False
+            stats["errors"] += 1
+            logger.error(f"Error in message stage {stage['name']}: {e}")
+            logger.error(f"Full traceback: {traceback.format_exc()}")
+        record_stage_latency(stats, (time.perf_counter() - start) * 1000)
+        if stop:
+            stats["stopped"] += 1
             return
 
-        if re.search(r'\boj\b', message_lower) or re.search(r'\bOJ\b', message.content):
-            response = "OJ chakka sanga kura na gar"
-            gif_url = random.choice(MIKU_GIFS)
-            embed = discord.Embed(description=response, color=0xff1744)
-            embed.set_image(url=gif_url)
-            await message.reply(embed=embed)
-            return
 
-        if 'rei' in message_lower:
-            response = "I love my darling @Rei. He's so much bigger than my black femboy <3. "
-            gif_url = random.choice(HREI_GIFS)
-            embed = discord.Embed(description=response, color=0xff1744)
-            embed.set_image(url=gif_url)
+@message_stage("dm_reply", when=lambda ctx: ctx.is_dm)
+async def dm_reply_stage(ctx):
+    await handle_dm_reply(ctx.message)
+    return True
+
+@message_stage("message_store", when=lambda ctx: (
+    not ctx.is_dm and not ctx.is_bot and ctx.settings.get("modlog_channel_id") is not None
+))
+async def message_store_stage(ctx):
+    # Keep content for the modlog of deletions discord.py has no cache entry for
+    message_store.add(ctx.message)
+    return False
+
+@message_stage("ai_chat", when=lambda ctx: not ctx.is_bot and not ctx.is_command and (
+    ctx.is_ai_channel
+    or (bot.user is not None and bot.user.mentioned_in(ctx.message) and not ctx.message.mention_everyone)
+))
+async def ai_chat_stage(ctx):
+    # AI response in designated channel or when mentioned, queued behind !miku requests
+    # AI chat messages are not auto-responded to, moderated or counted as activity
+    message = ctx.message
+    if ctx.is_ai_channel:
+        ai_batcher.add(message)
+        return True
+
+    async def answer():
+        history = await get_recent_channel_history(message.channel, bot.user, message, limit=20)
+        system_prompt = get_system_prompt_with_timezone_and_duration(message.guild.id)
+        await reply_with_llm(message, message.content, user=message.author, history=history, system_prompt=system_prompt)
+
+    # A newer mention from the same user replaces their queued one; other users' questions stay queued
+    llm_dispatcher.submit(message.guild.id, LLM_PRIORITY_AMBIENT, answer, merge_key=(message.channel.id, message.author.id))
+    return True
+
+@message_stage("auto_response", when=lambda ctx: not ctx.is_bot and not ctx.is_command)
+async def auto_response_stage(ctx):
+    # Keyword auto-responses
+    message = ctx.message
+    for rule in ctx.matches:
+        if rule["kind"] != "response" or (rule.get("question") and '?' not in message.content):
+            continue
+        if "link" in rule:
+            await message.channel.send(rule["link"])
+        elif "gifs" in rule:
+            embed = discord.Embed(description=rule["reply"], color=0xff1744)
+            embed.set_image(url=random.choice(HREI_GIFS if rule["gifs"] == "hrei" else MIKU_GIFS))
             await message.reply(embed=embed)
-            return
-
-        if 'peak' in message_lower and '?' in message_lower:
-            await message.channel.send('https://discord.gg/peak')
-            return
-        elif 'valorant' in message_lower and '?' in message_lower:
-            await message.channel.send('https://discord.gg/valorant')
-            return
-
-        # @everyone abuse protection
-        if "@everyone" in message.content and not message.author.guild_permissions.mention_everyone:
-            user_id = str(message.author.id)
-            if user_id in everyone_warnings:
-                timeout_duration = timedelta(days=1)
-                await message.author.timeout(timeout_duration, reason="@everyone usage after warning")
-                await message.channel.send(
-                    f"{message.author.mention} has been timed out for 1 day due to repeated @everyone usage."
+        else:
+            await message.reply(rule["reply"])
+        return True
+    return False
+
+@message_stage("everyone_guard", when=lambda ctx: (
+    not ctx.is_bot and "@everyone" in ctx.message.content
+    and not ctx.message.author.guild_permissions.mention_everyone
+))
+async def everyone_guard_stage(ctx):
+    # @everyone abuse protection
+    message = ctx.message
+    await wait_for_state("everyone_warnings")
+    user_id = str(message.author.id)
+    guild_warnings = everyone_warnings[message.guild.id]
+    if user_id in guild_warnings:
+        moderation_queue.timeout(
+            message.channel, message.author, timedelta(days=1), "@everyone usage after warning",
+            notice=f"{message.author.mention} has been timed out for 1 day due to repeated @everyone usage."
+        )
+        del guild_warnings[user_id]
+    else:
+        guild_warnings[user_id] = discord.utils.utcnow()
+        moderation_queue.warn(
+            message.channel,
+            f"TAG NA GAR MUJI, MUTE KHANCHAS - {message.author.mention} - Do not use everyone unless absolutely necessary! Next time will result in a 24h timeout."
+        )
+    mark_dirty("everyone_warnings", message.guild.id, user_id)
+    return True
+
+@message_stage("mention_spam", when=lambda ctx: not ctx.is_bot and bool(ctx.message.mentions))
+async def mention_spam_stage(ctx):
+    # Mention spam protection
+    message = ctx.message
+    await wait_for_state("mention_spam_warnings")
+    now_ts = discord.utils.utcnow().timestamp()
+    for mentioned in message.mentions:
+        mention_patterns = [f"<@{mentioned.id}>", f"<@!{mentioned.id}>"]
+        explicit_mention = any(pattern in message.content for pattern in mention_patterns)
+        if not explicit_mention:
+            continue
+        key = (message.author.id, mentioned.id)
+        tracker_key = (message.guild.id, *key)
+        if mention_spam_tracker.hit(tracker_key, now_ts) >= MENTION_SPAM_THRESHOLD:
+            if key not in mention_spam_warnings:
+                mention_spam_warnings[key] = now_ts
+                mark_dirty("mention_spam_warnings", *key)
+                moderation_queue.warn(
+                    message.channel,
+                    f"⚠️ {message.author.mention}, stop spamming mentions to {mentioned.mention}! Next time you'll be timed out."
                 )
-                del everyone_warnings[user_id]
             else:
-                everyone_warnings[user_id] = discord.utils.utcnow()
-                await message.channel.send(
-                    f"TAG NA GAR MUJI, MUTE KHANCHAS - {message.author.mention} - Do not use everyone unless absolutely necessary! Next time will result in a 24h timeout."
+                moderation_queue.timeout(
+                    message.channel, message.author, timedelta(seconds=MENTION_TIMEOUT_DURATION),
+                    "Mention spam (auto timeout by bot)",
+                    notice=f"⏰ {message.author.mention} has been timed out for mention spam {mentioned.mention}."
                 )
-            save_all_data()
-            return
+                mention_spam_tracker.reset(tracker_key)
+                mention_spam_warnings.pop(key, None)
+                mark_dirty("mention_spam_warnings", *key)
+            return True
+    return False
+
+@message_stage("commands", when=lambda ctx: not ctx.is_bot and ctx.is_command)
+async def commands_stage(ctx):
+    await bot.process_commands(ctx.message)
+    await wait_for_state("server_stats")
+    bump_stat(ctx.message.guild.id, "commands_used")
+    return False
+
+@message_stage("auto_moderation", when=lambda ctx: not ctx.is_bot)
+async def auto_moderation_stage(ctx):
+    await auto_moderate(ctx.message, ctx.matches)
+    return False
+
+@message_stage("chat_activity", when=lambda ctx: not ctx.is_bot and not ctx.is_command and not ctx.is_ai_channel)
+async def chat_activity_stage(ctx):
+    # Track chat activity (skip AI channel, bots, commands)
+    await wait_for_state("server_stats", "chat_activity_weekly")
+    guild_id = ctx.message.guild.id
+    user_id = str(ctx.message.author.id)
+    key = (guild_id, user_id)
+    if chat_message_timestamps.count(key) < CHAT_ACTIVITY_RATE_LIMIT:
+        update_weekly_chat_activity(guild_id, user_id)
+        chat_message_timestamps.hit(key)
+    bump_stat(guild_id, "messages_today")
+    return False
 
-        # Mention spam protection
-        now_ts = discord.utils.utcnow().timestamp()
-        for mentioned in message.mentions:
-            mention_patterns = [f"<@{mentioned.id}>", f"<@!{mentioned.id}>"]
-            explicit_mention = any(pattern in message.content for pattern in mention_patterns)
-            if not explicit_mention:
-                continue
-            key = (message.author.id, mentioned.id)
-            dq = mention_spam_tracker[key]
-            dq.append(now_ts)
-            while dq and now_ts - dq[0] > MENTION_SPAM_WINDOW:
-                dq.popleft()
-            if len(dq) >= MENTION_SPAM_THRESHOLD:
-                if key not in mention_spam_warnings:
-                    mention_spam_warnings[key] = now_ts
-                    await message.channel.send(f"⚠\ufe0f {message.author.mention}, stop spamming mentions to {mentioned.mention}! Next time you'll be timed out.")
-                else:
-                    try:
-                        await message.author.timeout(
-                            timedelta(seconds=MENTION_TIMEOUT_DURATION),
-                            reason="Mention spam (auto timeout by bot)"
-                        )
-                        await message.channel.send(f"\u23f0 {message.author.mention} has been timed out for mention spam {mentioned.mention}.")
-                    except Exception as e:
-                        logger.error(f"Failed to timeout user for mention spam: {e}")
-                    mention_spam_tracker[key].clear()
-                    mention_spam_warnings.pop(key, None)
-                save_all_data()
-                return
-
-        # Process commands
-        await bot.process_commands(message)
-
-        # Track command usage
-        if message.content.startswith("!"):
-            server_stats["commands_used"] += 1
-
-        # Auto-moderation
-        await auto_moderate(message)
-
-        # Track chat activity (skip AI channel, bots, commands)
-        if not (ai_channel_id and message.channel.id == ai_channel_id):
-            if not message.author.bot and not message.content.startswith("!"):
-                guild_id = message.guild.id
-                user_id = str(message.author.id)
-                now = datetime.datetime.utcnow().timestamp()
-                if guild_id not in chat_message_timestamps:
-                    chat_message_timestamps[guild_id] = {}
-                if user_id not in chat_message_timestamps[guild_id]:
-                    chat_message_timestamps[guild_id][user_id] = []
-                timestamps = chat_message_timestamps[guild_id][user_id]
-                chat_message_timestamps[guild_id][user_id] = [t for t in timestamps if now - t < 10]
-                if len(chat_message_timestamps[guild_id][user_id]) < 5:
-                    update_weekly_chat_activity(guild_id, user_id)
-                    chat_message_timestamps[guild_id][user_id].append(now)
-                server_stats["messages_today"] += 1
 
+@bot.event
+async def on_message(message):
+    record_channel_history(message, bot.user)
+    if message.author == bot.user:
+        return
+    try:
+        await run_message_pipeline(MessageContext(message))
     except Exception as e:
         logger.error(f"Error in on_message: {e}")
         logger.error(f"Full traceback: {traceback.format_exc()}")
@@ -1147,6 +3301,7 @@ async def on_message(message):
 async def handle_dm_reply(message: discord.Message):
     """Handle DM replies from users and forward them to staff channel"""
     try:
+        await wait_for_state("active_dm_conversations")
         user_id = message.author.id
         
         # Check if this user has an active conversation
@@ -1166,11 +3321,13 @@ async def handle_dm_reply(message: discord.Message):
         if not staff_channel:
             # Remove invalid conversation
             del active_dm_conversations[user_id]
+            mark_dirty("active_dm_conversations", user_id)
             await message.channel.send("❌ Staff channel not found. Please contact staff through other means.")
             return
         
         # Update last message in conversation
         conversation["last_message"] = message.content
+        mark_dirty("active_dm_conversations", user_id)
         
 
         # Create embed to forward to staff
@@ -1204,9 +3361,6 @@ async def handle_dm_reply(message: discord.Message):
         # Send to staff channel
         await staff_channel.send(embed=forward_embed)
         
-        # Save conversation data
-        save_all_data()
-        
     except Exception as e:
         logger.error(f"Error handling DM reply: {e}")
         try:
@@ -1216,6 +3370,7 @@ async def handle_dm_reply(message: discord.Message):
 
 
 @bot.command(name="status")
+@requires_state("created_channels")
 async def status(ctx):
     """Debug command to check bot status"""
     embed = discord.Embed(title="Bot Status", color=0x00ff00)
@@ -1230,6 +3385,7 @@ async def status(ctx):
 
 
 @bot.command(name="vcstats")
+@requires_state("channel_stats", "created_channels")
 async def vcstats(ctx):
     """Display voice channel statistics"""
     embed = discord.Embed(title="📊 Voice Channel Statistics", color=0x0099ff)
@@ -1243,13 +3399,12 @@ async def vcstats(ctx):
 
     # Top users
     if channel_stats["user_activity"]:
-        sorted_users = sorted(channel_stats["user_activity"].items(),
-                              key=lambda x: x[1]["channels_created"],
-                              reverse=True)[:5]  # Top 5 users
+        top_users = get_leaderboard("channels_created", None, limit=5)  # Top 5 users
 
         top_users_text = ""
-        for i, (user_id, data) in enumerate(sorted_users, 1):
-            top_users_text += f"{i}. **{data['name']}** - {data['channels_created']} channels\n"
+        for i, (user_id, count) in enumerate(top_users, 1):
+            data = channel_stats["user_activity"][user_id]
+            top_users_text += f"{i}. **{data['name']}** - {count} channels\n"
 
         embed.add_field(name="🏆 Top Channel Creators",
                         value=top_users_text or "No data yet",
@@ -1276,6 +3431,7 @@ async def vcstats(ctx):
 
 @bot.command(name="cleanup")
 @commands.has_permissions(manage_channels=True)
+@requires_state("created_channels")
 async def cleanup(ctx):
     """Manual cleanup of orphaned channels"""
     cleaned = 0
@@ -1286,16 +3442,19 @@ async def cleanup(ctx):
                 if channel:
                     await channel.delete()
                 del created_channels[channel_id]
+                mark_dirty("created_channels", channel_id)
                 cleaned += 1
         except:
             if channel_id in created_channels:
                 del created_channels[channel_id]
+                mark_dirty("created_channels", channel_id)
                 cleaned += 1
 
     await ctx.send(f"Cleaned up {cleaned} orphaned channels.")
 
 
 @bot.command(name="voiceactivity", aliases=["va"])
+@requires_state("voice_activity", "voice_activity_alltime")
 async def voice_activity(ctx, mode: Optional[str] = None):
     """Show all-time (default) or today's voice channel activity leaderboard
     Usage: !va [today]
@@ -1346,7 +3505,8 @@ async def voice_activity(ctx, mode: Optional[str] = None):
         if guild_id not in voice_activity_alltime or not voice_activity_alltime[guild_id]:
             await ctx.send("No all-time voice activity recorded!")
             return
-        sorted_activity = sorted(voice_activity_alltime[guild_id].items(), key=lambda x: x[1]["total_time"], reverse=True)[:10]
+        sorted_activity = [(user_id, voice_activity_alltime[guild_id][user_id])
+                           for user_id, _ in get_leaderboard("voice_alltime", guild_id)]
         embed = discord.Embed(
             title="🎙️ All-Time Voice Activity Leaders",
             description="Most active users in voice channels (all-time)",
@@ -1538,9 +3698,11 @@ async def afk_command(ctx, action: Optional[str] = None, value: Optional[str] =
 
 @bot.command(name="warnings")
 @commands.has_permissions(manage_messages=True)
+@requires_state("everyone_warnings")
 async def check_warnings(ctx):
     """Check current @everyone warnings (Admin only)"""
-    if not everyone_warnings:
+    guild_warnings = everyone_warnings.get(ctx.guild.id)
+    if not guild_warnings:
         await ctx.send("No active @everyone warnings.")
         return
 
@@ -1550,7 +3712,7 @@ async def check_warnings(ctx):
         color=0xffaa00)
 
     warning_text = ""
-    for user_id, warning_time in everyone_warnings.items():
+    for user_id, warning_time in guild_warnings.items():
         try:
             user = bot.get_user(int(user_id))
             user_name = user.display_name if user else f"User ID: {user_id}"
@@ -1573,20 +3735,243 @@ async def check_warnings(ctx):
 
 @bot.command(name="clearwarnings")
 @commands.has_permissions(manage_messages=True)
+@requires_state("everyone_warnings")
 async def clear_warnings(ctx, user: Optional[discord.Member] = None):
     """Clear @everyone warnings for a user or all users (Admin only)"""
+    guild_warnings = everyone_warnings.get(ctx.guild.id, {})
     if user:
         user_id = str(user.id)
-        if user_id in everyone_warnings:
-            del everyone_warnings[user_id]
+        if user_id in guild_warnings:
+            del guild_warnings[user_id]
+            mark_dirty("everyone_warnings", ctx.guild.id, user_id)
             await ctx.send(
                 f"✅ Cleared @everyone warning for {user.display_name}")
         else:
             await ctx.send(f"❌ {user.display_name} has no active warnings")
     else:
-        count = len(everyone_warnings)
-        everyone_warnings.clear()
-        await ctx.send(f"✅ Cleared all {count} @everyone warnings")
+        count = len(guild_warnings)
+        for user_id in list(guild_warnings):
+            mark_dirty("everyone_warnings", ctx.guild.id, user_id)
+        everyone_warnings.pop(ctx.guild.id, None)
+        await ctx.send(f"✅ Cleared all {count} @everyone warnings")
+
+
+@bot.command(name="automod")
+@commands.has_permissions(administrator=True)
+async def automod_command(ctx, action: Optional[str] = None, *, value: Optional[str] = None):
+    """Configure this server's word filter, invite blocking and auto-responses. Usage: !automod show"""
+    guild_id = ctx.guild.id
+    settings = get_guild_settings(guild_id)
+    banned_words = list(settings.get("banned_words", []))
+    custom_responses = list(settings.get("custom_responses", []))
+    action = (action or "").lower()
+
+    if action == "ban" and value:
+        word = value.strip().lower()
+        if word in banned_words:
+            await ctx.send(f"❌ `{word}` is already banned.")
+            return
+        set_guild_setting(guild_id, "banned_words", banned_words + [word])
+        await ctx.send(f"✅ Added ||{word}|| to the banned words.")
+
+    elif action == "unban" and value:
+        word = value.strip().lower()
+        if word not in banned_words:
+            await ctx.send(f"❌ `{word}` is not banned.")
+            return
+        banned_words.remove(word)
+        set_guild_setting(guild_id, "banned_words", banned_words)
+        await ctx.send(f"✅ Removed ||{word}|| from the banned words.")
+
+    elif action == "respond" and value and "|" in value:
+        trigger, reply = (part.strip() for part in value.split("|", 1))
+        trigger = trigger.lower()
+        if not trigger or not reply:
+            await ctx.send("❌ Usage: `!automod respond <trigger> | <reply>`")
+            return
+        custom_responses = [r for r in custom_responses if r["trigger"] != trigger]
+        custom_responses.append({"trigger": trigger, "reply": reply})
+        set_guild_setting(guild_id, "custom_responses", custom_responses)
+        await ctx.send(f"✅ I'll reply to **{trigger}** from now on.")
+
+    elif action == "unrespond" and value:
+        trigger = value.strip().lower()
+        remaining = [r for r in custom_responses if r["trigger"] != trigger]
+        if len(remaining) == len(custom_responses):
+            await ctx.send(f"❌ No auto-response for **{trigger}**.")
+            return
+        set_guild_setting(guild_id, "custom_responses", remaining)
+        await ctx.send(f"✅ Removed the auto-response for **{trigger}**.")
+
+    elif action in ("invites", "responses", "links") and value in ("on", "off"):
+        key, label = {
+            "invites": ("block_invites", "Invite link blocking"),
+            "responses": ("auto_responses", "Built-in auto-responses"),
+            "links": ("link_filter", "Link whitelist filtering"),
+        }[action]
+        set_guild_setting(guild_id, key, value == "on")
+        await ctx.send(f"✅ {label} turned **{value}**.")
+
+    elif action in ("allow", "disallow") and value:
+        domain = value.strip().lower().strip(".")
+        added = [d for d in settings.get("link_whitelist_add", []) if d != domain]
+        removed = [d for d in settings.get("link_whitelist_remove", []) if d != domain]
+        if action == "allow":
+            added.append(domain)
+        elif domain in AUTO_MODERATION["link_whitelist"]:
+            removed.append(domain)
+        set_guild_setting(guild_id, "link_whitelist_add", added)
+        set_guild_setting(guild_id, "link_whitelist_remove", removed)
+        verb = "allowed" if action == "allow" else "no longer allowed"
+        await ctx.send(f"✅ Links to `{domain}` are {verb}.")
+
+    elif action == "limit" and value and len(value.split()) == 2:
+        feature, limit = value.lower().split()
+        if feature not in {rule[0] for rule in MESSAGE_FEATURE_RULES}:
+            await ctx.send(f"❌ Unknown check `{feature}`. Use one of: {', '.join(rule[0] for rule in MESSAGE_FEATURE_RULES)}")
+            return
+        limits = dict(settings.get("automod_limits", {}))
+        if limit == "default":
+            limits.pop(feature, None)
+        elif limit == "off":
+            limits[feature] = None
+        else:
+            try:
+                limits[feature] = float(limit)
+            except ValueError:
+                await ctx.send("❌ Limit must be a number, `off` or `default`.")
+                return
+        set_guild_setting(guild_id, "automod_limits", limits)
+        await ctx.send(f"✅ `{feature}` limit set to **{limit}**.")
+
+    elif action == "copypasta" and value:
+        value = value.strip().lower()
+        if value == "off":
+            set_guild_setting(guild_id, "copypasta_users", None)
+            await ctx.send("✅ Copypasta detection turned **off**.")
+        elif value.isdigit() and int(value) >= COPYPASTA_MIN_USERS:
+            set_guild_setting(guild_id, "copypasta_users", int(value))
+            await ctx.send(
+                f"✅ Once **{value}** users post the same message within {COPYPASTA_WINDOW}s, "
+                "the channel is warned and further copies are removed."
+            )
+        else:
+            await ctx.send(f"❌ Usage: `!automod copypasta <users ({COPYPASTA_MIN_USERS} or more)|off>`")
+
+    elif action == "show":
+        embed = discord.Embed(title="🛡️ Auto-Moderation Rules", color=0x00ff88)
+        embed.add_field(
+            name="Banned Words",
+            value=", ".join(f"||{w}||" for w in banned_words) or "None",
+            inline=False
+        )
+        embed.add_field(
+            name="Custom Responses",
+            value="\n".join(f"**{r['trigger']}** → {r['reply'][:50]}" for r in custom_responses) or "None",
+            inline=False
+        )
+        embed.add_field(name="Block Invites", value="On" if settings.get("block_invites") else "Off", inline=True)
+        embed.add_field(
+            name="Built-in Responses",
+            value="On" if settings.get("auto_responses", True) else "Off",
+            inline=True
+        )
+        embed.add_field(name="Compiled Rules", value=str(len(get_rule_matcher(guild_id).rules)), inline=True)
+        embed.add_field(name="Link Filter", value="On" if settings.get("link_filter") else "Off", inline=True)
+        embed.add_field(
+            name="Whitelist Changes",
+            value=", ".join([f"+{d}" for d in settings.get("link_whitelist_add", [])]
+                            + [f"-{d}" for d in settings.get("link_whitelist_remove", [])]) or "None",
+            inline=True
+        )
+        copypasta_users = settings.get("copypasta_users", AUTO_MODERATION["copypasta_users"])
+        embed.add_field(
+            name="Copypasta",
+            value=f"{copypasta_users} users / {COPYPASTA_WINDOW}s" if copypasta_users else "Off",
+            inline=True
+        )
+        embed.add_field(
+            name="Message Limits",
+            value=" • ".join(f"{feature}: {'off' if limit is None else f'{limit:g}'}"
+                             for feature, limit in feature_limits(guild_id).items()),
+            inline=False
+        )
+        await ctx.send(embed=embed)
+
+    else:
+        embed = discord.Embed(title="🛡️ Auto-Moderation Help", color=0x00ff88)
+        embed.add_field(
+            name="Commands",
+            value=(
+                "`!automod show` - Show this server's rules\n"
+                "`!automod ban <word>` / `!automod unban <word>` - Manage banned words\n"
+                "`!automod respond <trigger> | <reply>` - Add an auto-response\n"
+                "`!automod unrespond <trigger>` - Remove an auto-response\n"
+                "`!automod invites on|off` - Delete Discord invite links\n"
+                "`!automod links on|off` - Only allow whitelisted link domains\n"
+                "`!automod allow <domain>` / `!automod disallow <domain>` - Edit the link whitelist\n"
+                "`!automod responses on|off` - Toggle the built-in auto-responses\n"
+                "`!automod limit <caps|mentions|zalgo|emoji|repeat> <number|off|default>` - Tune message limits\n"
+                "`!automod copypasta <users|off>` - Warn, then remove text posted by that many users at once"
+            ),
+            inline=False
+        )
+        await ctx.send(embed=embed)
+
+
+@bot.command(name="raidmode")
+@commands.has_permissions(administrator=True)
+async def raidmode_command(ctx, action: Optional[str] = None, *, value: Optional[str] = None):
+    """Show or control raid mode for this server. Usage: !raidmode [on|off|threshold <joins>|timeout on|off]"""
+    guild_id = ctx.guild.id
+    action = (action or "").lower()
+
+    if action == "on":
+        start_raid_mode(ctx.guild, manual=True)
+        await ctx.send("🛡️ Raid mode turned **on**. It stays on until `!raidmode off`.")
+
+    elif action == "off":
+        state = raid_state.pop(guild_id, None)
+        if state is None:
+            await ctx.send("❌ Raid mode is not active.")
+            return
+        state["task"].cancel()
+        await send_raid_summary(ctx.guild, state, ended=True)
+        await ctx.send("✅ Raid mode turned **off**.")
+
+    elif action == "threshold" and value and value.strip().isdigit() and 2 <= int(value) <= RAID_MAX_THRESHOLD:
+        set_guild_setting(guild_id, "raid_join_threshold", int(value))
+        await ctx.send(f"✅ Raid mode will start at **{int(value)}** joins within {RAID_JOIN_WINDOW}s.")
+
+    elif action == "timeout" and value in ("on", "off"):
+        set_guild_setting(guild_id, "raid_timeout_new_accounts", value == "on")
+        await ctx.send(f"✅ Timing out new accounts during raids turned **{value}**.")
+
+    elif action in ("", "status"):
+        state = raid_state.get(guild_id)
+        settings = get_guild_settings(guild_id)
+        embed = discord.Embed(
+            title="🛡️ Raid Mode",
+            description="**Active**" + (" (manual)" if state and state["manual"] else "") if state else "Inactive",
+            color=0xff1744 if state else 0x00ff88
+        )
+        embed.add_field(name="Joins (last {}s)".format(RAID_JOIN_WINDOW), value=str(join_rate.count(guild_id)), inline=True)
+        embed.add_field(name="Threshold", value=str(raid_join_threshold(guild_id)), inline=True)
+        embed.add_field(
+            name="Timeout New Accounts",
+            value=f"On (< {RAID_NEW_ACCOUNT_DAYS} days old)" if settings.get("raid_timeout_new_accounts") else "Off",
+            inline=True
+        )
+        if state:
+            embed.add_field(name="Since", value=discord.utils.format_dt(state["since"], style='R'), inline=True)
+            embed.add_field(name="Joins During Raid", value=f"{state['joins']:,}", inline=True)
+            embed.add_field(name="Timed Out", value=f"{state['timed_out']:,}", inline=True)
+            embed.add_field(name="DMs Skipped", value=f"{state['dms_skipped']:,}", inline=True)
+        embed.timestamp = discord.utils.utcnow()
+        await ctx.send(embed=embed)
+
+    else:
+        await ctx.send(f"❌ Usage: `!raidmode [on|off|threshold <2-{RAID_MAX_THRESHOLD}>|timeout on|off]`")
 
 
 @bot.command(name="kick")
@@ -1804,11 +4189,13 @@ async def clear_messages(ctx, amount: int = 10):
 
 @bot.command(name="warn")
 @commands.has_permissions(manage_messages=True)
+@requires_state("warnings_db")
 async def warn_member(ctx, member: discord.Member, *, reason="No reason provided"):
     """Warn a member"""
     user_id = str(member.id)
-    if user_id not in WARNINGS_DB:
-        WARNINGS_DB[user_id] = []
+    guild_warnings = WARNINGS_DB.setdefault(ctx.guild.id, {})
+    if user_id not in guild_warnings:
+        guild_warnings[user_id] = []
     
     warning = {
         "reason": reason,
@@ -1817,7 +4204,8 @@ async def warn_member(ctx, member: discord.Member, *, reason="No reason provided
         "guild_id": ctx.guild.id
     }
     
-    WARNINGS_DB[user_id].append(warning)
+    guild_warnings[user_id].append(warning)
+    mark_dirty("warnings_db", ctx.guild.id, user_id)
     
     embed = discord.Embed(
         title="⚠️ Member Warned",
@@ -1826,7 +4214,7 @@ async def warn_member(ctx, member: discord.Member, *, reason="No reason provided
     )
     embed.add_field(name="Reason", value=reason, inline=True)
     embed.add_field(name="Warned by", value=ctx.author.mention, inline=True)
-    embed.add_field(name="Total Warnings", value=len(WARNINGS_DB[user_id]), inline=True)
+    embed.add_field(name="Total Warnings", value=len(guild_warnings[user_id]), inline=True)
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.timestamp = discord.utils.utcnow()
     await ctx.send(embed=embed)
@@ -1837,7 +4225,7 @@ async def warn_member(ctx, member: discord.Member, *, reason="No reason provided
         await mod_channel.send(embed=embed)
     
     # Auto-ban after 3 warnings
-    if len(WARNINGS_DB[user_id]) >= 3:
+    if len(guild_warnings[user_id]) >= 3:
         try:
             await member.ban(reason=f"Auto-banned after 3 warnings. Last warning: {reason}")
             await ctx.send(f"🔨 {member.mention} has been automatically banned after 3 warnings!")
@@ -1847,11 +4235,13 @@ async def warn_member(ctx, member: discord.Member, *, reason="No reason provided
 
 @bot.command(name="checkwarnings")
 @commands.has_permissions(manage_messages=True)
+@requires_state("warnings_db")
 async def check_user_warnings(ctx, member: Optional[discord.Member] = None):
     """Check warnings for a member or show all warnings"""
+    guild_warnings = WARNINGS_DB.get(ctx.guild.id, {})
     if member:
         user_id = str(member.id)
-        if user_id not in WARNINGS_DB or not WARNINGS_DB[user_id]:
+        if user_id not in guild_warnings or not guild_warnings[user_id]:
             await ctx.send(f"✅ {member.display_name} has no warnings!")
             return
         
@@ -1860,7 +4250,7 @@ async def check_user_warnings(ctx, member: Optional[discord.Member] = None):
             color=0xffaa00
         )
         
-        for i, warning in enumerate(WARNINGS_DB[user_id], 1):
+        for i, warning in enumerate(guild_warnings[user_id], 1):
             moderator = bot.get_user(warning["moderator"])
             mod_name = moderator.display_name if moderator else "Unknown"
             timestamp = dt.datetime.fromtimestamp(warning["timestamp"])
@@ -1874,7 +4264,7 @@ async def check_user_warnings(ctx, member: Optional[discord.Member] = None):
         await ctx.send(embed=embed)
     else:
         # Show all warnings
-        if not WARNINGS_DB:
+        if not guild_warnings:
             await ctx.send("✅ No warnings in the database!")
             return
         
@@ -1883,7 +4273,7 @@ async def check_user_warnings(ctx, member: Optional[discord.Member] = None):
             color=0xffaa00
         )
         
-        for user_id, warnings in WARNINGS_DB.items():
+        for user_id, warnings in guild_warnings.items():
             if warnings:
                 user = bot.get_user(int(user_id))
                 user_name = user.display_name if user else f"User {user_id}"
@@ -2088,6 +4478,7 @@ async def user_info(ctx, member: discord.Member = None):
 
 
 @bot.command(name="botinfo")
+@requires_state("server_stats")
 async def bot_info(ctx):
     """Display bot information and statistics, including a categorized command list"""
     # Calculate uptime
@@ -2141,9 +4532,10 @@ async def bot_info(ctx):
     )
     
     # Server stats
+    today = guild_stats(ctx.guild.id) if ctx.guild else dict.fromkeys(SERVER_STAT_NAMES, 0)
     embed.add_field(
         name="📈 Today's Stats",
-        value=f"**Messages:** {server_stats['messages_today']:,}\n**Commands:** {server_stats['commands_used']:,}\n**Joins:** {server_stats['users_joined']:,}",
+        value=f"**Messages:** {today['messages_today']:,}\n**Commands:** {today['commands_used']:,}\n**Joins:** {today['users_joined']:,}",
         inline=True
     )
     
@@ -2174,7 +4566,7 @@ async def bot_info(ctx):
             "dm", "dmclose", "dmstatus", "dmhelp"
         ],
         "🔧 Admin": [
-            "status", "cleanup", "setwelcome", "setmodlog", "setdmcategory", "setafk", "setaichannel", "settimezone", "setpersonality", "addpersonality", "viewpersonality", "resetpersonality"
+            "status", "cleanup", "setwelcome", "setmodlog", "setdmcategory", "setafk", "setaichannel", "settimezone", "setpersonality", "addpersonality", "viewpersonality", "resetpersonality", "storagestats", "memstats", "automod", "pipelinestats", "raidmode", "welcomemsg", "llmstats"
         ],
         "📝 Help": [
             "helpme", "invite", "support"
@@ -2313,14 +4705,14 @@ async def role_info(ctx, role: discord.Role):
 
 
 @bot.command(name="chatactivity", aliases=["chatleaderboard"])
+@requires_state("chat_activity_weekly")
 async def chat_activity_leaderboard(ctx):
     """Show the weekly chat activity leaderboard."""
     guild_id = ctx.guild.id
     if guild_id not in chat_activity_weekly or not chat_activity_weekly[guild_id]:
         await ctx.send("No chat activity recorded this week!")
         return
-    user_totals = {user_id: sum(days) for user_id, days in chat_activity_weekly[guild_id].items()}
-    top_users = sorted(user_totals.items(), key=lambda x: x[1], reverse=True)[:10]
+    top_users = get_leaderboard("chat_weekly", guild_id)
     leaderboard = ""
     for i, (user_id, total) in enumerate(top_users, 1):
         member = ctx.guild.get_member(int(user_id))
@@ -3059,6 +5451,7 @@ async def support_info(ctx):
 
 
 @bot.command(name="stats")
+@requires_state("server_stats", "channel_stats", "created_channels")
 async def server_stats_command(ctx):
     """Show server statistics"""
     embed = discord.Embed(
@@ -3068,9 +5461,10 @@ async def server_stats_command(ctx):
     )
     
     # Today's stats
+    today = guild_stats(ctx.guild.id)
     embed.add_field(
         name="📈 Today's Activity",
-        value=f"**Messages:** {server_stats['messages_today']:,}\n**Commands Used:** {server_stats['commands_used']:,}\n**Users Joined:** {server_stats['users_joined']:,}\n**Users Left:** {server_stats['users_left']:,}",
+        value=f"**Messages:** {today['messages_today']:,}\n**Commands Used:** {today['commands_used']:,}\n**Users Joined:** {today['users_joined']:,}\n**Users Left:** {today['users_left']:,}",
         inline=True
     )
     
@@ -3144,21 +5538,10 @@ async def check_and_assign_roles(member: discord.Member, channels_created: int):
                             f"Cannot assign role {role_name} to {member.display_name}"
                         )
 
-        save_all_data()
-
     except Exception as e:
         logger.error(f"Error in role assignment: {e}")
 
 
-async def heartbeat() -> None:
-    while True:
-        await asyncio.sleep(300)  # save every 5 minutes
-        try:
-            save_all_data()
-        except Exception as e:
-            logger.error(f"Heartbeat save failed: {e}")
-
-
 async def reset_voice_activity() -> None:
     while True:
         now = discord.utils.utcnow()
@@ -3166,6 +5549,7 @@ async def reset_voice_activity() -> None:
                                     microsecond=0) + timedelta(days=1)
         await discord.utils.sleep_until(next_midnight)
         voice_activity_today.clear()
+        mark_reset("voice_activity")
         logger.info("Reset voice activity data at midnight UTC")
 
 
@@ -3178,10 +5562,8 @@ async def reset_daily_stats() -> None:
         await discord.utils.sleep_until(next_midnight)
         
         # Reset server stats
-        server_stats["messages_today"] = 0
-        server_stats["commands_used"] = 0
-        server_stats["users_joined"] = 0
-        server_stats["users_left"] = 0
+        server_stats.clear()
+        mark_reset("server_stats")
         
         # Clear message cooldowns
         message_cooldowns.clear()
@@ -3193,8 +5575,8 @@ async def reset_daily_stats() -> None:
 
 # Category ID for DM channels
 DM_CATEGORY_ID = 1363906960583557322
-# Mapping: user_id -> channel_id
-user_dm_channels = {}
+# Mapping: user_id -> channel_id (recovered by channel name once forgotten)
+user_dm_channels = TTLCache("user_dm_channels", ttl=7 * 24 * 3600)
 
 async def get_or_create_dm_channel(guild, user):
     settings = get_guild_settings(guild.id)
@@ -3232,11 +5614,11 @@ async def get_or_create_dm_channel(guild, user):
         reason=f"DM channel for {user.display_name} ({user.id})"
     )
     user_dm_channels[user.id] = channel.id
-    save_all_data()
     return channel
 
 @bot.command(name="dm")
 @commands.has_permissions(manage_messages=True)
+@requires_state("active_dm_conversations")
 async def dm_user(ctx, user_input: str, *, message: str):
     """Send a DM to a user via the bot. Usage: !dm @user Your message here or !dm 123456789 Your message here"""
     try:
@@ -3280,8 +5662,8 @@ async def dm_user(ctx, user_input: str, *, message: str):
             "start_time": discord.utils.utcnow().timestamp(),
             "last_message": message
         }
+        mark_dirty("active_dm_conversations", user.id)
         await ctx.send(f"Message sent to {user.display_name}. Conversation in {dm_channel.mention}", allowed_mentions=discord.AllowedMentions.none())
-        save_all_data()
     except discord.Forbidden:
         await ctx.send(f"❌ Cannot send DM to {user.display_name if user else 'user'}. They may have DMs disabled.")
     except Exception as e:
@@ -3290,6 +5672,7 @@ async def dm_user(ctx, user_input: str, *, message: str):
 
 @bot.command(name="dmclose")
 @commands.has_permissions(manage_messages=True)
+@requires_state("active_dm_conversations")
 async def close_dm_conversation(ctx, user_input: str):
     """Close an active DM conversation with a user. Usage: !dmclose @user or !dmclose 123456789"""
     if ctx.channel.id != DM_CATEGORY_ID:
@@ -3339,6 +5722,7 @@ async def close_dm_conversation(ctx, user_input: str):
         
         # Remove from active conversations
         del active_dm_conversations[user.id]
+        mark_dirty("active_dm_conversations", user.id)
         
         # Send closing message to user
         try:
@@ -3355,9 +5739,6 @@ async def close_dm_conversation(ctx, user_input: str):
             # Confirm to staff (with silent mention)
             await ctx.send(f"✅ DM conversation with {user.display_name} has been closed.", allowed_mentions=discord.AllowedMentions.none())
             
-            # Save data
-            save_all_data()
-            
         except discord.Forbidden:
             await ctx.send(f"✅ Conversation closed locally (could not notify {user.display_name})")
         except Exception as e:
@@ -3369,6 +5750,7 @@ async def close_dm_conversation(ctx, user_input: str):
 
 @bot.command(name="dmstatus")
 @commands.has_permissions(manage_messages=True)
+@requires_state("active_dm_conversations")
 async def dm_status(ctx):
     """Show active DM conversations"""
     if ctx.channel.id != DM_CATEGORY_ID:
@@ -3488,466 +5870,769 @@ async def dm_help(ctx):
     await ctx.send(embed=embed)
 
 
-# MongoDB Atlas connection
-MONGO_URI = os.getenv("MONGO_URI")
-if MONGO_URI and MongoClient is not None:
-    try:
-        client = MongoClient(MONGO_URI)
-        db = client["discord_bot"]
-        # Test connection
-        client.admin.command('ping')
-        logger.info("✅ MongoDB connection established")
-    except Exception as e:
-        logger.error(f"❌ MongoDB connection failed: {e}")
-        db = None
-else:
-    logger.warning("⚠️ No MONGO_URI found or MongoClient unavailable, data persistence disabled")
-    db = None
+# --- Storage Backends ---
+# Everything the bot persists goes through one small document-store interface, so the
+# same code runs against MongoDB or a local SQLite file. Backends are blocking and are
+# only ever called from the storage thread (see run_storage) or the settings watcher.
+# Select one with STORAGE_BACKEND=mongo|sqlite (default: mongo when MONGO_URI is set).
+class StorageBackend(ABC):
+    """Blocking document store: collections of documents identified by their key fields."""
 
-# --- Persistence Functions ---
-def stringify_keys(d):
-    """Recursively convert all dict keys to strings."""
-    if isinstance(d, dict):
-        return {str(k): stringify_keys(v) for k, v in d.items()}
-    return d
+    name = "none"
+    supports_change_streams = False  # whether watch() works
 
+    @abstractmethod
+    def find_all(self, collection) -> list:
+        ...
 
-def _save_voice_activity_today() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_today save")
-        return
-    try:
-        db.voice_activity.delete_many({})
-        if voice_activity_today:
-            db.voice_activity.insert_one({"data": stringify_keys(voice_activity_today)})
-        logger.debug("voice_activity_today saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving voice_activity_today: {e}")
+    @abstractmethod
+    def apply_changes(self, collection, reset, changes) -> None:
+        """Upsert (key_doc, doc) pairs and delete (key_doc, None) pairs; reset empties the collection first."""
 
-def _save_channel_stats() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping channel_stats save")
-        return
-    try:
-        db.channel_stats.delete_many({})
-        if channel_stats:
-            db.channel_stats.insert_one({"data": stringify_keys(channel_stats)})
-        logger.debug("channel_stats saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving channel_stats: {e}")
+    @abstractmethod
+    def update_fields(self, collection, key_doc, fields) -> None:
+        """Merge fields into one document, creating it if needed."""
 
-def _save_created_channels() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping created_channels save")
-        return
-    try:
-        db.created_channels.delete_many({})
-        if created_channels:
-            db.created_channels.insert_one({"ids": [str(k) for k in created_channels.keys()]})
-        logger.debug("created_channels saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving created_channels: {e}")
+    def ensure_indexes(self, collection, key_fields, indexes=()) -> None:
+        pass
 
-def _save_everyone_warnings() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping everyone_warnings save")
-        return
-    try:
-        db.everyone_warnings.delete_many({})
-        if everyone_warnings:
-            db.everyone_warnings.insert_one({"data": stringify_keys(everyone_warnings)})
-        logger.debug("everyone_warnings saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving everyone_warnings: {e}")
+    @abstractmethod
+    def collection_names(self) -> list:
+        ...
 
-def _save_mention_spam_tracker() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping mention_spam_tracker save")
-        return
-    try:
-        tracker_data = [{"key": str(k), "timestamps": list(v)} for k, v in mention_spam_tracker.items()]
-        db.mention_spam_tracker.delete_many({})
-        if tracker_data:
-            db.mention_spam_tracker.insert_many(tracker_data)
-        logger.debug("mention_spam_tracker saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving mention_spam_tracker: {e}")
+    def watch(self, collection):
+        """Context manager iterating change events of a collection (only if supports_change_streams)."""
+        raise NotImplementedError(f"{self.name} storage has no change streams; poll instead")
 
-def _save_mention_spam_warnings() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping mention_spam_warnings save")
-        return
-    try:
-        db.mention_spam_warnings.delete_many({})
-        if mention_spam_warnings:
-            db.mention_spam_warnings.insert_one({"data": stringify_keys(mention_spam_warnings)})
-        logger.debug("mention_spam_warnings saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving mention_spam_warnings: {e}")
 
-def _save_warnings_db() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping WARNINGS_DB save")
-        return
-    try:
-        db.warnings_db.delete_many({})
-        if WARNINGS_DB:
-            db.warnings_db.insert_one({"data": stringify_keys(WARNINGS_DB)})
-        logger.debug("WARNINGS_DB saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving WARNINGS_DB: {e}")
+class MongoBackend(StorageBackend):
+    name = "mongo"
+    supports_change_streams = True
 
-def _save_server_stats() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping server_stats save")
-        return
-    try:
-        db.server_stats.delete_many({}) 
-        if server_stats:
-            db.server_stats.insert_one({"data": stringify_keys(server_stats)})
-        logger.debug("server_stats saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving server_stats: {e}")
+    def __init__(self, uri, database="discord_bot"):
+        self.client = MongoClient(uri)
+        self.db = self.client[database]
+        self.client.admin.command('ping')
 
-def _save_user_activity() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping user_activity save")
-        return
-    try:
-        db.user_activity.delete_many({})
-        if user_activity:
-            db.user_activity.insert_one({"data": stringify_keys(user_activity)})
-        logger.debug("user_activity saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving user_activity: {e}")
+    def find_all(self, collection) -> list:
+        return list(self.db[collection].find())
 
-def _save_message_cooldowns() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping message_cooldowns save")
-        return
-    try:
-        db.message_cooldowns.delete_many({})
-        if message_cooldowns:
-            db.message_cooldowns.insert_one({"data": stringify_keys(message_cooldowns)})
-        logger.debug("message_cooldowns saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving message_cooldowns: {e}")
+    def apply_changes(self, collection, reset, changes) -> None:
+        coll = self.db[collection]
+        if reset:
+            coll.delete_many({})
+        ops = [
+            UpdateOne(key_doc, {"$set": doc}, upsert=True) if doc is not None else DeleteOne(key_doc)
+            for key_doc, doc in changes
+        ]
+        for i in range(0, len(ops), BULK_WRITE_BATCH_SIZE):
+            coll.bulk_write(ops[i:i + BULK_WRITE_BATCH_SIZE], ordered=False)
 
-def _save_active_dm_conversations() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping active_dm_conversations save")
-        return
-    try:
-        db.active_dm_conversations.delete_many({})
-        if active_dm_conversations:
-            dm_data = [{"user_id": str(k), "data": v} for k, v in active_dm_conversations.items()]
-            if dm_data:
-                db.active_dm_conversations.insert_many(dm_data)
-        logger.debug("active_dm_conversations saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving active_dm_conversations: {e}")
+    def update_fields(self, collection, key_doc, fields) -> None:
+        self.db[collection].update_one(key_doc, {"$set": fields}, upsert=True)
 
-def _save_voice_activity_alltime() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_alltime save")
-        return
-    try:
-        db.voice_activity_alltime.delete_many({})
-        if voice_activity_alltime:
-            db.voice_activity_alltime.insert_one({"data": stringify_keys(voice_activity_alltime)})
-        logger.debug("voice_activity_alltime saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving voice_activity_alltime: {e}")
+    def ensure_indexes(self, collection, key_fields, indexes=()) -> None:
+        coll = self.db[collection]
+        coll.create_index([(field, 1) for field in key_fields])
+        for index in indexes:
+            coll.create_index(index)
 
-def _save_voice_activity_weekly() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_weekly save")
-        return
-    try:
-        db.voice_activity_weekly.delete_many({})
-        if voice_activity_weekly:
-            db.voice_activity_weekly.insert_one({"data": stringify_keys(voice_activity_weekly)})
-        logger.debug("voice_activity_weekly saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving voice_activity_weekly: {e}")
+    def collection_names(self) -> list:
+        return self.db.list_collection_names()
 
-def _save_chat_activity_weekly() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping chat_activity_weekly save")
-        return
-    try:
-        db.chat_activity_weekly.delete_many({})
-        if chat_activity_weekly:
-            db.chat_activity_weekly.insert_one({"data": stringify_keys(chat_activity_weekly)})
-        logger.debug("chat_activity_weekly saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving chat_activity_weekly: {e}")
+    def watch(self, collection):
+        return self.db[collection].watch(full_document="updateLookup")
 
-def save_all_data() -> None:
-    global voice_activity_weekly
-    if db is None:
-        logger.warning("Database not available, skipping save")
-        return
-        
-    try:
-        _save_voice_activity_today()
-        
-        _save_channel_stats()
-        
-        _save_created_channels()
-        
-        _save_everyone_warnings()
-        
-        _save_mention_spam_tracker()
-        
-        _save_mention_spam_warnings()
-        
-        _save_warnings_db()
-        
-        _save_server_stats()
-        
-        _save_user_activity()
-        
-        _save_message_cooldowns()
-            
-        
-        _save_active_dm_conversations()
-        
-        
-        
-        _save_voice_activity_alltime()
-        
-        _save_voice_activity_weekly()
-        
-        _save_chat_activity_weekly()
-        
-        logger.info("All data saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving data: {e}")
 
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return {"$date": value.isoformat()}
+    if isinstance(value, (set, deque)):
+        return list(value)
+    return str(value)  # ObjectId and other driver types
 
-def _load_voice_activity_today() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_today load")
-        return
-    try:
-        voice_activity_today.clear()
-        doc = db.voice_activity.find_one()
-        if doc:
-            voice_activity_today.update(doc["data"])
-        logger.debug("voice_activity_today loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading voice_activity_today: {e}")
+def _json_object_hook(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.datetime.fromisoformat(obj["$date"])
+    return obj
 
-def _load_channel_stats() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping channel_stats load")
-        return
-    try:
-        doc = db.channel_stats.find_one()
-        if doc:
-            channel_stats.clear()
-            channel_stats.update(doc["data"])
-        logger.debug("channel_stats loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading channel_stats: {e}")
+class SQLiteBackend(StorageBackend):
+    """Single-file store for single-node deployments: one table per collection, JSON documents.
 
-def _load_created_channels() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping created_channels load")
-        return
-    try:
-        created_channels.clear()
-        doc = db.created_channels.find_one()
-        if doc:
-            for cid in doc["ids"]:
-                created_channels[int(cid)] = True
-        logger.debug("created_channels loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading created_channels: {e}")
+    Runs in WAL mode so the settings watcher can read while the storage thread writes.
+    Each thread gets its own connection.
+    """
 
-def _load_everyone_warnings() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping everyone_warnings load")
-        return
-    try:
-        everyone_warnings.clear()
-        doc = db.everyone_warnings.find_one()
-        if doc:
-            everyone_warnings.update(doc["data"])
-        logger.debug("everyone_warnings loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading everyone_warnings: {e}")
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._tables = set()
+        self._conn()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _table(self, collection) -> str:
+        if not re.fullmatch(r"\w+", collection):
+            raise ValueError(f"Invalid collection name: {collection!r}")
+        if collection not in self._tables:
+            with self._conn() as conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{collection}" (key TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+            self._tables.add(collection)
+        return f'"{collection}"'
+
+    @staticmethod
+    def _key(key_doc) -> str:
+        return json.dumps(key_doc, sort_keys=True, default=_json_default)
+
+    def find_all(self, collection) -> list:
+        rows = self._conn().execute(f"SELECT doc FROM {self._table(collection)}").fetchall()
+        return [json.loads(doc, object_hook=_json_object_hook) for (doc,) in rows]
+
+    def apply_changes(self, collection, reset, changes) -> None:
+        table = self._table(collection)
+        upserts = [(self._key(key_doc), json.dumps(doc, default=_json_default))
+                   for key_doc, doc in changes if doc is not None]
+        deletes = [(self._key(key_doc),) for key_doc, doc in changes if doc is None]
+        with self._conn() as conn:
+            if reset:
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany(f"INSERT OR REPLACE INTO {table} (key, doc) VALUES (?, ?)", upserts)
+            conn.executemany(f"DELETE FROM {table} WHERE key = ?", deletes)
+
+    def update_fields(self, collection, key_doc, fields) -> None:
+        table = self._table(collection)
+        key = self._key(key_doc)
+        with self._conn() as conn:
+            row = conn.execute(f"SELECT doc FROM {table} WHERE key = ?", (key,)).fetchone()
+            doc = json.loads(row[0], object_hook=_json_object_hook) if row else dict(key_doc)
+            doc.update(fields)
+            conn.execute(f"INSERT OR REPLACE INTO {table} (key, doc) VALUES (?, ?)",
+                         (key, json.dumps(doc, default=_json_default)))
+
+    def ensure_indexes(self, collection, key_fields, indexes=()) -> None:
+        # The key column is already the primary key; leaderboard indexes become expression indexes
+        table = self._table(collection)
+        with self._conn() as conn:
+            for index in indexes:
+                name = f"{collection}_" + "_".join(field for field, _ in index)
+                columns = ", ".join(
+                    f"json_extract(doc, '$.{field}'){' DESC' if direction < 0 else ''}" for field, direction in index
+                )
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON {table} ({columns})')
 
-def _load_mention_spam_tracker() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping mention_spam_tracker load")
-        return
-    try:
-        mention_spam_tracker.clear()
-        for doc in db.mention_spam_tracker.find():
-            key = tuple(doc["key"]) if isinstance(doc["key"], list) else ast.literal_eval(doc["key"])
-            mention_spam_tracker[key] = deque(doc["timestamps"], maxlen=MENTION_SPAM_THRESHOLD)
-        logger.debug("mention_spam_tracker loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading mention_spam_tracker: {e}")
+    def collection_names(self) -> list:
+        rows = self._conn().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return [name for (name,) in rows]
 
-def _load_mention_spam_warnings() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping mention_spam_warnings load")
-        return
-    try:
-        mention_spam_warnings.clear()
-        doc = db.mention_spam_warnings.find_one()
-        if doc:
-            mention_spam_warnings.update(doc["data"])
-        logger.debug("mention_spam_warnings loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading mention_spam_warnings: {e}")
 
-def _load_warnings_db() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping WARNINGS_DB load")
-        return
-    try:
-        WARNINGS_DB.clear()
-        doc = db.warnings_db.find_one()
-        if doc:
-            WARNINGS_DB.update(doc["data"])
-        logger.debug("WARNINGS_DB loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading WARNINGS_DB: {e}")
+MONGO_URI = os.getenv("MONGO_URI")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo" if MONGO_URI else "sqlite").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "miku.db")
 
-def _load_server_stats() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping server_stats load")
-        return
+def open_storage(kind=STORAGE_BACKEND):
+    """Connect the configured backend; returns None (persistence disabled) when that fails."""
     try:
-        server_stats.clear()
-        doc = db.server_stats.find_one()
-        if doc:
-            server_stats.update(doc["data"])
-        logger.debug("server_stats loaded successfully")
+        if kind == "sqlite":
+            backend = SQLiteBackend(SQLITE_PATH)
+            logger.info(f"✅ SQLite storage opened at {SQLITE_PATH}")
+            return backend
+        if kind == "mongo":
+            if not MONGO_URI or MongoClient is None:
+                logger.warning("⚠️ No MONGO_URI found or MongoClient unavailable, data persistence disabled")
+                return None
+            backend = MongoBackend(MONGO_URI)
+            logger.info("✅ MongoDB connection established")
+            return backend
+        logger.error(f"❌ Unknown STORAGE_BACKEND {kind!r}, data persistence disabled")
     except Exception as e:
-        logger.error(f"Error loading server_stats: {e}")
+        logger.error(f"❌ {kind} storage connection failed: {e}")
+    return None
+
+def collection_key_fields(collection) -> tuple:
+    """Key field names identifying one document of a collection."""
+    if collection == "guild_settings":
+        return ("guild_id",)
+    state = PERSISTED_STATES.get(collection)
+    return tuple(field for field, _ in state.key_fields) if state else ()
+
+def migrate_mongo_to_sqlite(sqlite_path=SQLITE_PATH) -> None:
+    """Copy every MongoDB collection into a SQLite file (python bb.py --migrate-mongo-to-sqlite)."""
+    source = MongoBackend(MONGO_URI)
+    target = SQLiteBackend(sqlite_path)
+    for collection in source.collection_names():
+        docs = source.find_all(collection)
+        key_fields = collection_key_fields(collection)
+        changes = []
+        for doc in docs:
+            if key_fields and all(field in doc for field in key_fields):
+                key_doc = {field: doc[field] for field in key_fields}
+            else:
+                key_doc = {"_id": str(doc["_id"])}  # legacy layout, converted on the next load
+            changes.append((key_doc, {k: v for k, v in doc.items() if k != "_id"}))
+        target.apply_changes(collection, True, changes)
+        state = PERSISTED_STATES.get(collection)
+        if state is not None:
+            target.ensure_indexes(collection, key_fields, state.indexes)
+        logger.info(f"Copied {len(changes)} documents from {collection}")
+    logger.info(f"✅ Migration to {sqlite_path} complete")
+
+storage = None  # opened by connect_storage() from MikuBot.setup_hook
+
+async def connect_storage() -> None:
+    """Open the configured backend on the storage thread, so connecting never blocks the loop."""
+    global storage
+    if storage is None:
+        storage = await run_storage(open_storage)
+
+@bot.command(name="storagestats")
+@commands.has_permissions(administrator=True)
+async def storage_stats(ctx):
+    """Show database latency and event loop lag (Admin only)"""
+    ops = storage_metrics["ops"]
+    avg_ms = storage_metrics["total_ms"] / ops if ops else 0.0
+    embed = discord.Embed(title="💾 Storage Stats", color=0x00ff88)
+    embed.description = f"**Backend:** {storage.name if storage else 'disabled'}"
+    embed.add_field(
+        name="Database Calls",
+        value=f"**Ops:** {ops:,}\n**Errors:** {storage_metrics['errors']:,}\n**On loop thread:** {storage_metrics['loop_thread_calls']}",
+        inline=True
+    )
+    embed.add_field(
+        name="Latency (storage thread)",
+        value=f"**Avg:** {avg_ms:.1f}ms\n**Last:** {storage_metrics['last_ms']:.1f}ms\n**Max:** {storage_metrics['max_ms']:.1f}ms",
+        inline=True
+    )
+    embed.add_field(
+        name="Write-Behind",
+        value=f"**Changes marked:** {storage_metrics['marks']:,}\n**Saves:** {storage_metrics['flushes']:,}\n**Interval:** {SAVE_INTERVAL:g}s",
+        inline=True
+    )
+    embed.add_field(
+        name="Event Loop Lag",
+        value=f"**Current:** {storage_metrics['loop_lag_ms']:.1f}ms\n**Max:** {storage_metrics['loop_lag_max_ms']:.1f}ms",
+        inline=True
+    )
+    embed.timestamp = discord.utils.utcnow()
+    await ctx.send(embed=embed)
 
-def _load_user_activity() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping user_activity load")
-        return
-    try:
-        user_activity.clear()
-        doc = db.user_activity.find_one()
-        if doc:
-            user_activity.update(doc["data"])
-        logger.debug("user_activity loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading user_activity: {e}")
+@bot.command(name="memstats")
+@commands.has_permissions(administrator=True)
+async def memory_stats(ctx):
+    """Show entries and approximate memory per tracker (Admin only)"""
+    embed = discord.Embed(title="🧠 Tracker Memory", color=0x00ff88)
+    total = 0
+    for name, cache in sorted(ttl_caches.items()):
+        size = cache.memory_bytes()
+        total += size
+        embed.add_field(
+            name=name,
+            value=f"**Entries:** {cache.entry_count():,}\n**Memory:** ~{size / 1024:.1f} KB\n**TTL:** {cache.ttl:g}s\n**Evicted:** {cache.evictions:,}",
+            inline=True
+        )
+    embed.description = f"**Total:** ~{total / 1024:.1f} KB across {len(ttl_caches)} trackers"
+    embed.set_footer(text=f"Idle entries are swept every {TTL_SWEEP_INTERVAL}s")
+    embed.timestamp = discord.utils.utcnow()
+    await ctx.send(embed=embed)
 
-def _load_message_cooldowns() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping message_cooldowns load")
-        return
-    try:
-        message_cooldowns.clear()
-        doc = db.message_cooldowns.find_one()
-        if doc:
-            message_cooldowns.update(doc["data"])
-        logger.debug("message_cooldowns loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading message_cooldowns: {e}")
+@bot.command(name="llmstats")
+@commands.has_permissions(administrator=True)
+async def llm_stats_command(ctx):
+    """Show the AI request queue and dispatcher counters (Admin only)"""
+    stats = llm_dispatcher.stats
+    depth = llm_dispatcher.queue_depth()
+    avg_wait = stats["wait_ms_total"] / stats["dispatched"] if stats["dispatched"] else 0.0
+    embed = discord.Embed(title="🤖 AI Request Queue", color=0x00ff88)
+    embed.add_field(
+        name="Queue",
+        value="\n".join(f"**{lane}:** {count}" for lane, count in depth.items())
+              + f"\n**Running:** {llm_dispatcher.running}/{llm_dispatcher.max_concurrency}",
+        inline=True
+    )
+    embed.add_field(
+        name="Requests",
+        value=f"**Submitted:** {stats['submitted']:,}\n**Dispatched:** {stats['dispatched']:,}\n"
+              f"**Avg Wait:** {avg_wait:.0f}ms\n**Failed:** {stats['failed']:,}",
+        inline=True
+    )
+    embed.add_field(
+        name="Backpressure",
+        value=f"**Merged:** {stats['merged']:,}\n**Dropped (stale):** {stats['dropped_stale']:,}\n"
+              f"**Shed:** {stats['shed']:,}\n**Cancelled:** {stats['cancelled']:,}\n"
+              f"**429s:** {stats['rate_limited']:,}",
+        inline=True
+    )
+    cooldown = llm_dispatcher.cooldown_remaining()
+    embed.set_footer(
+        text=(f"Per guild: {LLM_GUILD_BURST} burst, {LLM_GUILD_RATE:g}/min" if LLM_GUILD_RATE > 0 else "Per guild: no limit")
+             + f" • AI channel batches: {ai_batcher.stats['batches']:,} for {ai_batcher.stats['messages']:,} messages"
+             + (f" • API cooldown {cooldown:.0f}s" if cooldown else "")
+    )
+    embed.timestamp = discord.utils.utcnow()
+    await ctx.send(embed=embed)
 
+@bot.command(name="pipelinestats")
+@commands.has_permissions(administrator=True)
+async def pipeline_stats_command(ctx):
+    """Show per-stage latency of the message pipeline (Admin only)"""
+    embed = discord.Embed(title="⏱️ Message Pipeline", color=0x00ff88)
+    for stage in MESSAGE_STAGES:
+        stats = pipeline_stats[stage["name"]]
+        if stats["runs"]:
+            timing = (
+                f"**Avg:** {stats['total_ms'] / stats['runs']:.2f}ms\n"
+                f"**p50:** {latency_percentile(stats, 0.5)} • **p95:** {latency_percentile(stats, 0.95)}\n"
+                f"**Max:** {stats['max_ms']:.1f}ms"
+            )
+        else:
+            timing = "No runs yet"
+        embed.add_field(
+            name=stage["name"],
+            value=f"**Runs:** {stats['runs']:,} • **Skipped:** {stats['skipped']:,}\n"
+                  f"**Stopped:** {stats['stopped']:,} • **Errors:** {stats['errors']:,}\n{timing}",
+            inline=True
+        )
+    queue_stats = moderation_queue.stats
+    embed.add_field(
+        name="moderation_queue",
+        value=f"**Actions:** {queue_stats['actions']:,}\n**API calls:** {queue_stats['api_calls']:,}\n"
+              f"**Failed:** {queue_stats['failed_calls']:,}",
+        inline=True
+    )
+    embed.add_field(
+        name="modlog_buffer",
+        value=f"**Events:** {modlog_buffer.stats['events']:,}\n**Messages:** {modlog_buffer.stats['messages']:,}\n"
+              f"**Digests:** {modlog_buffer.stats['digests']:,}",
+        inline=True
+    )
+    embed.set_footer(text="Stages run top to bottom; timings include Discord API calls made by the stage")
+    embed.timestamp = discord.utils.utcnow()
+    await ctx.send(embed=embed)
 
-def _load_active_dm_conversations() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping active_dm_conversations load")
-        return
+# --- Persistence Functions ---
+BULK_WRITE_BATCH_SIZE = 500
+
+def stringify_keys(d):
+    """Recursively convert all dict keys to strings, copying nested dicts and lists."""
+    if isinstance(d, dict):
+        return {str(k): stringify_keys(v) for k, v in d.items()}
+    if isinstance(d, (list, deque)):
+        return [stringify_keys(v) for v in d]
+    return d
+
+
+class PersistedState:
+    """A module-level state dict stored as one document per key.
+
+    Code that mutates the state calls mark_dirty() with the key it touched, and
+    a save only writes those keys as unordered $set upserts (or deletes for keys
+    that no longer exist), instead of rewriting the whole collection.
+    """
+
+    def __init__(self, collection, get_state, key_fields, nested=False, encode=None, decode=None,
+                 legacy=None, indexes=(), on_load=None, written_at=None):
+        self.collection = collection
+        self.get_state = get_state      # returns the live module-level dict
+        self.key_fields = key_fields    # ((field_name, type), ...)
+        self.nested = nested            # {a: {b: value}} instead of {(a, b): value}
+        self.encode = encode            # value -> document fields, for values that need query fields
+        self.decode = decode or (lambda value: value)
+        self.indexes = indexes          # extra compound indexes for leaderboard/report queries
+        self.legacy = legacy or self._legacy_items
+        self.on_load = on_load          # called after restore() to rebuild derived state
+        self.written_at = written_at    # value -> time.time() it was recorded, for TTLCache-backed states
+        self.dirty = set()
+        self.reset = False              # delete every document before applying changes
+        self.ready = None               # asyncio.Event set once the startup load finished
+
+    def _slot(self, key):
+        return key if len(key) > 1 else key[0]
+
+    def lookup(self, key):
+        node = self.get_state()
+        if not self.nested:
+            return node.get(self._slot(key))
+        for part in key:
+            if not isinstance(node, MutableMapping) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def store(self, key, value) -> bool:
+        """Put a restored value in the state; False if its TTL had already run out."""
+        node = self.get_state()
+        if self.nested:
+            for part in key[:-1]:
+                node = node.setdefault(part, {})
+            slot = key[-1]
+        else:
+            slot = self._slot(key)
+        if self.written_at is not None and isinstance(node, TTLCache):
+            return node.set_with_time(slot, value, self.written_at(value))
+        node[slot] = value
+        return True
+
+    def keys(self):
+        state = self.get_state()
+        if not self.nested:
+            return [key if isinstance(key, tuple) else (key,) for key in state]
+        keys = []
+        def walk(node, prefix):
+            if len(prefix) == len(self.key_fields):
+                keys.append(prefix)
+                return
+            for part, child in node.items():
+                walk(child, prefix + (part,))
+        walk(state, ())
+        return keys
+
+    def mark_all(self) -> None:
+        """Rewrite the whole collection on the next save."""
+        self.reset = True
+        self.dirty.update(self.keys())
+
+    def drain(self):
+        """Collect pending changes as (key_doc, document or None); runs on the event loop."""
+        changes = []
+        for key in self.dirty:
+            value = self.lookup(key)
+            key_doc = {name: part for (name, _), part in zip(self.key_fields, key)}
+            if value is None:
+                changes.append((key_doc, None))
+            elif self.encode is not None:
+                changes.append((key_doc, {**self.encode(value), **key_doc}))
+            elif isinstance(value, dict):
+                changes.append((key_doc, {**stringify_keys(value), **key_doc}))
+            else:
+                changes.append((key_doc, {**key_doc, "value": stringify_keys(value)}))
+        reset, self.reset = self.reset, False
+        self.dirty = set()
+        return reset, changes
+
+    def requeue(self, reset, changes) -> None:
+        """Put changes back after a failed write so the next save retries them."""
+        self.reset = self.reset or reset
+        for key_doc, _ in changes:
+            self.dirty.add(tuple(key_doc[name] for name, _ in self.key_fields))
+
+    def _legacy_items(self, doc):
+        """Unpack the old {"data": {...}} single-document format, or None for a per-key document."""
+        if "data" not in doc:
+            return None
+        depth = len(self.key_fields) if self.nested else 1
+        items = []
+        def walk(node, prefix):
+            if len(prefix) == depth:
+                items.append((prefix, node))
+                return
+            for part, child in node.items():
+                walk(child, prefix + (part,))
+        walk(doc["data"], ())
+        if not self.nested and len(self.key_fields) > 1:
+            items = [(tuple(ast.literal_eval(key[0])), value) for key, value in items]
+        return items
+
+    def restore(self, docs) -> None:
+        """Replace the in-memory state with stored documents; runs on the event loop."""
+        key_names = {name for name, _ in self.key_fields}
+        state = self.get_state()
+        state.clear()
+        found_legacy = False
+        restored = []
+        for doc in docs:
+            items = self.legacy(doc)
+            if items is None:
+                key = tuple(doc[name] for name, _ in self.key_fields)
+                if "value" in doc:
+                    value = doc["value"]
+                else:
+                    value = {k: v for k, v in doc.items() if k != "_id" and k not in key_names}
+                items = [(key, value)]
+            else:
+                found_legacy = True
+            for key, value in items:
+                value = self.decode(value)
+                if value is OUTDATED_DOCUMENT:
+                    continue
+                key = tuple(kind(part) for (_, kind), part in zip(self.key_fields, key))
+                restored.append((key, value))
+        if self.written_at is not None:
+            restored.sort(key=lambda item: self.written_at(item[1]))  # TTLCache entries go in oldest first
+        expired = [key for key, value in restored if not self.store(key, value)]
+        self.dirty.clear()
+        self.dirty.update(expired)  # delete the documents of entries that expired while the bot was down
+        self.reset = False
+        if found_legacy:
+            # Convert the old single-document layout to per-key documents on the next save
+            self.mark_all()
+            logger.info(f"Migrating {self.collection} to per-key documents")
+
+
+def datetime_timestamp(value) -> float:
+    """time.time() value of a stored datetime; naive ones (as MongoDB returns them) are UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+OUTDATED_DOCUMENT = object()  # returned by a decode function for documents restore() should skip
+GUILD_USER_KEY = (("guild_id", int), ("user_id", str))
+MENTION_KEY = (("author_id", int), ("target_id", int))
+WEEKLY_INDEX = [("guild_id", 1), ("week", 1), ("count", -1)]
+
+def current_week_id() -> str:
+    """ISO week of the current UTC date, e.g. "2024-W07"."""
+    year, week, _ = datetime.datetime.utcnow().isocalendar()
+    return f"{year}-W{week:02d}"
+
+# The week the in-memory weekly counters belong to. Both weekly states are cleared at
+# the Monday 00:00 UTC boundary, which also advances this, so every count is stored
+# with the week it was recorded in.
+weekly_activity_week = current_week_id()
+
+def encode_week_days(days) -> dict:
+    """Store a 7-day counter with its week and total so leaderboards can be queried by index."""
+    return {"days": list(days), "week": weekly_activity_week, "count": sum(days)}
+
+def decode_week_days(value):
+    """The stored 7-day counter, or OUTDATED_DOCUMENT for one from an earlier week."""
+    # Documents written before the week/count fields hold the bare list in "value"
+    if not isinstance(value, dict):
+        return value
+    if value.get("week", weekly_activity_week) != weekly_activity_week:
+        return OUTDATED_DOCUMENT  # e.g. the bot was offline at the boundary; the next reset deletes it
+    return list(value["days"])
+
+def _server_stats_loaded() -> None:
+    for stats in server_stats.values():
+        for stat in SERVER_STAT_NAMES:
+            stats.setdefault(stat, 0)
+
+def _legacy_user_warnings(doc):
+    """Split pre-guild warning documents ({user_id: [warning, ...]}) by each warning's guild_id."""
+    if "guild_id" in doc:
+        return None
+    by_user = doc["data"] if "data" in doc else {doc["user_id"]: doc.get("value", [])}
+    items = defaultdict(list)
+    for user_id, warnings in by_user.items():
+        for warning in warnings:
+            items[(warning.get("guild_id", 0), user_id)].append(warning)
+    return list(items.items())
+
+def _channel_stats_loaded() -> None:
+    channel_stats["total_created"] = sum(
+        activity.get("channels_created", 0) for activity in channel_stats["user_activity"].values()
+    )
+    rebuild_leaderboards()
+
+PERSISTED_STATES = {state.collection: state for state in (
+    PersistedState("voice_activity", lambda: voice_activity_today, GUILD_USER_KEY, nested=True),
+    PersistedState(
+        "channel_stats", lambda: channel_stats["user_activity"], (("user_id", str),),
+        indexes=([("channels_created", -1)],), on_load=_channel_stats_loaded,
+        legacy=lambda doc: [
+            ((user_id,), value) for user_id, value in doc["data"].get("user_activity", {}).items()
+        ] if "data" in doc else None
+    ),
+    PersistedState(
+        "created_channels", lambda: created_channels, (("channel_id", int),),
+        legacy=lambda doc: [((cid,), True) for cid in doc["ids"]] if "ids" in doc else None
+    ),
+    PersistedState(
+        "everyone_warnings", lambda: everyone_warnings, GUILD_USER_KEY, nested=True,
+        legacy=lambda doc: [] if "guild_id" not in doc else None,  # pre-guild warnings are dropped
+        written_at=datetime_timestamp
+    ),
+    PersistedState("mention_spam_warnings", lambda: mention_spam_warnings, MENTION_KEY, written_at=float),
+    PersistedState("warnings_db", lambda: WARNINGS_DB, GUILD_USER_KEY, nested=True, legacy=_legacy_user_warnings),
+    PersistedState(
+        "server_stats", lambda: server_stats, (("guild_id", int),), on_load=_server_stats_loaded,
+        legacy=lambda doc: [] if "guild_id" not in doc else None  # old global counters are dropped
+    ),
+    PersistedState("user_activity", lambda: user_activity, (("user_id", str),)),
+    PersistedState(
+        "active_dm_conversations", lambda: active_dm_conversations, (("user_id", int),),
+        legacy=lambda doc: [((doc["user_id"],), doc["data"])] if "data" in doc else None
+    ),
+    PersistedState(
+        "voice_activity_alltime", lambda: voice_activity_alltime, GUILD_USER_KEY, nested=True,
+        indexes=([("guild_id", 1), ("total_time", -1)],), on_load=rebuild_leaderboards
+    ),
+    PersistedState(
+        "voice_activity_weekly", lambda: voice_activity_weekly, GUILD_USER_KEY, nested=True,
+        encode=encode_week_days, decode=decode_week_days, indexes=(WEEKLY_INDEX,),
+        on_load=rebuild_leaderboards
+    ),
+    PersistedState(
+        "chat_activity_weekly", lambda: chat_activity_weekly, GUILD_USER_KEY, nested=True,
+        encode=encode_week_days, decode=decode_week_days, indexes=(WEEKLY_INDEX,),
+        on_load=rebuild_leaderboards
+    ),
+)}
+
+def mark_dirty(collection, *key) -> None:
+    """Record that one key of a persisted state changed; the flusher writes it in the background."""
+    PERSISTED_STATES[collection].dirty.add(key)
+    storage_metrics["marks"] += 1
+    request_save()
+
+def mark_reset(collection) -> None:
+    """Record that a persisted state was cleared; the next save empties its collection."""
+    state = PERSISTED_STATES[collection]
+    state.reset = True
+    state.dirty.clear()
+    request_save()
+
+
+@storage_io
+def _write_guild_setting(guild_id, key, value) -> None:
     try:
-        active_dm_conversations.clear()
-        for doc in db.active_dm_conversations.find():
-            active_dm_conversations[int(doc["user_id"])] = doc["data"]
-        logger.debug("active_dm_conversations loaded successfully")
+        storage.update_fields("guild_settings", {"guild_id": guild_id}, {key: value})
     except Exception as e:
-        logger.error(f"Error loading active_dm_conversations: {e}")
+        logger.error(f"Error saving guild setting {key} for {guild_id}: {e}")
+
+@storage_io
+def _write_changes(batches) -> list:
+    """Apply drained changes with unordered bulk writes; returns the collections that failed."""
+    failed = []
+    for collection, reset, changes in batches:
+        try:
+            storage.apply_changes(collection, reset, changes)
+            logger.debug(f"{collection}: wrote {len(changes)} changed documents")
+        except Exception as e:
+            logger.error(f"Error saving {collection}: {e}")
+            failed.append(collection)
+    return failed
 
-def _load_voice_activity_alltime() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_alltime load")
+async def save_all_data() -> None:
+    """Write every key marked dirty since the last save."""
+    if storage is None:
+        logger.warning("Database not available, skipping save")
         return
-    try:
-        voice_activity_alltime.clear()
-        doc = db.voice_activity_alltime.find_one()
-        if doc:
-            voice_activity_alltime.update(doc["data"])
-        logger.debug("voice_activity_alltime loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading voice_activity_alltime: {e}")
 
-def _load_voice_activity_weekly() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping voice_activity_weekly load")
+    pending = {}
+    for name, state in PERSISTED_STATES.items():
+        if state.dirty or state.reset:
+            pending[name] = state.drain()
+    if not pending:
         return
+    batches = [(name, reset, changes) for name, (reset, changes) in pending.items()]
     try:
-        voice_activity_weekly.clear()
-        doc = db.voice_activity_weekly.find_one()
-        if doc:
-            voice_activity_weekly.update(doc["data"])
-        logger.debug("voice_activity_weekly loaded successfully")
+        failed = await run_storage(_write_changes, batches)
     except Exception as e:
-        logger.error(f"Error loading voice_activity_weekly: {e}")
+        logger.error(f"Error saving data: {e}")
+        failed = list(pending)
+    for name in failed:
+        PERSISTED_STATES[name].requeue(*pending[name])
+    written = sum(len(changes) for name, (_, changes) in pending.items() if name not in failed)
+    storage_metrics["flushes"] += 1
+    logger.debug(f"Saved {written} changed documents")
+
+
+# --- Write-Behind Flusher ---
+# Callers only mark state dirty. A single background task coalesces everything marked
+# within SAVE_INTERVAL into one save, so a change is never more than SAVE_INTERVAL
+# seconds (plus the write itself) away from the database. MikuBot.close() forces a
+# final flush on shutdown and SIGTERM.
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", "5"))  # seconds
+_flusher_wakeup = None
+_flusher_task = None
+
+def request_save() -> None:
+    """Wake the flusher; repeated requests within one interval collapse into a single save."""
+    if _flusher_wakeup is not None:
+        _flusher_wakeup.set()
+
+async def persistence_flusher() -> None:
+    loop = asyncio.get_running_loop()
+    last_flush = loop.time() - SAVE_INTERVAL
+    while True:
+        await _flusher_wakeup.wait()
+        delay = last_flush + SAVE_INTERVAL - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        _flusher_wakeup.clear()
+        last_flush = loop.time()
+        try:
+            # Shielded so cancelling the flusher never drops a half-finished save
+            await asyncio.shield(save_all_data())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background save failed: {e}")
 
-def _load_chat_activity_weekly() -> None:
-    if db is None:
-        logger.warning("Database not available, skipping chat_activity_weekly load")
+def start_persistence_flusher() -> None:
+    global _flusher_wakeup, _flusher_task
+    if storage is None or _flusher_task is not None:
         return
+    _flusher_wakeup = asyncio.Event()
+    _flusher_task = asyncio.create_task(persistence_flusher())
+    request_save()
+
+async def stop_persistence_flusher() -> None:
+    """Stop the flusher and write everything that is still dirty."""
+    global _flusher_task
+    if _flusher_task is None:
+        return
+    task, _flusher_task = _flusher_task, None
+    task.cancel()
     try:
-        chat_activity_weekly.clear()
-        doc = db.chat_activity_weekly.find_one()
-        if doc:
-            chat_activity_weekly.update(doc["data"])
-        logger.debug("chat_activity_weekly loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading chat_activity_weekly: {e}")
+        await task
+    except asyncio.CancelledError:
+        pass
+    await save_all_data()
+    logger.info("Final save on shutdown complete")
 
-def load_all_data() -> None:
-    global voice_activity_weekly
-    if db is None:
-        logger.warning("Database not available, skipping load")
-        return
 
-        
-    try:
-        _load_voice_activity_today()
-        
-        _load_channel_stats()
-        
-        _load_created_channels()
-        
-        _load_everyone_warnings()
-        
-        _load_mention_spam_tracker()
-        
-        _load_mention_spam_warnings()
-        
-        _load_warnings_db()
+@storage_io
+def _ensure_indexes() -> None:
+    """Index every collection on its key fields (upsert filters) plus its leaderboard indexes."""
+    for name, state in PERSISTED_STATES.items():
+        try:
+            storage.ensure_indexes(name, [field for field, _ in state.key_fields], state.indexes)
+        except Exception as e:
+            logger.error(f"Error creating indexes for {name}: {e}")
 
-        _load_server_stats()
-        
-        _load_user_activity()
-        
-        _load_message_cooldowns()
-        
-        _load_active_dm_conversations()
-        
-        _load_voice_activity_alltime()
-        
-        _load_voice_activity_weekly()
-        
-        _load_chat_activity_weekly()
-        
-        logger.info("All data loaded successfully")
+@storage_io
+def _read_collection(name) -> list:
+    """Fetch one persisted collection (runs on a storage read thread)."""
+    return storage.find_all(name)
+
+async def _load_state(state) -> None:
+    try:
+        docs = await run_storage(_read_collection, state.collection, executor=storage_read_executor)
+        state.restore(docs)
+        if state.on_load is not None:
+            state.on_load()
+        logger.debug(f"{state.collection} loaded successfully")
     except Exception as e:
-        logger.error(f"Error loading data on startup: {e}")
+        logger.error(f"Error loading {state.collection}: {e}")
+    finally:
+        state.ready.set()
+    request_save()  # write any documents migrated from the old layout
+
+async def load_all_data() -> None:
+    """Load every persisted state concurrently; each state becomes usable as soon as it is in."""
+    start = time.perf_counter()
+    await asyncio.gather(*(_load_state(state) for state in PERSISTED_STATES.values()))
+    logger.info(f"All data loaded successfully in {time.perf_counter() - start:.2f}s")
+
+def start_loading_state() -> None:
+    """Start the one-time background load; handlers use wait_for_state() for what they need."""
+    if storage is None:
+        logger.warning("Database not available, skipping load")
+        return
+    for state in PERSISTED_STATES.values():
+        state.ready = asyncio.Event()
+    spawn_background(run_storage(_ensure_indexes))
+    spawn_background(load_all_data())
 
 @bot.command(name="setmatchchannel")
 @commands.has_permissions(administrator=True)
@@ -3988,6 +6673,61 @@ async def set_welcome_channel(ctx, channel: discord.TextChannel):
     set_guild_setting(ctx.guild.id, "welcome_channel_id", channel.id)
     await ctx.send(f"✅ Welcome channel set to {channel.mention}")
 
+@bot.command(name="welcomemsg")
+@commands.has_permissions(administrator=True)
+async def welcome_message_command(ctx, action: Optional[str] = None, *, value: Optional[str] = None):
+    """Manage this server's welcome templates. Usage: !welcomemsg [add <text>|remove <number>|title <text>|reset]"""
+    guild_id = ctx.guild.id
+    settings = get_guild_settings(guild_id)
+    templates = list(settings.get("welcome_templates", []))
+    action = (action or "").lower()
+
+    if action == "add" and value:
+        error = validate_welcome_template(value)
+        if error:
+            await ctx.send(f"❌ Template has an {error}. Use `{{mention}}`, `{{name}}`, `{{server}}` or `{{count}}`.")
+            return
+        set_guild_setting(guild_id, "welcome_templates", templates + [value])
+        await ctx.send(f"✅ Added welcome template #{len(templates) + 1}.")
+
+    elif action == "remove" and value and value.strip().isdigit():
+        index = int(value) - 1
+        if not 0 <= index < len(templates):
+            await ctx.send("❌ No template with that number.")
+            return
+        templates.pop(index)
+        set_guild_setting(guild_id, "welcome_templates", templates)
+        await ctx.send(f"✅ Removed welcome template #{index + 1}.")
+
+    elif action == "title" and value:
+        set_guild_setting(guild_id, "welcome_title", value[:256])
+        await ctx.send("✅ Welcome title updated.")
+
+    elif action == "reset":
+        set_guild_setting(guild_id, "welcome_templates", [])
+        set_guild_setting(guild_id, "welcome_title", "🎃 Welcome to the Spooky Server!")
+        await ctx.send("✅ Welcome messages reset to the defaults.")
+
+    elif action in ("", "list"):
+        embed = discord.Embed(
+            title=settings.get("welcome_title", "🎃 Welcome to the Spooky Server!"),
+            description="\n".join(f"**{i}.** {t[:150]}" for i, t in enumerate(templates, 1))
+                        or "Using the default spooky templates.",
+            color=0x00ff88
+        )
+        embed.add_field(
+            name="Welcome DMs",
+            value=f"**Queued:** {welcome_dm_queue.qsize() if welcome_dm_queue else 0} • **Sent:** {welcome_dm_stats['sent']:,}\n"
+                  f"**DMs Closed:** {welcome_dm_stats['forbidden']:,} • **Dropped:** {welcome_dm_stats['dropped']:,} • "
+                  f"**Rate Limited:** {welcome_dm_stats['rate_limited']:,}",
+            inline=False
+        )
+        embed.set_footer(text="Placeholders: {mention} {name} {server} {count}")
+        await ctx.send(embed=embed)
+
+    else:
+        await ctx.send("❌ Usage: `!welcomemsg [add <text>|remove <number>|title <text>|reset]`")
+
 @bot.command(name="setmodlog")
 @commands.has_permissions(administrator=True)
 async def set_modlog_channel(ctx, channel: discord.TextChannel):
@@ -4020,9 +6760,16 @@ async def set_afk_channel(ctx, channel: discord.VoiceChannel):
 
 @bot.command(name="setaichannel")
 @commands.has_permissions(administrator=True)
-async def set_ai_channel(ctx, channel: discord.TextChannel):
+async def set_ai_channel(ctx, channel: discord.TextChannel, debounce: Optional[float] = None):
     set_guild_setting(ctx.guild.id, "ai_channel_id", channel.id)
-    await ctx.send(f"✅ AI/Miku channel set to {channel.mention}")
+    if debounce is None:
+        await ctx.send(f"✅ AI/Miku channel set to {channel.mention}")
+        return
+    if not 0 <= debounce <= 30:
+        await ctx.send("❌ The quiet period must be between 0 and 30 seconds.")
+        return
+    set_guild_setting(ctx.guild.id, "ai_debounce_seconds", debounce)
+    await ctx.send(f"✅ AI/Miku channel set to {channel.mention}, answering after {debounce:g}s of quiet")
 
 @bot.command(name="settimezone")
 @commands.has_permissions(administrator=True)
@@ -4369,8 +7116,11 @@ def update_weekly_voice_time(guild_id, user_id, seconds):
         voice_activity_weekly[guild_id][user_id] = [0] * 7
     idx = get_weekday_index()
     voice_activity_weekly[guild_id][user_id][idx] += seconds
+    mark_dirty("voice_activity_weekly", guild_id, user_id)
+    bump_leaderboard("voice_weekly", guild_id, user_id, sum(voice_activity_weekly[guild_id][user_id]))
 
 async def reset_voice_activity_weekly() -> None:
+    global weekly_activity_week
     while True:
         now = discord.utils.utcnow()
         # Find next Monday 00:00 UTC
@@ -4385,10 +7135,10 @@ async def reset_voice_activity_weekly() -> None:
             if not weekly:
                 continue
             # Find top user
-            user_totals = {user_id: sum(days) for user_id, days in weekly.items()}
-            if not user_totals:
+            top = get_leaderboard("voice_weekly", guild_id, limit=1)
+            if not top:
                 continue
-            top_user_id = max(user_totals, key=user_totals.get)
+            top_user_id, top_total = top[0]
             top_member = guild.get_member(int(top_user_id))
             if not top_member:
                 continue
@@ -4414,13 +7164,22 @@ async def reset_voice_activity_weekly() -> None:
             channel = guild.system_channel or guild.text_channels[0]
             if channel:
                 try:
-                    await channel.send(f"🏆 {top_member.mention} is the Voice Champion of the Week with {int(user_totals[top_user_id]//3600)}h {(int(user_totals[top_user_id])%3600)//60}m in VC!")
+                    await channel.send(f"🏆 {top_member.mention} is the Voice Champion of the Week with {int(top_total//3600)}h {(int(top_total)%3600)//60}m in VC!")
                 except Exception:
                     pass
         # Reset weekly data
         voice_activity_weekly.clear()
-        save_all_data()
-        logger.info("Reset weekly voice activity and awarded champion role.")
+        chat_activity_weekly.clear()
+        mark_reset("voice_activity_weekly")
+        mark_reset("chat_activity_weekly")
+        for key in [key for key in leaderboards if key[0] in ("voice_weekly", "chat_weekly")]:
+            del leaderboards[key]
+        weekly_activity_week = current_week_id()
+        logger.info("Reset weekly voice and chat activity and awarded champion role.")
+
+if "--migrate-mongo-to-sqlite" in sys.argv:
+    migrate_mongo_to_sqlite()
+    sys.exit(0)
 
 token = os.getenv("TOKEN")
 if not token:
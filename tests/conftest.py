@@ -0,0 +1,11 @@
+import os
+import sys
+
+# bb.py starts the bot at import time when TOKEN is set, and the Spotify client
+# needs credentials to be constructed.
+os.environ["TOKEN"] = ""
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test")
+os.environ.pop("MESSAGE_SPILL_PATH", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,43 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import bb
+
+
+def make_message(message_id, name, content, channel_id=1):
+    return SimpleNamespace(
+        id=message_id, content=content, channel=SimpleNamespace(id=channel_id),
+        author=SimpleNamespace(display_name=name),
+    )
+
+
+def test_history_appends_current_message():
+    bb.channel_history[1] = OrderedDict([(10, ("ann", "hi")), (11, ("bob", "yo"))])
+    current = make_message(12, "cat", "question")
+    history = asyncio.run(bb.get_recent_channel_history(current.channel, None, current))
+    assert history == [("ann", "hi"), ("bob", "yo"), ("cat", "question")]
+
+
+def test_history_leaves_out_excluded_batch():
+    bb.channel_history[1] = OrderedDict([
+        (10, ("ann", "hi")), (11, ("bob", "line one")), (12, ("bob", "line two")),
+    ])
+    current = make_message(12, "bob", "line two")
+    history = asyncio.run(bb.get_recent_channel_history(current.channel, None, current, exclude_ids={11, 12}))
+    assert history == [("ann", "hi")]
+
+
+class FailingChannel:
+    id = 2
+
+    async def history(self, limit):
+        yield SimpleNamespace(id=20, content="first", author=SimpleNamespace(display_name="ann"))
+        raise RuntimeError("503 Service Unavailable")
+
+
+def test_failed_load_is_not_cached():
+    bb.channel_history.pop(2, None)
+    ring = asyncio.run(bb.load_channel_history(FailingChannel(), None))
+    assert list(ring.values()) == [("ann", "first")]
+    assert 2 not in bb.channel_history
@@ -0,0 +1,39 @@
+import bb
+
+RAID_TEXT = (
+    "FREE NITRO for everyone!!! click the link below and claim your free nitro gift "
+    "before it expires today only"
+)
+
+
+def make_detector():
+    return bb.CopypastaDetector("copypasta_test", window=120, max_size=1000)
+
+
+def test_short_messages_are_not_sketched():
+    assert bb.copypasta_sketch("good morning everyone how are you doing") is None
+
+
+def test_near_identical_text_flags_once_enough_users_post_it():
+    detector = make_detector()
+    results = [detector.check(1, user, RAID_TEXT + " x" * user, 4, now=100 + user) for user in range(5)]
+    assert [result is not None for result in results] == [False, False, False, True, True]
+    assert len(results[-1]["users"]) == 5
+
+
+def test_one_user_repeating_a_text_is_not_a_raid():
+    detector = make_detector()
+    assert all(detector.check(1, "same", RAID_TEXT, 3, now=100 + i) is None for i in range(5))
+
+
+def test_users_outside_the_window_no_longer_count():
+    detector = make_detector()
+    detector.check(1, "a", RAID_TEXT, 3, now=0)
+    detector.check(1, "b", RAID_TEXT, 3, now=1)
+    assert detector.check(1, "c", RAID_TEXT, 3, now=200) is None
+
+
+def test_guilds_are_separate():
+    detector = make_detector()
+    detector.check(1, "a", RAID_TEXT, 2, now=0)
+    assert detector.check(2, "b", RAID_TEXT, 2, now=1) is None
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+import bb
+
+
+@pytest.fixture(autouse=True)
+def clean_settings():
+    bb.guild_settings_cache.clear()
+    bb._settings_writes_in_flight.clear()
+    bb._settings_written_at.clear()
+    yield
+    bb.guild_settings_cache.clear()
+    bb._settings_writes_in_flight.clear()
+    bb._settings_written_at.clear()
+
+
+def test_snapshot_replaces_and_removes_guilds():
+    bb.guild_settings_cache.update({1: {"guild_id": 1, "a": 1}, 2: {"guild_id": 2}})
+    bb._merge_guild_settings_snapshot([{"guild_id": 1, "a": 2}, {"guild_id": 3}], time.monotonic())
+    assert bb.guild_settings_cache == {1: {"guild_id": 1, "a": 2}, 3: {"guild_id": 3}}
+
+
+def test_guild_with_a_write_in_flight_keeps_its_settings():
+    bb.guild_settings_cache[1] = {"guild_id": 1, "ai_channel_id": 5}
+    bb._settings_writes_in_flight[1] = 1
+    bb._merge_guild_settings_snapshot([], time.monotonic())
+    assert bb.guild_settings_cache[1] == {"guild_id": 1, "ai_channel_id": 5}
+
+
+def test_write_finished_after_the_read_began_wins_over_the_snapshot():
+    bb.guild_settings_cache[1] = {"guild_id": 1, "timezone": "Asia/Kathmandu"}
+    read_started = time.monotonic()
+    bb._settings_writes_in_flight[1] = 1
+    bb._guild_setting_written(1)
+    bb._merge_guild_settings_snapshot([{"guild_id": 1, "timezone": "UTC"}], read_started)
+    assert bb.guild_settings_cache[1]["timezone"] == "Asia/Kathmandu"
+    assert 1 not in bb._settings_writes_in_flight
+
+
+def test_write_finished_before_the_read_takes_the_snapshot():
+    bb.guild_settings_cache[1] = {"guild_id": 1, "timezone": "UTC"}
+    bb._settings_writes_in_flight[1] = 1
+    bb._guild_setting_written(1)
+    read_started = bb._settings_written_at[1] + 0.001
+    bb._merge_guild_settings_snapshot([{"guild_id": 1, "timezone": "Europe/Paris"}], read_started)
+    assert bb.guild_settings_cache[1]["timezone"] == "Europe/Paris"
@@ -0,0 +1,45 @@
+import bb
+
+
+def test_update_keeps_top_n_highest_first():
+    board = bb.Leaderboard(size=3)
+    for user_id, score in [("a", 5), ("b", 9), ("c", 1), ("d", 7)]:
+        board.update(user_id, score)
+    assert board.top == [(9, "b"), (7, "d"), (5, "a")]
+
+
+def test_update_raises_existing_entry_without_duplicating_it():
+    board = bb.Leaderboard(size=3)
+    board.update("a", 1)
+    board.update("b", 2)
+    board.update("a", 10)
+    assert board.top == [(10, "a"), (2, "b")]
+
+
+def test_score_below_full_board_is_ignored():
+    board = bb.Leaderboard(size=2)
+    board.update("a", 5)
+    board.update("b", 4)
+    board.update("c", 4)
+    assert board.top == [(5, "a"), (4, "b")]
+
+
+def test_rebuild_matches_sorted_scores():
+    board = bb.Leaderboard(size=2)
+    board.rebuild({"a": 3, "b": 8, "c": 5})
+    assert board.top == [(8, "b"), (5, "c")]
+
+
+def test_week_days_round_trip_for_current_week():
+    doc = bb.encode_week_days([1, 2, 3, 0, 0, 0, 4])
+    assert doc == {"days": [1, 2, 3, 0, 0, 0, 4], "week": bb.weekly_activity_week, "count": 10}
+    assert bb.decode_week_days(doc) == [1, 2, 3, 0, 0, 0, 4]
+
+
+def test_week_days_from_an_earlier_week_are_skipped():
+    doc = {"days": [5] * 7, "week": "2000-W01", "count": 35}
+    assert bb.decode_week_days(doc) is bb.OUTDATED_DOCUMENT
+
+
+def test_legacy_week_days_list_still_loads():
+    assert bb.decode_week_days([1] * 7) == [1] * 7
@@ -0,0 +1,29 @@
+import bb
+
+
+def test_suffix_trie_matches_domains_and_subdomains_only():
+    trie = bb.DomainSuffixTrie(["tenor.com", "youtu.be"])
+    assert trie.matches("tenor.com")
+    assert trie.matches("media.tenor.com")
+    assert not trie.matches("eviltenor.com")
+    assert not trie.matches("tenor.com.evil.net")
+    assert not trie.matches("com")
+
+
+def test_extract_link_hosts():
+    assert bb.extract_link_hosts("see https://User:pw@Tenor.com:443/x and www.youtube.com/watch") == [
+        "tenor.com", "youtube.com",
+    ]
+
+
+def test_backslash_ends_the_host():
+    assert bb.extract_link_hosts(r"https://evil.com\@tenor.com/gif") == ["evil.com"]
+
+
+def test_ipv6_hosts():
+    assert bb.extract_link_hosts("http://[::1]/admin") == ["::1"]
+    assert bb.extract_link_hosts("http://[::1") == ["[::1"]
+
+
+def test_no_links():
+    assert bb.extract_link_hosts("just text, no links") == []
@@ -0,0 +1,61 @@
+import asyncio
+
+import bb
+
+
+def test_token_bucket_spends_burst_then_waits_for_refill():
+    bucket = bb.TokenBucket(rate=0.5, capacity=2)
+    now = bucket.updated
+    for _ in range(2):
+        assert bucket.ready_in(now) == 0
+        bucket.take()
+    assert bucket.ready_in(now) == 2.0
+    assert bucket.ready_in(now + 2) == 0
+
+
+def test_token_bucket_rate_zero_never_limits():
+    bucket = bb.TokenBucket(rate=0, capacity=1)
+    now = bucket.updated
+    for _ in range(5):
+        assert bucket.ready_in(now) == 0
+        bucket.take()
+
+
+def test_dispatcher_runs_commands_first_and_merges_by_key():
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+        return run
+
+    async def scenario():
+        dispatcher = bb.LLMDispatcher(max_concurrency=1, max_queue=10)
+        dispatcher.submit(1, bb.LLM_PRIORITY_AMBIENT, job("ambient old"), merge_key="chan")
+        dispatcher.submit(1, bb.LLM_PRIORITY_AMBIENT, job("ambient new"), merge_key="chan")
+        dispatcher.submit(2, bb.LLM_PRIORITY_COMMAND, job("command"))
+        dispatcher.start()
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if len(order) == 2:
+                break
+        dispatcher._task.cancel()
+        return dispatcher
+
+    dispatcher = asyncio.run(scenario())
+    assert order == ["command", "ambient new"]
+    assert dispatcher.stats["merged"] == 1
+
+
+def test_cancel_withdraws_a_queued_request():
+    dispatcher = bb.LLMDispatcher(max_concurrency=1, max_queue=10)
+
+    async def job():
+        pass
+
+    async def scenario():
+        dispatcher.submit(1, bb.LLM_PRIORITY_AMBIENT, job, merge_key="chan")
+        return dispatcher.cancel("chan"), dispatcher.cancel("chan")
+
+    assert asyncio.run(scenario()) == (True, False)
+    assert dispatcher.queue_depth() == {"!miku": 0, "ambient": 0}
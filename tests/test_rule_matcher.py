@@ -0,0 +1,41 @@
+import bb
+
+
+def names(matcher, text):
+    return [rule["name"] for rule in matcher.match(text)]
+
+
+def make_matcher(**settings):
+    return bb.build_rule_matcher({"auto_responses": False, **settings})
+
+
+def test_banned_words_match_inside_words_and_overlapping():
+    matcher = bb.RuleMatcher([
+        {"kind": "ban", "name": "bad", "literal": "bad"},
+        {"kind": "ban", "name": "badword", "literal": "badword"},
+    ])
+    assert names(matcher, "what a BADWORD") == ["bad", "badword"]
+    assert names(matcher, "nothing here") == []
+
+
+def test_invite_is_found_when_a_response_matches_the_same_text():
+    matcher = make_matcher(block_invites=True, custom_responses=[{"trigger": "discord", "reply": "hi"}])
+    assert names(matcher, "join discord.gg/abc") == ["invite", "discord"]
+    assert names(matcher, "discord.com/invite/xyz") == ["invite", "discord"]
+
+
+def test_word_triggers_need_word_boundaries():
+    matcher = make_matcher(custom_responses=[{"trigger": "c++", "reply": "x"}, {"trigger": "oj", "reply": "y"}])
+    assert names(matcher, "I like C++ a lot") == ["c++"]
+    assert names(matcher, "c++x") == []
+    assert names(matcher, "joj") == []
+    assert names(matcher, "oj!") == ["oj"]
+
+
+def test_results_follow_rule_priority():
+    matcher = make_matcher(banned_words=["spam"], custom_responses=[{"trigger": "hello", "reply": "hi"}])
+    assert [rule["kind"] for rule in matcher.match("hello spam")] == ["ban", "response"]
+
+
+def test_empty_matcher_matches_nothing():
+    assert bb.RuleMatcher([]).match("anything") == []
@@ -0,0 +1,32 @@
+import bb
+
+
+def make_counter(window=10, capacity=5):
+    counter = bb.SlidingWindowCounter("test", window=window, capacity=capacity)
+    bb.ttl_caches.pop("test", None)
+    return counter
+
+
+def test_hit_counts_events_inside_the_window():
+    counter = make_counter()
+    assert [counter.hit("k", now) for now in (100, 101, 102)] == [1, 2, 3]
+    assert counter.hit("k", 111) == 2  # 100 and 101 fell out; 102 and 111 remain
+    assert counter.count("k", 112.5) == 1
+
+
+def test_capacity_caps_the_count():
+    counter = make_counter(capacity=3)
+    for now in range(10):
+        count = counter.hit("k", 100 + now * 0.1)
+    assert count == 3
+
+
+def test_keys_are_counted_separately_and_reset():
+    counter = make_counter()
+    counter.hit(("g", 1), 100)
+    counter.hit(("g", 1), 101)
+    counter.hit(("g", 2), 101)
+    assert counter.count(("g", 1), 102) == 2
+    counter.reset(("g", 1))
+    assert counter.count(("g", 1), 102) == 0
+    assert counter.count(("g", 2), 102) == 1
@@ -0,0 +1,51 @@
+import datetime
+
+import pytest
+
+import bb
+
+
+def test_backend_missing_a_method_fails_at_construction():
+    class Incomplete(bb.StorageBackend):
+        def find_all(self, collection):
+            return []
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_sqlite_round_trip(tmp_path):
+    backend = bb.SQLiteBackend(str(tmp_path / "test.db"))
+    joined = datetime.datetime(2024, 2, 14, 12, 30)
+    backend.apply_changes("voice_activity", False, [
+        ({"guild_id": 1, "user_id": "a"}, {"guild_id": 1, "user_id": "a", "total_time": 60, "joined": joined}),
+        ({"guild_id": 1, "user_id": "b"}, {"guild_id": 1, "user_id": "b", "total_time": 5}),
+    ])
+    backend.apply_changes("voice_activity", False, [({"guild_id": 1, "user_id": "b"}, None)])
+    docs = backend.find_all("voice_activity")
+    assert docs == [{"guild_id": 1, "user_id": "a", "total_time": 60, "joined": joined}]
+    assert "voice_activity" in backend.collection_names()
+
+
+def test_sqlite_reset_and_update_fields(tmp_path):
+    backend = bb.SQLiteBackend(str(tmp_path / "test.db"))
+    backend.apply_changes("server_stats", False, [({"guild_id": 1}, {"guild_id": 1, "messages_today": 3})])
+    backend.apply_changes("server_stats", True, [({"guild_id": 2}, {"guild_id": 2, "messages_today": 1})])
+    assert backend.find_all("server_stats") == [{"guild_id": 2, "messages_today": 1}]
+    backend.update_fields("guild_settings", {"guild_id": 2}, {"timezone": "UTC"})
+    backend.update_fields("guild_settings", {"guild_id": 2}, {"ai_channel_id": 5})
+    assert backend.find_all("guild_settings") == [{"guild_id": 2, "timezone": "UTC", "ai_channel_id": 5}]
+
+
+def test_sqlite_has_no_change_streams(tmp_path):
+    backend = bb.SQLiteBackend(str(tmp_path / "test.db"))
+    assert not backend.supports_change_streams
+    with pytest.raises(NotImplementedError):
+        backend.watch("guild_settings")
+
+
+def test_sqlite_creates_weekly_index(tmp_path):
+    backend = bb.SQLiteBackend(str(tmp_path / "test.db"))
+    backend.ensure_indexes("chat_activity_weekly", ["guild_id", "user_id"], [bb.WEEKLY_INDEX])
+    names = [name for (name,) in backend._conn().execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert "chat_activity_weekly_guild_id_week_count" in names
@@ -0,0 +1,89 @@
+import datetime
+import time
+
+import bb
+
+
+def make_cache(ttl=60, **kwargs):
+    return bb.TTLCache("test", ttl=ttl, register=False, **kwargs)
+
+
+def test_expire_drops_entries_older_than_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bb.time, "monotonic", lambda: now[0])
+    cache = make_cache(ttl=10)
+    cache["a"] = 1
+    now[0] += 5
+    cache["b"] = 2
+    now[0] += 6
+    assert cache.expire() == 1
+    assert list(cache) == ["b"]
+
+
+def test_touch_keeps_an_entry_alive(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bb.time, "monotonic", lambda: now[0])
+    cache = make_cache(ttl=10)
+    cache["a"] = 1
+    now[0] += 8
+    cache.touch("a")
+    now[0] += 8
+    assert cache.expire() == 0
+    assert "a" in cache
+
+
+def test_max_size_evicts_oldest_and_calls_on_evict():
+    evicted = []
+    cache = make_cache(max_size=2, on_evict=lambda key, value: evicted.append((key, value)))
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    assert list(cache) == ["b", "c"]
+    assert evicted == [("a", 1)]
+    assert cache.evictions == 1
+
+
+def test_default_factory_and_explicit_delete_skip_on_evict():
+    evicted = []
+    cache = make_cache(default_factory=list, on_evict=lambda key, value: evicted.append(key))
+    cache["a"].append(1)
+    assert cache["a"] == [1]
+    del cache["a"]
+    assert cache.pop("missing", None) is None
+    assert evicted == []
+
+
+def test_set_with_time_keeps_the_original_age(monkeypatch):
+    monkeypatch.setattr(bb.time, "monotonic", lambda: 1000.0)
+    cache = make_cache(ttl=60)
+    assert not cache.set_with_time("old", 1, time.time() - 61)
+    assert cache.set_with_time("recent", 2, time.time() - 50)
+    assert list(cache) == ["recent"]
+    monkeypatch.setattr(bb.time, "monotonic", lambda: 1011.0)
+    assert cache.expire() == 1
+
+
+def test_restore_drops_expired_warnings_and_marks_them_for_deletion():
+    warnings = bb.TTLCache("restore_test", ttl=3600, register=False)
+    state = bb.PersistedState("restore_test", lambda: warnings, bb.MENTION_KEY, written_at=float)
+    now = time.time()
+    state.restore([
+        {"author_id": 1, "target_id": 2, "value": now - 7200},
+        {"author_id": 3, "target_id": 4, "value": now - 60},
+    ])
+    assert list(warnings) == [(3, 4)]
+    assert state.dirty == {(1, 2)}
+
+
+def test_restore_guild_warnings_from_naive_datetimes():
+    warnings = bb.GuildTrackers("restore_guild_test", ttl=3600)
+    bb.ttl_caches.pop("restore_guild_test")
+    state = bb.PersistedState(
+        "restore_guild_test", lambda: warnings, bb.GUILD_USER_KEY, nested=True, written_at=bb.datetime_timestamp
+    )
+    utcnow = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    state.restore([
+        {"guild_id": 1, "user_id": "old", "value": utcnow - datetime.timedelta(hours=2)},
+        {"guild_id": 1, "user_id": "new", "value": utcnow - datetime.timedelta(minutes=5)},
+    ])
+    assert list(warnings[1]) == ["new"]